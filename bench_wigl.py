@@ -0,0 +1,493 @@
+#!/usr/bin/python
+#
+# bench_wigl.py - benchmarks for wigl's hot paths
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Time the bits of wigl that run every frame (or at startup) and write the
+results out as JSON, so runs from different commits can be compared.
+
+The GL benchmarks use a headless context (WIGL_HEADLESS, default 'egl'),
+so they'll run on Mesa's llvmpipe if there's no GPU; the GL vendor and
+renderer are included in the results so you know what you're comparing.
+
+Each benchmark gets `warmup` untimed runs, then `repeat` timed runs of
+`number` calls each. Times are in seconds per call. Memory use is measured
+with one more (untimed) run with tracemalloc, where it's available (not on
+python 2). There's also the process's peak RSS after each benchmark, but
+that's a peak for the whole process - it never goes down - so the useful
+number is rss_growth_kb: how far this benchmark (setup included) pushed it
+up. That's 0 for anything that stayed under an earlier benchmark's peak.
+"""
+
+import os
+os.environ.setdefault('WIGL_HEADLESS', 'egl')
+
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+from timeit import default_timer as clock
+
+import numpy as np
+import OpenGL
+
+try:
+    import tracemalloc
+except ImportError: # python 2
+    tracemalloc = None
+
+import wigl
+import wigl.mesh
+from wigl import WIGL, VBO, ShaderProgram, VertexShader, FragmentShader
+from wigl import Texture2D, StreamingVBO, DrawItem, RenderQueue
+from wigl.math import *
+from wigl.mesh import simplemesh, triangle_mesh_indexes
+from wigl.mesh import index_gltype, GridLOD
+from wigl.pbm import readpbm
+from wigl.kinect import DEPTH_GLSL, depth_to_points, Registration
+from wigl.shadercache import ProgramCache
+from wigl.filters import depth_filter
+from wigl import fakenect
+# (not import *, which would clobber the platform module)
+from OpenGL.GL import glFinish, glDrawElements
+from OpenGL.GL import glGetString, GL_VENDOR, GL_RENDERER, GL_VERSION
+from OpenGL.GL import GL_TEXTURE_2D, GL_R16, GL_RED, GL_UNSIGNED_SHORT
+from OpenGL.GL import GL_RGB8, GL_RGB, GL_UNSIGNED_BYTE
+from OpenGL.GL import GL_ELEMENT_ARRAY_BUFFER, GL_TRIANGLE_STRIP
+
+BENCHMARKS = list()
+
+def benchmark(name, number=1, gl=False):
+    '''Register a benchmark. The decorated function does any setup and
+       returns the function to be timed.'''
+    def decorator(setup):
+        BENCHMARKS.append((name, setup, number, gl))
+        return setup
+    return decorator
+
+# hello_kinect's shaders, more or less
+VERTEX_SHADER = """
+    #version 330
+    %s
+    in vec2 meshpos;
+    layout(std140) uniform Camera {
+        mat4 projection;
+        mat4 view;
+    };
+    uniform mat4 model;
+    uniform sampler2D heightmap;
+    smooth out vec4 frag_color;
+    void main() {
+        float aspect = 4.0/3.0;
+        vec2 texpos = vec2((meshpos.x+aspect)/(2*aspect),
+                           (1-meshpos.y)/2);
+        vec4 position = vec4(meshpos, 0.0, 1.0);
+        position.z = raw_to_meters(
+                        texture(heightmap, texpos).r*65535.0);
+        gl_Position = projection * view * model * position;
+        frag_color = vec4(position.xyz, 1.0);
+    }
+""" % DEPTH_GLSL
+
+FRAGMENT_SHADER = """
+    #version 330
+    smooth in vec4 frag_color;
+    out vec4 out_color;
+    void main() {
+        out_color = frag_color;
+    }
+"""
+
+def scene_shaders():
+    return VertexShader(VERTEX_SHADER), FragmentShader(FRAGMENT_SHADER)
+
+class Scene(WIGL):
+    """A heightmap like hello_kinect's, minus the Kinect."""
+    def setup(self):
+        self.perspective(fovy=60)
+        self.lookat(eye=(0,0,-1.5))
+        self.shaders = ShaderProgram(*scene_shaders())
+        self.vertex_vbo = VBO(simplemesh(320,240,aspect=self.aspect))
+        self.shaders.bind_attr('meshpos', self.vertex_vbo)
+        self.tri_idx = VBO(triangle_mesh_indexes(self.vertex_vbo, dtype=None),
+                           target=GL_ELEMENT_ARRAY_BUFFER)
+        self.device = fakenect.FakeDevice(None, 0)
+        self.device.make_depth_frame()
+        self.texture = Texture2D(self.device.depth, GL_TEXTURE_2D,
+                                 GL_R16, GL_RED, GL_UNSIGNED_SHORT)
+        self.texture.load()
+        self.shaders.set_uniform("heightmap", self.texture.unit)
+
+    def display(self):
+        self.texture.bind(self.texture.unit)
+        self.tri_idx.bind()
+        gltype = index_gltype(self.tri_idx.data)
+        self.glstate.primitive_restart(gltype)
+        glDrawElements(GL_TRIANGLE_STRIP, self.tri_idx.data.size, gltype, None)
+
+class Context(object):
+    """Things the benchmarks might need."""
+    def __init__(self, gl=True):
+        self.tmpdir = tempfile.mkdtemp(prefix="bench_wigl.")
+        self.scene = None
+        if gl:
+            # WIGL prints the GL info to stdout, which is where the JSON goes
+            stdout, sys.stdout = sys.stdout, sys.stderr
+            try:
+                self.scene = Scene(size=(640,480))
+            finally:
+                sys.stdout = stdout
+
+    def close(self):
+        shutil.rmtree(self.tmpdir)
+        if self.scene is not None:
+            self.scene.destroy()
+
+# wigl.math
+
+@benchmark('math.translate', number=1000)
+def bench_translate(ctx):
+    return lambda: translate(1, 2, 3)
+
+@benchmark('math.rotate', number=1000)
+def bench_rotate(ctx):
+    return lambda: rotate(30, 0, 1, 0)
+
+@benchmark('math.scale', number=1000)
+def bench_scale(ctx):
+    return lambda: scale(1, 2, 3)
+
+@benchmark('math.lookat', number=1000)
+def bench_lookat(ctx):
+    return lambda: lookat((0,0,-1.5), (0,0,0), (0,1,0))
+
+@benchmark('math.perspective', number=1000)
+def bench_perspective(ctx):
+    return lambda: perspective(60, 4/3.0, 0.1, 10.0)
+
+@benchmark('math.ortho', number=1000)
+def bench_ortho(ctx):
+    return lambda: ortho()
+
+@benchmark('math.rotations[1000]', number=100)
+def bench_rotations(ctx):
+    angles = np.linspace(0, 360, 1000)
+    axes = np.random.RandomState(0).rand(1000, 3)
+    out = np.empty((1000,4,4), dtype=np.float32)
+    return lambda: rotations(angles, axes, out=out)
+
+@benchmark('math.compose[1000]', number=100)
+def bench_compose(ctx):
+    a = translations(np.random.RandomState(0).rand(1000, 3))
+    b = rotations(np.linspace(0, 360, 1000), np.tile((0,1,0), (1000,1)))
+    out = np.empty_like(a)
+    return lambda: compose(a, b, out=out)
+
+# wigl.mesh
+
+@benchmark('mesh.simplemesh(320x240)', number=10)
+def bench_simplemesh(ctx):
+    return lambda: simplemesh(320, 240, aspect=4/3.0)
+
+@benchmark('mesh.triangle_mesh_indexes(320x240, uncached)', number=10)
+def bench_indexes(ctx):
+    mesh = simplemesh(320, 240)
+    def run():
+        wigl.mesh._index_cache.clear()
+        triangle_mesh_indexes(mesh)
+    return run
+
+@benchmark('mesh.triangle_mesh_indexes(640x480, uncached)', number=3)
+def bench_indexes_big(ctx):
+    mesh = simplemesh(640, 480)
+    def run():
+        wigl.mesh._index_cache.clear()
+        triangle_mesh_indexes(mesh)
+    return run
+
+@benchmark('mesh.triangle_mesh_indexes(320x240, cached)', number=1000)
+def bench_indexes_cached(ctx):
+    mesh = simplemesh(320, 240)
+    return lambda: triangle_mesh_indexes(mesh)
+
+@benchmark('mesh.GridLOD.select(4x4 tiles)', number=100)
+def bench_lod_select(ctx):
+    lod = GridLOD(simplemesh(320, 240, aspect=4/3.0), tiles=(4,4),
+                  zrange=(0,2))
+    mvp = compose(perspective(60, 4/3.0, 0.1, 10.0),
+                  lookat((0,0,-3), (0,0,0), (0,1,0)))
+    return lambda: lod.select(mvp, (640,480))
+
+# wigl.pbm
+
+@benchmark('pbm.readpbm(640x480x16)', number=100)
+def bench_readpbm(ctx):
+    filename = os.path.join(ctx.tmpdir, "depth.pgm")
+    data = (np.arange(640*480) % 2048).astype('>u2')
+    with open(filename, "wb") as f:
+        f.write(b"P5\n# benchmark\n640 480\n65535\n")
+        f.write(data.tostring())
+    # actually touch the data, or we're only timing the header parsing
+    return lambda: readpbm(filename).sum()
+
+# wigl.kinect
+
+@benchmark('kinect.Registration.map(640x480)', number=30)
+def bench_registration_map(ctx):
+    reg = Registration()
+    raw = (np.arange(640*480) % 2048).astype(np.uint16).reshape(480, 640)
+    out = np.empty(reg.coords.shape, dtype=np.float32)
+    return lambda: reg.map(raw, out)
+
+@benchmark('kinect.Registration.colors(640x480)', number=30)
+def bench_registration_colors(ctx):
+    reg = Registration()
+    raw = (np.arange(640*480) % 2048).astype(np.uint16).reshape(480, 640)
+    video = np.zeros((480, 640, 3), dtype=np.uint8)
+    out = np.empty((480, 640, 3), dtype=np.uint8)
+    return lambda: reg.colors(raw, video, out)
+
+# GL
+
+@benchmark('Texture2D.load(640x480x16)', number=10, gl=True)
+def bench_texture_load(ctx):
+    data = ctx.scene.device.depth.copy()
+    def run():
+        tex = Texture2D(data, GL_TEXTURE_2D, GL_R16, GL_RED, GL_UNSIGNED_SHORT)
+        tex.load()
+        glFinish()
+        tex.delete()
+    return run
+
+@benchmark('Texture2D.replace(640x480x16)', number=30, gl=True)
+def bench_texture_replace(ctx):
+    data = ctx.scene.device.depth.copy()
+    tex = Texture2D(data, GL_TEXTURE_2D, GL_R16, GL_RED, GL_UNSIGNED_SHORT)
+    tex.load()
+    def run():
+        tex.replace(data)
+        glFinish()
+    return run
+
+@benchmark('Texture2D.replace(640x480x16, streaming)', number=30, gl=True)
+def bench_texture_stream(ctx):
+    data = ctx.scene.device.depth.copy()
+    tex = Texture2D(data, GL_TEXTURE_2D, GL_R16, GL_RED, GL_UNSIGNED_SHORT)
+    tex.load()
+    tex.enable_streaming()
+    def run():
+        tex.replace(data)
+        glFinish()
+    return run
+
+@benchmark('Texture2D.replace(640x480 RGB, streaming)', number=30, gl=True)
+def bench_video_stream(ctx):
+    device = ctx.scene.device
+    device.make_video_frame()
+    data = device.video.copy()
+    tex = Texture2D(data, GL_TEXTURE_2D, GL_RGB8, GL_RGB, GL_UNSIGNED_BYTE)
+    tex.load()
+    tex.enable_streaming()
+    def run():
+        tex.replace(data)
+        glFinish()
+    return run
+
+@benchmark('StreamingVBO.begin/end point cloud (640x480)', number=30, gl=True)
+def bench_streaming_vbo(ctx):
+    raw = np.full((480, 640), 700, dtype=np.uint16)
+    points = StreamingVBO((480*640, 3), np.float32)
+    def run():
+        depth_to_points(raw, out=points.begin().reshape(480, 640, 3))
+        points.end()
+        points.fence()
+        glFinish()
+    return run
+
+@benchmark('ShaderProgram build (no cache)', number=5, gl=True)
+def bench_program_nocache(ctx):
+    def run():
+        prog = ShaderProgram(*scene_shaders(), cache=None)
+        prog.delete()
+    return run
+
+@benchmark('ShaderProgram build (cached)', number=5, gl=True)
+def bench_program_cached(ctx):
+    cache = ProgramCache(os.path.join(ctx.tmpdir, "shaders"))
+    def run():
+        prog = ShaderProgram(*scene_shaders(), cache=cache)
+        prog.delete()
+    return run
+
+@benchmark('WIGL.apply_matrices', number=1000, gl=True)
+def bench_apply_matrices(ctx):
+    scene = ctx.scene
+    def run():
+        scene.rotate(1, 0, 1, 0)
+        scene.apply_matrices()
+    return run
+
+@benchmark('bind program+VAO+texture (already bound)', number=1000, gl=True)
+def bench_rebind(ctx):
+    scene = ctx.scene
+    def run():
+        with scene.shaders, scene.vao:
+            scene.texture.bind(scene.texture.unit)
+            scene.tri_idx.bind()
+    return run
+
+@benchmark('RenderQueue.draw (64 items, 1 batch)', number=100, gl=True)
+def bench_render_queue(ctx):
+    scene = ctx.scene
+    queue = RenderQueue()
+    # (small strips, so this is about CPU overhead, not llvmpipe's fill rate)
+    n = scene.tri_idx.data.size // 64
+    for k in xrange(64):
+        queue.add(DrawItem(scene.shaders, scene.vao, GL_TRIANGLE_STRIP,
+                           scene.tri_idx, first=k*n, count=64,
+                           textures=[scene.texture]))
+    return queue.draw
+
+@benchmark('filters.depth_filter run (640x480)', number=10, gl=True)
+def bench_depth_filter(ctx):
+    scene = ctx.scene
+    chain = depth_filter(scene.texture.data.shape[::-1])
+    def run():
+        chain.run(scene.texture)
+        glFinish()
+    return run
+
+@benchmark('depth frame to draw (320x240 grid)', number=10, gl=True)
+def bench_frame(ctx):
+    scene = ctx.scene
+    def run():
+        scene.device.make_depth_frame()
+        scene.texture.replace(scene.device.depth)
+        scene.step()
+        glFinish()
+    return run
+
+# running the things
+
+def maxrss_kb():
+    '''Peak resident set size of this process, in KB'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux says KB, OS X says bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def run_benchmark(ctx, name, setup, number, warmup, repeat):
+    rss_before = maxrss_kb()
+    func = setup(ctx)
+    for i in xrange(warmup):
+        func()
+    times = list()
+    for i in xrange(repeat):
+        start = clock()
+        for j in xrange(number):
+            func()
+        times.append((clock() - start) / number)
+    traced_peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        func()
+    times = np.array(times)
+    peak_rss = maxrss_kb()
+    return dict(
+        name=name,
+        number=number,
+        repeat=repeat,
+        warmup=warmup,
+        times=times.tolist(),
+        min=times.min(),
+        median=np.median(times),
+        mean=times.mean(),
+        stdev=times.std(),
+        traced_peak_bytes=traced_peak,
+        process_peak_rss_kb=peak_rss,
+        rss_growth_kb=peak_rss - rss_before,
+    )
+
+def git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here,
+                                      stderr=open(os.devnull, "w"))
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def metadata(ctx):
+    meta = dict(
+        time=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        commit=git_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        numpy=np.__version__,
+        pyopengl=OpenGL.__version__,
+        mode=wigl.MODE or 'default',
+    )
+    if ctx.scene is not None:
+        for i in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+            meta[i.name.lower()] = glGetString(i).decode('ascii')
+    return meta
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark wigl.")
+    parser.add_argument("-o", "--output", default="-",
+                        help="write JSON results here (default: stdout)")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="timed runs per benchmark (default: %(default)s)")
+    parser.add_argument("-w", "--warmup", type=int, default=1,
+                        help="untimed runs first (default: %(default)s)")
+    parser.add_argument("-k", "--filter", default="",
+                        help="only run benchmarks with this in their name")
+    parser.add_argument("--no-gl", action="store_true",
+                        help="skip benchmarks that need a GL context")
+    args = parser.parse_args()
+
+    todo = [b for b in BENCHMARKS if args.filter in b[0]
+                                  and not (args.no_gl and b[3])]
+    ctx = Context(gl=any(b[3] for b in todo))
+    results = list()
+    try:
+        for name, setup, number, gl in todo:
+            result = run_benchmark(ctx, name, setup, number,
+                                   args.warmup, args.repeat)
+            sys.stderr.write("%-50s %12.3fus\n" % (name, result['median']*1e6))
+            results.append(result)
+        out = dict(meta=metadata(ctx), benchmarks=results)
+    finally:
+        ctx.close()
+
+    if args.output == "-":
+        json.dump(out, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -17,13 +17,20 @@
 # You should have received a copy of the GNU General Public License
 # along with wigl.  If not, see <http://www.gnu.org/licenses/>.
 
+# (wigl goes first, so WIGL_MODE and WIGL_HEADLESS can set up PyOpenGL)
+from wigl import WIGL, VBO, DO_REDRAW
+from wigl import ShaderProgram, VertexShader, FragmentShader, Texture2D
+
 from OpenGL.GL import *
 
-from wigl import WIGL, VBO, DO_REDRAW, RESTART_INDEX
-from wigl import ShaderProgram, VertexShader, FragmentShader, Texture2D
+from wigl.mesh import simplemesh, GridLOD
+from wigl.math import compose
+from wigl.kinect import Kinect, DEPTH_GLSL, Registration
+from wigl.kinect import DEPTH_MIN, DEPTH_MAX
+from wigl.filters import depth_filter
+from wigl.recording import KinectPlayback
 
-from wigl.mesh import simplemesh, triangle_mesh_indexes
-from wigl.kinect import Kinect, KinectError
+import sys
 
 import numpy as np
 
@@ -33,6 +40,13 @@ class Heightmap(WIGL):
         self.rotcounter = 0.0
         self.frames = 0
         self.texture = None
+        self.video = None
+        # hole filling, smoothing and temporal averaging, on the GPU
+        self.filter = None
+        self.filtering = True
+        # color each vertex from the RGB camera, if there is one
+        self.registration = Registration()
+        self.coloring = True
 
         # set up projection + view matrices
         self.center = [0,0,0]
@@ -44,27 +58,33 @@ class Heightmap(WIGL):
         self.shaders = ShaderProgram(
             VertexShader("""
                 #version 330
+                %s
+                %s
                 in vec2 meshpos;
                 in vec3 color;
                 smooth out vec4 frag_color;
-                uniform mat4 projection;
-                uniform mat4 view;
+                layout(std140) uniform Camera {
+                    mat4 projection;
+                    mat4 view;
+                };
                 uniform mat4 model;
                 uniform sampler2D heightmap;
+                uniform sampler2D registration;
+                uniform sampler2D video;
+                uniform bool use_video;
                 void main() {
                     // Find the height value that corresponds to this grid point
                     float aspect = 4.0/3.0; // FIXME: uniform
+                    // (the depth frame's top row is at t=0, so flip t)
                     vec2 texpos = vec2((meshpos.x+aspect)/(2*aspect),
-                                       (meshpos.y+1)/2);
+                                       (1-meshpos.y)/2);
                     vec4 hmpos = texture(heightmap, texpos);
 
                     // Construct the vertex accordingly
                     vec4 position = vec4(1.0);
                     position.xy = meshpos;
                     // Convert depth from raw data to (approximate) meters
-                    hmpos.r = clamp(hmpos.r, 500.0/65536.0, 1000.0/65536.0);
-                    position.z = 0.1236*tan(hmpos.r*23.05576+1.1863) - 0.5;
-                    position.z = clamp(position.z, 0.0, 2.0);
+                    position.z = raw_to_meters(hmpos.r*65535.0);
 
                     gl_Position = projection * view * model * position;
 
@@ -75,8 +95,15 @@ class Heightmap(WIGL):
                     frag_color.r += position.x;
                     frag_color.g += position.y;
                     frag_color.b += position.z;
+
+                    // or the RGB camera's color, if we've got it
+                    if (use_video) {
+                        vec2 st = texture(registration, texpos).rg;
+                        frag_color = texture(video,
+                                             video_coord(st, position.z));
+                    }
                 }
-            """),
+            """ % (DEPTH_GLSL, self.registration.glsl)),
             FragmentShader("""
                 #version 330
                 smooth in vec4 frag_color;
@@ -90,9 +117,16 @@ class Heightmap(WIGL):
         self.vertex_vbo = VBO(simplemesh(320,240,aspect=self.aspect))
         self.shaders.bind_attr('meshpos', self.vertex_vbo)
 
-        # Create a VBO for index data for triangles
-        self.tri_idx = VBO(triangle_mesh_indexes(self.vertex_vbo),
-                                 target=GL_ELEMENT_ARRAY_BUFFER)
+        # Create a VBO for index data for triangles, at a few levels of
+        # detail so we don't draw more triangles than there are pixels
+        self.lod = GridLOD(self.vertex_vbo.data, levels=4, tiles=(4,4),
+                           zrange=(DEPTH_MIN, DEPTH_MAX))
+        self.tri_idx = VBO(self.lod.indexes, target=GL_ELEMENT_ARRAY_BUFFER)
+        # one DrawItem per tile; the render queue draws them all at once
+        self.tiles = self.lod.items(self.shaders, self.vao, GL_TRIANGLE_STRIP,
+                                    self.tri_idx)
+        for item in self.tiles:
+            self.queue.add(item)
 
         # Color data!
         colors = ((1,0,0),(0,1,0),(0,0,1))
@@ -101,23 +135,48 @@ class Heightmap(WIGL):
         ], dtype=np.float32))
         self.shaders.bind_attr('color', self.color_vbo)
 
-        # update rotation every 10ms
-        self.timer(10, self.rotate_model, repeat=True)
+        # update rotation 100 times a second, and check for new depth
+        # frames twice as often as the Kinect makes them. Both of these can
+        # ask for a redraw; we'll still only draw once per vsync.
+        self.every(1/100.0, self.rotate_model)
+        self.every(1/60.0, self.poll_kinect)
 
-        # set up the kinect callback
-        self.kinect = Kinect()
-        self.kinect.start_depth(self.new_depth_frame)
-
-    def idle(self):
-        try:
-            self.kinect.process_events()
-        except KinectError as e:
-            print e
+        # start capturing from the kinect in the background
+        # (or replay a recording, if we were given one)
+        if len(sys.argv) > 1:
+            self.kinect = KinectPlayback(sys.argv[1], loop=True)
+        else:
+            self.kinect = Kinect()
+        self.kinect.start_capture(video=self.kinect.has_video)
+        self.shaders.set_uniforms(use_video=False)
+        if self.kinect.has_video:
+            # where each depth pixel lands in the RGB frame (at infinity)
+            self.regmap = Texture2D(self.registration.coords, GL_TEXTURE_2D,
+                                    GL_RG32F, GL_RG, GL_FLOAT)
+            self.regmap.load(unit=1)
+            self.shaders.set_uniforms(registration=1, video=2)
+
+    def poll_kinect(self, value=None):
+        capture = self.kinect.capture
+        if capture.error:
+            print capture.error
             self.quit()
+        elif capture.has_new:
+            data, timestamp = self.kinect.latest_depth()
+            self.new_depth_frame(self.kinect, data, timestamp)
+        if capture.video is not None and capture.video.has_new:
+            data, timestamp = self.kinect.latest_video()
+            self.new_video_frame(self.kinect, data, timestamp)
 
     def keyboard(self, key, x, y):
         if key == " ":
             self.rotation = not self.rotation
+        elif key == "f":
+            self.filtering = not self.filtering
+            print "depth filtering: %s" % ("on" if self.filtering else "off")
+        elif key == "c":
+            self.coloring = not self.coloring
+            print "video color: %s" % ("on" if self.coloring else "off")
         elif key == "r":
             self.resetmodel()
         elif key == "a":
@@ -132,6 +191,9 @@ class Heightmap(WIGL):
             self.eye[1] += 0.1
         elif key == "q":
             self.eye[1] -= 0.1
+        elif key == "t":
+            print self.timing.format()
+            print "indexes drawn: %d" % self.lod.drawn
 
         if key in "wasdeqr":
             print "center: %s" % self.center
@@ -146,18 +208,37 @@ class Heightmap(WIGL):
             self.texture = Texture2D(data, GL_TEXTURE_2D,
                                      GL_R16, GL_RED, GL_UNSIGNED_SHORT)
             self.texture.load()
+            self.texture.enable_streaming()
+            self.filter = depth_filter(data.shape[::-1])
         else:
             self.texture.replace(data)
-        heightmap = self.shaders.get_uniform("heightmap")
-        with self.shaders:
-            glUniform1i(heightmap, self.texture.unit)
+        heightmap = self.texture
+        if self.filtering:
+            heightmap = self.filter.run(self.texture)
+        textures = (heightmap,)
+        use_video = self.coloring and self.video is not None
+        if use_video:
+            textures += (self.regmap, self.video)
+        for item in self.tiles:
+            item.textures = textures
+        self.shaders.set_uniforms(heightmap=heightmap.unit,
+                                  use_video=use_video)
         self.frames += 1
         self.redraw()
 
+    def new_video_frame(self, dev, data, timestamp):
+        if not self.video:
+            self.video = Texture2D(data, GL_TEXTURE_2D,
+                                   GL_RGB8, GL_RGB, GL_UNSIGNED_BYTE)
+            self.video.load(unit=2)
+            self.video.enable_streaming()
+        else:
+            self.video.replace(data)
+        # (the next depth frame picks it up)
+
     def display(self):
-        self.tri_idx.bind()
-        glDrawElements(GL_TRIANGLE_STRIP, self.tri_idx.data.size,
-                       GL_UNSIGNED_INT, None)
+        mvp = compose(compose(self.projection, self.view), self.model)
+        self.lod.update_items(self.tiles, self.lod.select(mvp, self.size))
 
     def rotate_model(self, value):
         # rotate model around the y axis
@@ -167,7 +248,6 @@ class Heightmap(WIGL):
             self.rotate(self.rotcounter*45, 0,1,0)
             self.apply_matrices()
             self.redraw()
-        self.idle()
 
 if __name__ == '__main__':
     w = Heightmap()
@@ -0,0 +1,108 @@
+# test_shadercache.py - tests for wigl.shadercache
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+These need a GL context, so they use a headless one (WIGL_HEADLESS,
+default 'egl'), and get skipped if that can't be had. Run them with:
+
+    python -m unittest discover tests
+"""
+
+import os
+os.environ.setdefault('WIGL_HEADLESS', 'egl')
+
+import shutil
+import tempfile
+import unittest
+
+from wigl import WIGL, ShaderProgram, VertexShader, FragmentShader
+from wigl.shadercache import ProgramCache, HEADER
+
+VERTEX_SHADER = """
+    #version 330
+    in vec2 pos;
+    void main() {
+        gl_Position = vec4(pos, 0.0, 1.0);
+    }
+"""
+
+FRAGMENT_SHADER = """
+    #version 330
+    out vec4 color;
+    void main() {
+        color = vec4(1.0);
+    }
+"""
+
+def shaders():
+    return VertexShader(VERTEX_SHADER), FragmentShader(FRAGMENT_SHADER)
+
+class Window(WIGL):
+    def setup(self):
+        self.shaders = ShaderProgram(*shaders(), cache=None)
+
+class ProgramCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.window = Window(size=(16,16))
+        except Exception as e:
+            raise unittest.SkipTest("no GL context: %s" % e)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.window.destroy()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_shadercache.")
+        self.cache = ProgramCache(self.tmpdir)
+        if not self.cache.supported:
+            self.skipTest("driver can't save program binaries")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hit(self):
+        ShaderProgram(*shaders(), cache=self.cache)
+        self.assertEqual(self.cache.stores, 1)
+        prog = ShaderProgram(*shaders(), cache=self.cache)
+        self.assertTrue(prog.cached)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_bad_format(self):
+        '''A binary in a format the driver won't take gets rebuilt.'''
+        ShaderProgram(*shaders(), cache=self.cache)
+        key = self.cache.key(shaders())
+        path = self.cache._path(key)
+        with open(path, 'rb') as f:
+            raw = bytearray(f.read())
+        fields = list(HEADER.unpack_from(bytes(raw)))
+        fields[2] = 0xFFFF # binary format
+        HEADER.pack_into(raw, 0, *fields)
+        with open(path, 'wb') as f:
+            f.write(raw)
+
+        prog = ShaderProgram(*shaders(), cache=self.cache)
+        self.assertFalse(prog.cached)
+        self.assertTrue(prog.prog_ok())
+        self.assertEqual(self.cache.rejected, 1)
+        # ...and the cache entry got rewritten with a good one
+        self.assertEqual(self.cache.stores, 2)
+        prog = ShaderProgram(*shaders(), cache=self.cache)
+        self.assertTrue(prog.cached)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,24 +23,119 @@ experiment with) modern (ish) OpenGL - i.e. OpenGL 3.3 or later.
 (It'd be OpenGL 4.x but Mesa doesn't support that... yet.)
 """
 
+import os
+
+# Headless mode (see wigl.headless) has to be picked before PyOpenGL loads.
+# HEADLESS is the backend to use ('egl' or 'osmesa'), or '' for a window.
+# (wigl.headless doesn't load PyOpenGL until it makes a context.)
+from .headless import BACKENDS as HEADLESS_BACKENDS
+HEADLESS = os.environ.get('WIGL_HEADLESS', '')
+if HEADLESS and HEADLESS not in HEADLESS_BACKENDS:
+    raise ValueError("unknown WIGL_HEADLESS %r (expected one of %s)" % \
+                      (HEADLESS, ", ".join(HEADLESS_BACKENDS)))
+if HEADLESS and 'PYOPENGL_PLATFORM' not in os.environ:
+    os.environ['PYOPENGL_PLATFORM'] = HEADLESS
+
+# So does the error checking mode:
+#   WIGL_MODE=fast:  turn off PyOpenGL's glGetError() after every call (and
+#                    its logging wrappers), and get GL errors from the driver
+#                    through KHR_debug instead; see wigl.gldebug
+#   WIGL_MODE=debug: all of PyOpenGL's checks, a debug context, messages
+#                    delivered during the call that caused them, and DEBUG
+# Otherwise you get PyOpenGL's defaults. Import wigl before OpenGL.GL (or
+# anything else that imports it), or this won't take effect.
+MODE = os.environ.get('WIGL_MODE', '')
+MODES = ('fast', 'debug')
+if MODE and MODE not in MODES:
+    raise ValueError("unknown WIGL_MODE %r (expected one of %s)" % \
+                      (MODE, ", ".join(MODES)))
+import OpenGL
+if MODE == 'fast':
+    OpenGL.ERROR_CHECKING = False
+    OpenGL.ERROR_LOGGING = False
+    OpenGL.CONTEXT_CHECKING = False
+    OpenGL.ARRAY_SIZE_CHECKING = False
+    if HEADLESS == 'egl':
+        # PyOpenGL (3.1.5, at least) forgets to define this when error
+        # checking is off, and then the EGL bindings won't load
+        from OpenGL.raw.EGL import _errors
+        if not hasattr(_errors, '_error_checker'):
+            _errors._error_checker = None
+elif MODE == 'debug':
+    # (not CONTEXT_CHECKING: it trips over the EGL calls that happen
+    # before there's a context)
+    OpenGL.ERROR_CHECKING = True
+    OpenGL.ERROR_LOGGING = True
+    # The errors get raised anyway; this just stops python 2 complaining
+    # that there are no handlers for the log messages if the application
+    # hasn't set up logging itself.
+    import logging
+    logging.getLogger('OpenGL').addHandler(logging.NullHandler())
+
 from OpenGL.GL import *
-from OpenGL.GLUT import *
-from OpenGL.arrays.vbo import VBO, VBOHandler
+if HEADLESS:
+    # GLUT won't load on the headless platforms, but we want its constants
+    from OpenGL.raw.GLUT.constants import *
+else:
+    from OpenGL.GLUT import *
+from OpenGL.arrays.vbo import VBO as _VBO, VBOHandler
+from OpenGL.error import CopyError
+from OpenGL.extensions import hasGLExtension
 
 from .math import *
+from .timing import FrameTiming, clock
+from .scheduler import Scheduler
+from .shadercache import program_cache
+from .gldebug import DebugMessages
+from . import glstate
+from .renderqueue import DrawItem, RenderQueue
+
+import numpy as np
+import ctypes
+import sys
+import time
 
 __all__ = [
     'WIGL', 'VBO',
     'DO_REDRAW', 'SKIP_REST', 'RESTART_INDEX',
     'ShaderProgram', 'VertexShader', 'FragmentShader',
+    'UniformBuffer', 'CAMERA_BLOCK', 'CAMERA_BINDING',
+    'Texture', 'Texture2D', 'PixelStream', 'Framebuffer',
+    'VAO', 'InstanceBuffer', 'INSTANCE_GLSL', 'StreamingVBO',
+    'DrawItem', 'RenderQueue',
 ]
 
 # constants for returning from keyboard callback etc.
 DO_REDRAW = 1
 SKIP_REST = 2
 
-# HA HA WHEE I LIKE THIS RESTART INDEX
-RESTART_INDEX = 0xDEADBEEF
+# Set this to True to turn on extra (slow-ish) sanity checks, e.g. raising
+# CopyError if a texture upload would have to copy its data.
+DEBUG = (MODE == 'debug')
+
+if MODE == 'fast':
+    # We hand GL numpy arrays (and get them back), so get the numpy handler
+    # loaded now and make it the output type, rather than having PyOpenGL
+    # hunt for handlers the first time it sees each type.
+    from OpenGL.arrays.arraydatatype import ArrayDatatype
+    from OpenGL.arrays.numpymodule import NumpyHandler
+    _numpy_handler = NumpyHandler()
+    ArrayDatatype.getRegistry().register(_numpy_handler,
+                                         [np.ndarray, np.memmap])
+    ArrayDatatype.getRegistry().registerReturn(_numpy_handler)
+
+# The restart index for 32-bit indexes. glstate.primitive_restart() sets
+# the right one for each index type.
+RESTART_INDEX = glstate.RESTART_INDEX
+
+# The uniform block that WIGL keeps the camera matrices in, and the binding
+# point it lives at. Declare it in your shaders like so:
+#   layout(std140) uniform Camera {
+#       mat4 projection;
+#       mat4 view;
+#   };
+CAMERA_BLOCK = 'Camera'
+CAMERA_BINDING = 0
 
 def enumstr(glenum):
     '''Given a GLenum (e.g. GL_SHADING_LANGUAGE_VERSION),
@@ -59,6 +154,8 @@ class WIGL(object):
                  size=(640,480),
                  mode=GLUT_DOUBLE|GLUT_RGB|GLUT_DEPTH,
                  clearcolor=(1,1,1,1),
+                 headless=None,
+                 fps=60,
                  ):
         self.mode = mode
 
@@ -66,41 +163,92 @@ class WIGL(object):
         self.winsize = size # requested (non-fullscreen) window size
         self.fullscreen = False
 
-        glutInit() # XXX: sys.argv?
-        glutInitContextVersion(3,3)
-        glutInitContextFlags(GLUT_FORWARD_COMPATIBLE)
-        glutInitContextProfile(GLUT_CORE_PROFILE)
-        glutInitDisplayMode(mode)
-        glutInitWindowSize(*size)
-        self.window = glutCreateWindow(name)
-        # twiddle GL stuff now that we have a window
+        # With no window, we render into self.framebuffer and the caller
+        # runs frames with step() (or mainloop(), which just calls step()).
+        # (headless=True/False just double-checks WIGL_HEADLESS, since
+        # PyOpenGL's platform was picked back when wigl was imported)
+        self.headless = bool(HEADLESS)
+        if headless is not None and bool(headless) != self.headless:
+            raise ValueError("headless=%s, but WIGL_HEADLESS is %s. Set "
+                             "WIGL_HEADLESS (e.g. to 'egl') or unset it "
+                             "before wigl is imported instead." % (headless,
+                             repr(HEADLESS) if HEADLESS else "not set"))
+        self._running = False
+        self.context = None
+        self.window = None
+        self.framebuffer = None
+
+        if self.headless:
+            from .headless import create_context
+            self.context = create_context(HEADLESS, size,
+                                          debug=(MODE == 'debug'))
+            self.glstate = glstate.reset()
+            self.framebuffer = Framebuffer(size)
+            self.framebuffer.bind()
+        else:
+            glutInit() # XXX: sys.argv?
+            glutInitContextVersion(3,3)
+            if MODE == 'debug':
+                glutInitContextFlags(GLUT_FORWARD_COMPATIBLE|GLUT_DEBUG)
+            else:
+                glutInitContextFlags(GLUT_FORWARD_COMPATIBLE)
+            glutInitContextProfile(GLUT_CORE_PROFILE)
+            glutInitDisplayMode(mode)
+            glutInitWindowSize(*size)
+            self.window = glutCreateWindow(name)
+            self.glstate = glstate.reset()
+        # twiddle GL stuff now that we have a context
         print glinfo(GL_VENDOR)
         print glinfo(GL_VERSION)
         print glinfo(GL_SHADING_LANGUAGE_VERSION)
         print glinfo(GL_RENDERER)
 
+        # GL errors etc. from the driver, if PyOpenGL isn't checking for us
+        self.debug = None
+        if MODE:
+            self.debug = DebugMessages()
+            if not self.debug.install(synchronous=(MODE == 'debug')):
+                self.debug = None
+
         glClearColor(*clearcolor)
         glEnable(GL_DEPTH_TEST)
         glDepthFunc(GL_LESS)
 
         glEnable(GL_PRIMITIVE_RESTART)
-        glPrimitiveRestartIndex(RESTART_INDEX)
+        self.glstate.primitive_restart(GL_UNSIGNED_INT)
+
+        # CPU time for callbacks, GPU time for frames; see wigl.timing
+        self.timing = FrameTiming()
+
+        # timers and redraws; see wigl.scheduler. Redraws are limited to
+        # `fps` frames per second (i.e. your monitor's refresh rate).
+        self.scheduler = Scheduler(frame_interval=1.0/fps)
+        self._wakegen = 0
+        self._wake_at = None
+
+        # shared buffer for the camera matrices; see apply_matrices()
+        self.camera = UniformBuffer(2*4*4*4, CAMERA_BINDING)
+        self._camera_data = np.empty((2,4,4), dtype=np.float32)
 
         # set default view/perspective/model matrices
         self.lookat()
         self.ortho()
         self.resetmodel()
 
-        # set up the default callbacks
-        glutDisplayFunc(self._display_cb)
-        glutReshapeFunc(self._resize_cb)
-        glutKeyboardFunc(self._keyboard_cb)
+        if not self.headless:
+            # set up the default callbacks
+            glutDisplayFunc(self._display_cb)
+            glutReshapeFunc(self._resize_cb)
+            glutKeyboardFunc(self._keyboard_cb)
 
-        # Disable the idle callback unless our subclass defined one
-        if hasattr(self, 'idle') and callable(self.idle):
-            glutIdleFunc(self.idle)
-        else:
-            glutIdleFunc(None)
+            # Disable the idle callback unless our subclass defined one
+            if hasattr(self, 'idle') and callable(self.idle):
+                glutIdleFunc(self._idle_cb)
+            else:
+                glutIdleFunc(None)
+
+        # things to draw every frame, after display(); see wigl.renderqueue
+        self.queue = RenderQueue()
 
         # create a VBO and do the user-defined interesting setup bits
         self.vao = VAO()
@@ -108,9 +256,12 @@ class WIGL(object):
             self.setup()
 
         # now we should have shaders, so we can apply perspective
+        self.attach_camera(self.shaders)
         self.apply_matrices()
 
     def fullscreen_toggle(self):
+        if self.headless:
+            return
         if not self.fullscreen:
             glutFullScreen()
             self.fullscreen = True
@@ -137,49 +288,159 @@ class WIGL(object):
 
     def translate(self, x, y, z):
         '''Translate the model by (x,y,z)'''
-        self.model = translate(x,y,z) * self.model
+        compose(translate(x,y,z), self.model, out=self.model)
 
     def rotate(self, angle, x, y, z):
         '''Rotate the model around the given vector (x,y,z)'''
-        self.model = rotate(angle, x,y,z) * self.model
+        compose(rotate(angle, x,y,z), self.model, out=self.model)
 
     def scale(self, x, y, z):
         '''Scale the model along the x, y, and z axes by the given factors'''
-        self.model = scale(x,y,z) * self.model
+        compose(scale(x,y,z), self.model, out=self.model)
+
+    def attach_camera(self, program):
+        '''Make `program` read the camera matrices from our Camera block.
+           Returns False if the program doesn't have one.'''
+        return program.bind_block(CAMERA_BLOCK, CAMERA_BINDING)
 
     def apply_matrices(self):
-        proj = self.shaders.get_uniform('projection')
-        view = self.shaders.get_uniform('view')
-        model = self.shaders.get_uniform('model')
-        with self.shaders:
-            # True -> "matrix is row-major, transpose before use"
-            glUniformMatrix4fv(proj, 1, True, self.projection)
-            glUniformMatrix4fv(view, 1, True, self.view)
-            glUniformMatrix4fv(model, 1, True, self.model)
+        # The camera block is shared by every attached program, so this is
+        # one buffer update no matter how many programs there are.
+        # GLSL wants column-major matrices, so transpose on the way in.
+        self._camera_data[0] = self.projection.T
+        self._camera_data[1] = self.view.T
+        self.camera.update(self._camera_data)
+        # Programs with plain projection/view uniforms still get them here.
+        self.shaders.set_uniforms(projection=self.projection,
+                                  view=self.view,
+                                  model=self.model)
+
+    def _wake(self):
+        '''Make sure the scheduler gets run again when it next needs to.
+           (In headless mode, mainloop() takes care of this.)'''
+        if self.headless:
+            return
+        delay = self.scheduler.next_wakeup()
+        if delay is None:
+            return
+        when = clock() + delay
+        if self._wake_at is not None and self._wake_at <= when:
+            return
+        # Any timer we armed earlier is now stale; _tick_cb ignores it.
+        self._wakegen += 1
+        self._wake_at = when
+        glutTimerFunc(int(np.ceil(delay*1000)), self._tick_cb, self._wakegen)
+
+    def _tick_cb(self, gen):
+        if gen != self._wakegen:
+            return
+        self._wake_at = None
+        self._tick()
+        self._wake()
+
+    def _tick(self):
+        '''Run any tasks that are due, and post a redraw if it's time.'''
+        self.scheduler.run_due()
+        if self.scheduler.frame_due():
+            self._post_redraw()
+
+    def _post_redraw(self):
+        self.scheduler.redraw_posted = True
+        if not self.headless:
+            glutPostRedisplay()
+
+    def every(self, secs, func, value=None, max_catchup=5):
+        '''Call func(value) every `secs` seconds, on a fixed schedule.
+           If we fall behind, it gets called up to `max_catchup` times in a
+           row to catch up. Returns a Task; call its cancel() to stop.'''
+        def timed(value):
+            self.timing.timed('timer', func, value)
+        task = self.scheduler.every(secs, timed, value, max_catchup)
+        self._wake()
+        return task
 
     def timer(self, msecs, func, value=None, repeat=False):
+        '''Call func(value) after `msecs` milliseconds (and every `msecs`
+           after that, if repeat=True; see every()).'''
         if repeat:
-            def wrapped_func(value):
-                func(value)
-                glutTimerFunc(msecs, wrapped_func, value)
-            glutTimerFunc(msecs, wrapped_func, value)
-        else:
-            glutTimerFunc(msecs, func, value)
+            return self.every(msecs/1000.0, func, value)
+        def timed(value):
+            self.timing.timed('timer', func, value)
+        task = self.scheduler.after(msecs/1000.0, timed, value)
+        self._wake()
+        return task
+
+    def report_timing(self, secs=1.0, out=sys.stdout):
+        '''Print a summary of self.timing to `out` every `secs` seconds.'''
+        def report(value):
+            out.write(self.timing.format() + "\n")
+            out.flush()
+        self.timer(int(secs*1000), report, repeat=True)
 
     def redraw(self):
-        glutPostRedisplay()
+        '''Ask for a new frame. Requests are coalesced, so you get at most one
+           frame per 1/fps seconds no matter how often this is called.'''
+        self.scheduler.request_redraw()
+        if self.scheduler.frame_due():
+            self._post_redraw()
+        else:
+            self._wake()
 
     def quit(self):
-        glutLeaveMainLoop()
+        if self.headless:
+            self._running = False
+        else:
+            glutLeaveMainLoop()
 
     def _display_cb(self):
+        start = clock()
+        self.timing.begin_frame()
         glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
         with self.shaders, self.vao:
             r = self.display()
-        if self.mode & GLUT_DOUBLE:
+            self.queue.draw()
+        self.timing.end_frame()
+        self.scheduler.frame_done(start)
+        self.timing.add('display', clock() - start)
+        if self.mode & GLUT_DOUBLE and not self.headless:
             glutSwapBuffers()
 
+    def step(self, frames=1):
+        '''Headless mode: run any timers that are due and the idle callback
+           (if there is one), then draw a frame. Repeat `frames` times.'''
+        for i in xrange(frames):
+            self.scheduler.run_due()
+            if hasattr(self, 'idle') and callable(self.idle):
+                self._idle_cb()
+            self._display_cb()
+
+    def read_pixels(self):
+        '''Return the current frame as a (height, width, 4) uint8 RGBA array,
+           top row first.'''
+        width, height = self.size
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        data = glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE)
+        pixels = np.frombuffer(data, dtype=np.uint8)
+        # GL's origin is the bottom left
+        return pixels.reshape(height, width, 4)[::-1]
+
+    def resize(self, width, height):
+        '''Change the size of the window (or, if headless, the framebuffer)'''
+        if self.headless:
+            self.framebuffer.delete()
+            self.framebuffer = Framebuffer((width, height))
+            self.framebuffer.bind()
+            self._resize_cb(width, height)
+        else:
+            glutReshapeWindow(width, height)
+
+    def _idle_cb(self):
+        self.timing.timed('idle', self.idle)
+
     def _keyboard_cb(self, key, x, y):
+        self.timing.timed('keyboard', self._keyboard, key, x, y)
+
+    def _keyboard(self, key, x, y):
         r = self.keyboard(key, x, y)
         if r == DO_REDRAW:
             self.redraw()
@@ -189,9 +450,12 @@ class WIGL(object):
             self.quit()
 
     def _resize_cb(self, width, height):
+        self.timing.timed('resize', self._resize, width, height)
+
+    def _resize(self, width, height):
         oldw, oldh = self.size
         # XXX does this DTRT for ortho?
-        self.projection[0][0] *= (float(oldw)/oldh)/(float(width)/height)
+        self.projection[0,0] *= (float(oldw)/oldh)/(float(width)/height)
         self.size = (width, height)
         self.apply_matrices()
         glViewport(0, 0, self.size[0], self.size[1])
@@ -216,7 +480,126 @@ class WIGL(object):
     # aaaand mainloop!
 
     def mainloop(self):
-        glutMainLoop()
+        if self.headless:
+            # no window, so there's no way to stop but calling quit()
+            self._running = True
+            idle = hasattr(self, 'idle') and callable(self.idle)
+            while self._running:
+                self._tick()
+                if idle:
+                    self._idle_cb()
+                if self.scheduler.redraw_posted:
+                    self._display_cb()
+                elif not idle:
+                    # nothing to do until the next task or frame is due
+                    delay = self.scheduler.next_wakeup()
+                    time.sleep(0.1 if delay is None else min(delay, 0.1))
+        else:
+            glutMainLoop()
+
+    def destroy(self):
+        '''Headless mode: clean up the framebuffer and GL context.'''
+        if self.framebuffer is not None:
+            self.framebuffer.delete()
+            self.framebuffer = None
+        if self.context is not None:
+            self.context.destroy()
+            self.context = None
+            glstate.reset()
+
+class VBO(_VBO):
+    """PyOpenGL's VBO, but it binds through wigl.glstate, so binding one
+       that's already bound (and up to date) doesn't cost a GL call.
+    """
+    def create_buffers(self):
+        buffers = super(VBO, self).create_buffers()
+        glstate.current.forget_buffer(buffers[0])
+        return buffers
+
+    def bind(self):
+        if not self.buffers:
+            self.create_buffers()
+        glstate.current.bind_buffer(self.target, self.buffers[0])
+        self.copy_data()
+
+    def unbind(self):
+        glstate.current.bind_buffer(self.target, 0)
+
+    def delete(self):
+        for buf in self.buffers:
+            glstate.current.forget_buffer(buf)
+        super(VBO, self).delete()
+
+class Framebuffer(object):
+    """A Framebuffer Object: somewhere to render other than the window.
+       By default it gets an RGBA8 color renderbuffer and a 24-bit depth
+       renderbuffer of the given size; pass a (loaded) Texture2D as `color`
+       to render into that instead.
+       Binding one sets the viewport to its size, and unbinding goes back
+       to whatever framebuffer (and viewport) was there before.
+    """
+    _current = None
+
+    def __init__(self, size, color=None, depth=True):
+        self.size = tuple(size)
+        self.color = color
+        self.renderbuffers = list()
+        self._prev = None
+        self._viewport = None
+        self.id = glGenFramebuffers(1)
+        glstate.current.forget_framebuffer(self.id)
+        glstate.current.bind_framebuffer(self.id)
+        if color is None:
+            self._renderbuffer(GL_RGBA8, GL_COLOR_ATTACHMENT0)
+        else:
+            glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+                                   color.texturetype, color.id, 0)
+        if depth:
+            self._renderbuffer(GL_DEPTH_COMPONENT24, GL_DEPTH_ATTACHMENT)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        prev = Framebuffer._current
+        glstate.current.bind_framebuffer(prev.id if prev else 0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Framebuffer incomplete: 0x%x" % status)
+
+    def _renderbuffer(self, glformat, attachment):
+        rb = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, rb)
+        glRenderbufferStorage(GL_RENDERBUFFER, glformat, *self.size)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment,
+                                  GL_RENDERBUFFER, rb)
+        self.renderbuffers.append(rb)
+
+    def bind(self):
+        self._prev = Framebuffer._current
+        if self._prev is None:
+            # the window's viewport, so unbind() can put it back
+            self._viewport = glGetIntegerv(GL_VIEWPORT)
+        glstate.current.bind_framebuffer(self.id)
+        glViewport(0, 0, self.size[0], self.size[1])
+        Framebuffer._current = self
+
+    def unbind(self, *args):
+        prev, self._prev = self._prev, None
+        glstate.current.bind_framebuffer(prev.id if prev else 0)
+        if prev is not None:
+            glViewport(0, 0, prev.size[0], prev.size[1])
+        elif self._viewport is not None:
+            glViewport(*self._viewport)
+        Framebuffer._current = prev
+
+    __enter__ = bind
+    __exit__  = unbind
+
+    def delete(self):
+        if Framebuffer._current is self:
+            self.unbind()
+        glDeleteFramebuffers(1, [self.id])
+        glstate.current.forget_framebuffer(self.id)
+        if self.renderbuffers:
+            glDeleteRenderbuffers(len(self.renderbuffers), self.renderbuffers)
+        self.renderbuffers = list()
 
 class VAO(object):
     """A Vertex Array Object.
@@ -225,6 +608,8 @@ class VAO(object):
        loop, you set them up and bind them to the *VAO*.
        Then you just bind the VAO you want to use for each draw loop and
        GL does the rest.
+       Like ShaderProgram, `with vao:` leaves it bound afterward unless
+       DEBUG is set; the next bind of the same VAO is then free.
     """
     def __init__(self):
         self._id = None
@@ -233,63 +618,435 @@ class VAO(object):
     def id(self):
         if self._id is None:
             self._id = glGenVertexArrays(1)
+            glstate.current.forget_vao(self._id)
         return self._id
 
     def bind(self):
-        glBindVertexArray(self.id)
+        glstate.current.bind_vao(self.id)
 
     def unbind(self, *args):
-        glBindVertexArray(0)
+        glstate.current.bind_vao(0)
+
+    def _exit(self, *args):
+        if DEBUG:
+            self.unbind()
+
+    def bind_attr(self, program, name, thisvbo, **kwargs):
+        '''Bind a VBO to one of program's attributes, in this VAO.
+           Takes the same keyword arguments as ShaderProgram.bind_attr().'''
+        self.bind()
+        program.bind_attr(name, thisvbo, **kwargs)
+
+    def bind_instances(self, program, instances, name='instance'):
+        '''Bind an InstanceBuffer to program's attributes, in this VAO.'''
+        self.bind()
+        instances.bind(program, name)
+
+    def delete(self):
+        if self._id is not None:
+            glDeleteVertexArrays(1, [self._id])
+            glstate.current.forget_vao(self._id)
+            self._id = None
 
     __enter__ = bind
-    __exit__  = unbind
+    __exit__  = _exit
+
+# glUniform*v functions and the array types they want, by uniform type.
+# Anything not listed here (i.e. samplers) gets uploaded with glUniform1iv.
+_uniform_funcs = {
+    GL_FLOAT:             (glUniform1fv, np.float32),
+    GL_FLOAT_VEC2:        (glUniform2fv, np.float32),
+    GL_FLOAT_VEC3:        (glUniform3fv, np.float32),
+    GL_FLOAT_VEC4:        (glUniform4fv, np.float32),
+    GL_INT:               (glUniform1iv, np.int32),
+    GL_INT_VEC2:          (glUniform2iv, np.int32),
+    GL_INT_VEC3:          (glUniform3iv, np.int32),
+    GL_INT_VEC4:          (glUniform4iv, np.int32),
+    GL_BOOL:              (glUniform1iv, np.int32),
+    GL_UNSIGNED_INT:      (glUniform1uiv, np.uint32),
+    GL_UNSIGNED_INT_VEC2: (glUniform2uiv, np.uint32),
+    GL_UNSIGNED_INT_VEC3: (glUniform3uiv, np.uint32),
+    GL_UNSIGNED_INT_VEC4: (glUniform4uiv, np.uint32),
+}
+_uniform_matrix_funcs = {
+    GL_FLOAT_MAT2: glUniformMatrix2fv,
+    GL_FLOAT_MAT3: glUniformMatrix3fv,
+    GL_FLOAT_MAT4: glUniformMatrix4fv,
+}
+# Matrix attributes take up one attribute location per column.
+_attrib_columns = {
+    GL_FLOAT_MAT2: 2,
+    GL_FLOAT_MAT3: 3,
+    GL_FLOAT_MAT4: 4,
+}
+
+class UniformBuffer(object):
+    """A Uniform Buffer Object, bound to a fixed binding point.
+       Any number of ShaderPrograms can read from it (see
+       ShaderProgram.bind_block), so updating it once updates them all.
+       Like ShaderProgram.set_uniforms, update() skips no-op uploads.
+    """
+    def __init__(self, size, binding, usage=GL_DYNAMIC_DRAW):
+        self.size = size
+        self.binding = binding
+        # copy of the buffer contents, so we can skip no-op uploads
+        self._shadow = np.zeros(size, dtype=np.uint8)
+        self.id = glGenBuffers(1)
+        glstate.current.forget_buffer(self.id)
+        glstate.current.bind_buffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferData(GL_UNIFORM_BUFFER, size, self._shadow, usage)
+        glBindBufferBase(GL_UNIFORM_BUFFER, binding, self.id)
+        self.uploads = 0
+        self.skips = 0
+
+    def update(self, data, offset=0):
+        '''Write the array `data` into the buffer at `offset` (in bytes).'''
+        data = np.ascontiguousarray(data)
+        if offset+data.nbytes > self.size:
+            raise ValueError("%d bytes at offset %d won't fit in a %d byte "
+                             "uniform buffer" % (data.nbytes, offset, self.size))
+        raw = data.view(np.uint8).ravel()
+        shadow = self._shadow[offset:offset+raw.size]
+        if np.array_equal(shadow, raw):
+            self.skips += 1
+            return
+        shadow[...] = raw
+        glstate.current.bind_buffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferSubData(GL_UNIFORM_BUFFER, offset, data.nbytes, data)
+        self.uploads += 1
+
+    def delete(self):
+        glDeleteBuffers(1, [self.id])
+        glstate.current.forget_buffer(self.id)
+
+class ShaderVar(object):
+    """An active uniform or attribute in a linked ShaderProgram."""
+    __slots__ = ('name', 'location', 'size', 'type')
+    def __init__(self, name, location, size, gltype):
+        self.name = name
+        self.location = location
+        self.size = size
+        self.type = gltype
+
+    def __repr__(self):
+        return "<ShaderVar %s location=%s size=%s type=%s>" % \
+                (self.name, self.location, self.size, self.type)
+
+def _varname(name):
+    '''Clean up a name from glGetActiveUniform/glGetActiveAttrib'''
+    if not isinstance(name, str):
+        name = name.decode('ascii')
+    # arrays are reported as "name[0]"; we want to look them up as "name"
+    if name.endswith('[0]'):
+        name = name[:-3]
+    return name
 
 class ShaderProgram(object):
-    def __init__(self, *shaders):
+    """A linked GLSL program. `with program:` makes it current; unless
+       DEBUG is set it stays current afterward, since switching back to 0
+       is just a wasted call (see wigl.glstate).
+    """
+    def __init__(self, *shaders, **kwargs):
+        # cache=None to always build from source; see wigl.shadercache
+        cache = kwargs.pop('cache', program_cache)
+        if kwargs:
+            raise TypeError("ShaderProgram() got unexpected keyword "
+                            "argument(s): %s" % ", ".join(sorted(kwargs)))
         self.id = glCreateProgram()
+        glstate.current.forget_program(self.id)
         self.vbolist = []
-        for shader in shaders:
-            shader.compile()
-            glAttachShader(self.id, shader.id)
-        glLinkProgram(self.id)
-
-        # clean up shaders
-        if self.prog_ok():
+        key = cache.key(shaders) if cache else None
+        self.cached = bool(cache and cache.load(self.id, key))
+        if not self.cached:
+            start = clock()
             for shader in shaders:
-                glDeleteShader(shader.id)
-
-    def prog_ok(self):
-        glValidateProgram(self.id)
-        if not glGetProgramiv(self.id, GL_VALIDATE_STATUS):
-            raise RuntimeError("Validation failed: %s" % \
-                                glGetProgramInfoLog(self.id))
+                shader.compile()
+                glAttachShader(self.id, shader.id)
+            if cache and cache.supported:
+                glProgramParameteri(self.id, GL_PROGRAM_BINARY_RETRIEVABLE_HINT,
+                                    GL_TRUE)
+            glLinkProgram(self.id)
+
+            # clean up shaders
+            if self.prog_ok():
+                for shader in shaders:
+                    glDetachShader(self.id, shader.id)
+                    glDeleteShader(shader.id)
+            if cache:
+                cache.store(self.id, key, clock() - start)
+
+        # find all the active uniforms/attributes now, so we never have to
+        # ask the driver for their locations again
+        self.uniforms = self._active_vars(GL_ACTIVE_UNIFORMS,
+                                          glGetActiveUniform,
+                                          glGetUniformLocation)
+        self.attributes = self._active_vars(GL_ACTIVE_ATTRIBUTES,
+                                            glGetActiveAttrib,
+                                            glGetAttribLocation)
+
+        # uniform block name -> binding point; see bind_block()
+        self.blocks = dict()
+
+        # last value uploaded for each uniform, so we can skip no-op uploads
+        self._shadow = dict()
+        self.uniform_uploads = 0
+        self.uniform_skips = 0
+
+    def _active_vars(self, count_enum, getactive, getlocation):
+        out = dict()
+        for i in xrange(glGetProgramiv(self.id, count_enum)):
+            name, size, gltype = getactive(self.id, i)
+            name = _varname(name)
+            out[name] = ShaderVar(name, getlocation(self.id, name), size, gltype)
+        return out
+
+    def prog_ok(self, validate=None):
+        '''Raise RuntimeError if the program didn't link. If `validate` (or,
+           by default, DEBUG) is set, also check that it can run with the
+           current GL state; that's slow, and only meaningful right before
+           drawing, so it's off otherwise.'''
         if not glGetProgramiv(self.id, GL_LINK_STATUS):
             raise RuntimeError("Link failed: %s" % \
                                 glGetProgramInfoLog(self.id))
+        if validate or (validate is None and DEBUG):
+            glValidateProgram(self.id)
+            if not glGetProgramiv(self.id, GL_VALIDATE_STATUS):
+                raise RuntimeError("Validation failed: %s" % \
+                                    glGetProgramInfoLog(self.id))
+        return True
 
     def bind_attr(self, name, thisvbo, size=None, gltype=None, normalized=False,
-                  stride=0, offset=None):
-        attr_id = glGetAttribLocation(self.id, name)
+                  stride=0, offset=None, divisor=0):
+        '''Feed the named attribute from thisvbo.
+           divisor=0 means one value per vertex; divisor=N means one value
+           per N instances, for instanced drawing (see InstanceBuffer).
+           Matrix attributes (mat2/mat3/mat4) get one location per column;
+           each row of thisvbo should hold one matrix, column by column.'''
+        var = self.attributes.get(name)
+        attr_id = var.location if var else -1
+        columns = _attrib_columns.get(var.type, 1) if var else 1
         if gltype is None:
             gltype = VBOHandler().arrayToGLType(thisvbo)
         if size is None:
-            size = VBOHandler().unitSize(thisvbo)
+            size = columns if columns > 1 else VBOHandler().unitSize(thisvbo)
         thisvbo.bind()
-        glEnableVertexAttribArray(attr_id)
-        glVertexAttribPointer(attr_id, size, gltype, normalized, stride, offset)
+        if columns == 1:
+            if isinstance(offset, (int, long)):
+                offset = ctypes.c_void_p(offset)
+            glEnableVertexAttribArray(attr_id)
+            glVertexAttribPointer(attr_id, size, gltype, normalized, stride,
+                                  offset)
+            glVertexAttribDivisor(attr_id, divisor)
+        else:
+            colsize = size * thisvbo.data.itemsize
+            stride = stride or columns*colsize
+            for col in xrange(columns):
+                glEnableVertexAttribArray(attr_id+col)
+                glVertexAttribPointer(attr_id+col, size, gltype, normalized,
+                            stride, ctypes.c_void_p((offset or 0)+col*colsize))
+                glVertexAttribDivisor(attr_id+col, divisor)
         self.vbolist.append(thisvbo)
 
     def get_uniform(self, name):
-        return glGetUniformLocation(self.id, name)
+        '''Return the location of the named uniform (-1 if it's not active)'''
+        var = self.uniforms.get(name)
+        return var.location if var else -1
+
+    def get_attrib(self, name):
+        '''Return the location of the named attribute (-1 if it's not active)'''
+        var = self.attributes.get(name)
+        return var.location if var else -1
+
+    def _dirty(self, name, value):
+        '''If `value` differs from what we last uploaded to the uniform `name`,
+           remember it and return the uniform's ShaderVar. Otherwise (or if
+           the uniform isn't active) return None.'''
+        var = self.uniforms.get(name)
+        if var is None or var.location < 0:
+            return None
+        # compare first, so unchanged values (the usual case) aren't copied
+        old = self._shadow.get(name)
+        if old is not None and old.shape == np.shape(value) and \
+                (old == value).all():
+            self.uniform_skips += 1
+            return None
+        self._shadow[name] = np.array(value, copy=True)
+        return var
+
+    def _upload(self, var, value):
+        if var.type in _uniform_matrix_funcs:
+            # True -> "matrix is row-major, transpose before use"
+            value = np.ascontiguousarray(value, dtype=np.float32)
+            count = value.size // (value.shape[-1]**2)
+            _uniform_matrix_funcs[var.type](var.location, count, True, value)
+        else:
+            func, dtype = _uniform_funcs.get(var.type, (glUniform1iv, np.int32))
+            value = np.ascontiguousarray(value, dtype=dtype).ravel()
+            func(var.location, var.size, value)
+        self.uniform_uploads += 1
+
+    def set_uniforms(self, **values):
+        '''Set the named uniforms to the given values.
+           Only values that changed since the last upload are actually sent
+           to the driver; see uniform_uploads and uniform_skips.'''
+        dirty = list()
+        for name, value in values.items():
+            var = self._dirty(name, value)
+            if var:
+                dirty.append((var, self._shadow[name]))
+        if not dirty:
+            return
+        state = glstate.current
+        prev = state.program
+        state.use_program(self.id)
+        for var, value in dirty:
+            self._upload(var, value)
+        # Put back whatever was in use, if anything was (a program left
+        # current after its `with` block doesn't count, unless DEBUG).
+        if prev != self.id and (prev or DEBUG):
+            state.use_program(prev or 0)
+
+    def set_uniform(self, name, value):
+        '''Set a single uniform. See set_uniforms().'''
+        self.set_uniforms(**{name:value})
+
+    def bind_block(self, name, binding):
+        '''Connect the uniform block `name` to the given binding point.
+           Returns False if the program has no active block by that name.'''
+        index = glGetUniformBlockIndex(self.id, name)
+        if index == GL_INVALID_INDEX:
+            return False
+        glUniformBlockBinding(self.id, index, binding)
+        self.blocks[name] = binding
+        return True
+
+    def invalidate_uniforms(self):
+        '''Forget the uploaded uniform values, so that the next set_uniforms()
+           uploads everything. Use this if you've called glUniform* yourself.'''
+        self._shadow.clear()
 
     def use(self):
-        glUseProgram(self.id)
+        glstate.current.use_program(self.id)
 
     def stop(self, *args):
-        glUseProgram(0)
+        glstate.current.use_program(0)
+
+    def _exit(self, *args):
+        if DEBUG:
+            self.stop()
+
+    def delete(self):
+        glDeleteProgram(self.id)
+        glstate.current.forget_program(self.id)
 
     __enter__ = use
-    __exit__  = stop
+    __exit__  = _exit
+
+# For vertex shaders using InstanceBuffer(layout='pqs'): returns the model
+# matrix for a position, (x,y,z,w) quaternion and scale, like
+#   translate(position) * rotationq(orientation) * scale(scale)
+INSTANCE_GLSL = '''
+mat4 instance_matrix(vec3 position, vec4 q, vec3 scale) {
+    float xx = q.x*q.x, yy = q.y*q.y, zz = q.z*q.z;
+    float xy = q.x*q.y, xz = q.x*q.z, yz = q.y*q.z;
+    float wx = q.w*q.x, wy = q.w*q.y, wz = q.w*q.z;
+    // (GLSL matrices are column-major)
+    return mat4(
+        scale.x * vec4(1-2*(yy+zz),   2*(xy+wz),   2*(xz-wy), 0),
+        scale.y * vec4(  2*(xy-wz), 1-2*(xx+zz),   2*(yz+wx), 0),
+        scale.z * vec4(  2*(xz+wy),   2*(yz-wx), 1-2*(xx+yy), 0),
+        vec4(position, 1));
+}
+'''
+
+class InstanceBuffer(object):
+    """Per-instance transforms for drawing lots of copies of something
+       with one glDraw*Instanced call.
+
+       layout='mat4': one 4x4 model matrix per instance, in an attribute
+           declared as `in mat4 instance;`
+       layout='pqs': position (vec3), orientation quaternion (vec4, x,y,z,w)
+           and scale (vec3) per instance, in attributes named
+           instance_position, instance_orientation and instance_scale;
+           use INSTANCE_GLSL's instance_matrix() to put them together.
+           That's 40 bytes per instance instead of 64.
+
+       Fill it from numpy arrays with set_matrices() or set_transforms(),
+       then bind() it to a program (or VAO.bind_instances()) once, and
+       upload() whenever it changes.
+    """
+    # floats per instance, and (suffix, size, offset) for each attribute
+    layouts = {
+        'mat4': (16, (('', 4, 0),)),
+        'pqs':  (10, (('_position', 3, 0), ('_orientation', 4, 3),
+                      ('_scale', 3, 7))),
+    }
+
+    def __init__(self, count, layout='mat4', usage=GL_DYNAMIC_DRAW):
+        if layout not in self.layouts:
+            raise ValueError("unknown instance layout %r (expected one of %s)"
+                             % (layout, ", ".join(sorted(self.layouts))))
+        self.layout = layout
+        self.count = count
+        width, self.attribs = self.layouts[layout]
+        self.data = np.zeros((count, width), dtype=np.float32)
+        if layout == 'mat4':
+            self.data.reshape(count, 4, 4)[:] = np.eye(4, dtype=np.float32)
+        else:
+            self.data[:,6] = 1.0    # orientation w
+            self.data[:,7:10] = 1.0 # scale
+        self.vbo = VBO(self.data, usage=usage)
+        self.uploads = 0
+
+    def set_matrices(self, matrices, start=0):
+        '''Set the model matrices (an (N,4,4) stack, like the ones wigl.math
+           makes) for instances start...start+N. (layout='mat4' only)'''
+        if self.layout != 'mat4':
+            raise ValueError("set_matrices() needs layout='mat4'")
+        matrices = np.asarray(matrices, dtype=np.float32).reshape(-1, 4, 4)
+        out = self.data[start:start+len(matrices)].reshape(-1, 4, 4)
+        # GL wants each matrix column by column
+        out[...] = matrices.transpose(0, 2, 1)
+
+    def set_transforms(self, positions=None, orientations=None, scales=None,
+                       start=0):
+        '''Set any of the positions (N,3), orientations (N,4) and scales
+           (N,3 or N) for instances start...start+N.
+           With layout='mat4' they're turned into matrices, so you have to
+           pass all three (well, you can leave out scales).'''
+        n = len(next(v for v in (positions, orientations, scales)
+                     if v is not None))
+        if self.layout == 'mat4':
+            scales = np.ones((n,3)) if scales is None else \
+                     np.broadcast_to(np.reshape(scales, (n,-1)), (n,3))
+            m = compose(translations(positions),
+                        compose(rotationsq(orientations), scalings(scales)))
+            self.set_matrices(m, start)
+            return
+        rows = self.data[start:start+n]
+        if positions is not None:
+            rows[:,0:3] = positions
+        if orientations is not None:
+            rows[:,3:7] = orientations
+        if scales is not None:
+            rows[:,7:10] = np.reshape(scales, (n, -1))
+
+    def upload(self):
+        '''Send the instance data to the GPU.'''
+        self.vbo.set_array(self.data)
+        self.vbo.bind()
+        self.uploads += 1
+
+    def bind(self, program, name='instance'):
+        '''Set up program's instance attributes to read from this buffer.'''
+        stride = self.data.shape[1] * self.data.itemsize
+        for suffix, size, offset in self.attribs:
+            program.bind_attr(name+suffix, self.vbo, size=size,
+                              gltype=GL_FLOAT, stride=stride,
+                              offset=offset*self.data.itemsize, divisor=1)
+
+    def delete(self):
+        self.vbo.delete()
 
 class Shader(object):
     def __init__(self, source, shadertype):
@@ -316,6 +1073,25 @@ class FragmentShader(Shader):
     def __init__(self, source):
         super(FragmentShader, self).__init__(source, GL_FRAGMENT_SHADER)
 
+# numpy dtypes that GL can read directly for each pixel type
+_pixel_dtypes = {
+    GL_UNSIGNED_BYTE:  np.uint8,
+    GL_BYTE:           np.int8,
+    GL_UNSIGNED_SHORT: np.uint16,
+    GL_SHORT:          np.int16,
+    GL_UNSIGNED_INT:   np.uint32,
+    GL_INT:            np.int32,
+    GL_FLOAT:          np.float32,
+}
+
+# bytes per texel for common internal formats; see Texture.gpu_bytes
+_texel_bytes = {
+    GL_R8: 1,   GL_R16: 2,   GL_R16F: 2,  GL_R32F: 4,
+    GL_RG8: 2,  GL_RG16: 4,  GL_RG16F: 4, GL_RG32F: 8,
+    GL_RGB: 3,  GL_RGB8: 3,  GL_RGB16: 6, GL_RGB16F: 6, GL_RGB32F: 12,
+    GL_RGBA: 4, GL_RGBA8: 4, GL_RGBA16: 8, GL_RGBA16F: 8, GL_RGBA32F: 16,
+}
+
 class Texture(object):
     def __init__(self, data, texturetype, glformat, pixelformat, pixeltype):
         self.id = None
@@ -325,13 +1101,25 @@ class Texture(object):
         self.glformat = glformat
         self.pixelformat = pixelformat
         self.pixeltype = pixeltype
+        self.stream = None
+        self.copies = 0
+
+    @property
+    def gpu_bytes(self):
+        '''Approximately how much GPU memory this texture takes up once loaded
+           (not counting mipmaps or driver padding).'''
+        pixels = self.data.shape[0] * self.data.shape[1]
+        texel = _texel_bytes.get(self.glformat)
+        if texel is None:
+            texel = self.data.itemsize * (self.data.size // pixels)
+        return pixels * texel
 
     def bind(self, unit=0):
         self.unit = unit
-        glActiveTexture(GL_TEXTURE0 + self.unit)
         if self.id is None:
             self.id = glGenTextures(1)
-        glBindTexture(self.texturetype, self.id)
+            glstate.current.forget_texture(self.id)
+        glstate.current.bind_texture(self.texturetype, self.id, unit)
 
     def load(self, unit=0, mode=GL_LINEAR):
         self.bind(unit)
@@ -339,15 +1127,267 @@ class Texture(object):
         glTexParameteri(self.texturetype, GL_TEXTURE_MIN_FILTER, mode)
         glTexParameteri(self.texturetype, GL_TEXTURE_MAG_FILTER, mode)
 
+    def _pixels(self, data):
+        '''Return (pixels, swap): `data` in a form GL can read directly, and
+           whether GL needs to swap its bytes (GL_UNPACK_SWAP_BYTES).
+           That's always `data` itself if it's C-contiguous and the right
+           dtype for our pixeltype, in either byte order; anything else has
+           to be converted, which gets counted in self.copies (or raises
+           CopyError if DEBUG).'''
+        want = _pixel_dtypes.get(self.pixeltype)
+        if data.flags.c_contiguous and \
+                (want is None or data.dtype.newbyteorder('=') == want):
+            return data, not data.dtype.isnative
+        if DEBUG:
+            raise CopyError("texture data (%s, %s) would be copied for upload"
+                            % (data.dtype, "contiguous" if
+                               data.flags.c_contiguous else "non-contiguous"))
+        self.copies += 1
+        return np.ascontiguousarray(data, dtype=want), False
+
+    def enable_streaming(self, nbuffers=3):
+        '''Make replace() upload through a ring of pixel buffer objects, so it
+           returns without waiting for the GPU. See PixelStream.'''
+        if self.stream is None:
+            self.stream = PixelStream(self.data.nbytes, nbuffers)
+        return self.stream
+
     def replace(self, data):
-        glBindTexture(self.texturetype, self.id)
-        self.replaceimg(data)
+        '''Replace the texture image with `data`.
+           Returns False if this is a streaming texture and the frame had to
+           be dropped because all the stream's buffers were still busy.'''
+        glstate.current.bind_texture(self.texturetype, self.id, self.unit)
+        if self.stream is None:
+            self.replaceimg(data)
+            return True
+        if not self.stream.write(data):
+            return False
+        self.replaceimg(data, from_pbo=True)
+        self.stream.fence()
+        return True
 
     def delete(self):
+        if self.stream is not None:
+            self.stream.delete()
+            self.stream = None
         glDeleteTextures(1, self.id)
+        glstate.current.forget_texture(self.id)
+
+def _mapped_array(ptr, shape, dtype):
+    '''Return a numpy array of the given shape/dtype over mapped memory'''
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    raw = np.ctypeslib.as_array(
+                ctypes.cast(ptr, ctypes.POINTER(ctypes.c_ubyte)),
+                shape=(nbytes,))
+    return raw.view(dtype).reshape(shape)
+
+class PixelStream(object):
+    """A ring of Pixel Buffer Objects for streaming texture uploads.
+       write() copies a frame into the next free buffer and leaves it bound
+       as GL_PIXEL_UNPACK_BUFFER, so the following glTex(Sub)Image call
+       reads from it asynchronously; then fence() marks the buffer busy
+       until the GPU is done copying out of it.
+       If every buffer is still busy the frame is dropped rather than
+       waiting for the GPU; `dropped` counts how often that happened.
+    """
+    def __init__(self, nbytes, nbuffers=3):
+        self.nbytes = nbytes
+        self.ids = [glGenBuffers(1) for i in xrange(nbuffers)]
+        self.fences = [None] * nbuffers
+        self.current = nbuffers-1
+        self.uploads = 0
+        self.dropped = 0
+        state = glstate.current
+        for bufid in self.ids:
+            state.forget_buffer(bufid)
+            state.bind_buffer(GL_PIXEL_UNPACK_BUFFER, bufid)
+            glBufferData(GL_PIXEL_UNPACK_BUFFER, nbytes, None, GL_STREAM_DRAW)
+        # (this one really has to be unbound, or texture uploads read from it)
+        state.bind_buffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+    def _is_free(self, i):
+        fence = self.fences[i]
+        if fence is None:
+            return True
+        if glClientWaitSync(fence, 0, 0) == GL_TIMEOUT_EXPIRED:
+            return False
+        glDeleteSync(fence)
+        self.fences[i] = None
+        return True
+
+    def write(self, data):
+        '''Copy `data` into the next buffer in the ring and bind it.
+           Returns False (and binds nothing) if it's still in use.'''
+        if data.nbytes != self.nbytes:
+            raise ValueError("frame is %d bytes, stream buffers are %d" % \
+                              (data.nbytes, self.nbytes))
+        nxt = (self.current + 1) % len(self.ids)
+        if not self._is_free(nxt):
+            self.dropped += 1
+            return False
+        self.current = nxt
+        glstate.current.bind_buffer(GL_PIXEL_UNPACK_BUFFER, self.ids[nxt])
+        # The fence says the GPU is done with this buffer, so there's no need
+        # for the driver to synchronize the mapping.
+        ptr = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, self.nbytes,
+                               GL_MAP_WRITE_BIT |
+                               GL_MAP_INVALIDATE_BUFFER_BIT |
+                               GL_MAP_UNSYNCHRONIZED_BIT)
+        _mapped_array(ptr, data.shape, data.dtype)[...] = data
+        glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        return True
+
+    def fence(self):
+        '''Mark the current buffer busy until the GPU finishes the commands
+           issued so far (i.e. the upload from it), and unbind it.'''
+        self.fences[self.current] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        glstate.current.bind_buffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.uploads += 1
+
+    def delete(self):
+        for fence in self.fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        self.fences = [None] * len(self.ids)
+        glDeleteBuffers(len(self.ids), self.ids)
+        for bufid in self.ids:
+            glstate.current.forget_buffer(bufid)
+
+class StreamingVBO(object):
+    """A vertex buffer for data that changes every frame, like a point
+       cloud computed on the CPU, that you write straight into mapped
+       memory instead of handing over an array to be copied:
+
+           points = StreamingVBO((640*480, 3), np.float32)
+           program.bind_attr('position', points)
+           ...
+           pts = points.begin()         # numpy view of mapped memory
+           depth_to_points(raw, out=pts.reshape(480, 640, 3))
+           points.end()
+           glDrawArrays(GL_POINTS, points.first, points.count)
+           points.fence()
+
+       If the driver has ARB_buffer_storage (GL 4.4), the buffer holds
+       `regions` copies of the data, persistently mapped, and each begin()
+       moves to the next region; fence() marks a region busy until the GPU
+       has drawn from it, and begin() only waits if it comes back around to
+       a region that's still busy (see `waits`). Draw from `first` (or pass
+       it as basevertex to glDrawElementsBaseVertex) to use the region you
+       just wrote. Otherwise (or with persistent=False) it falls back to
+       orphaning a single buffer each time, and `first` is always 0.
+    """
+    def __init__(self, shape, dtype=np.float32, regions=3,
+                 target=GL_ARRAY_BUFFER, persistent=None):
+        self.shape = tuple(shape)
+        self.count = self.shape[0]
+        self.dtype = np.dtype(dtype)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.target = target
+        if persistent is None:
+            persistent = hasGLExtension('GL_ARB_buffer_storage')
+        self.persistent = persistent
+        self.regions = regions if persistent else 1
+        # an empty array with our dtype and row shape, for bind_attr()
+        self.data = np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        self.region = self.regions-1
+        self.fences = [None] * self.regions
+        self.writes = 0
+        self.waits = 0
+        self.mapped = None
+        self.id = glGenBuffers(1)
+        glstate.current.forget_buffer(self.id)
+        glstate.current.bind_buffer(target, self.id)
+        if persistent:
+            flags = GL_MAP_WRITE_BIT|GL_MAP_PERSISTENT_BIT|GL_MAP_COHERENT_BIT
+            total = self.nbytes * self.regions
+            glBufferStorage(target, total, None, flags)
+            ptr = glMapBufferRange(target, 0, total, flags)
+            self.mapped = _mapped_array(ptr, (self.regions,)+self.shape,
+                                        self.dtype)
+        else:
+            glBufferData(target, self.nbytes, None, GL_STREAM_DRAW)
+
+    @property
+    def first(self):
+        '''Index of the first element of the current region'''
+        return self.region * self.count
+
+    @property
+    def offset(self):
+        '''Byte offset of the current region in the buffer'''
+        return self.region * self.nbytes
+
+    def bind(self):
+        glstate.current.bind_buffer(self.target, self.id)
+
+    def unbind(self, *args):
+        glstate.current.bind_buffer(self.target, 0)
+
+    def begin(self):
+        '''Move on to the next region and return a writable numpy view of
+           it. Call end() when you're done writing.'''
+        if not self.persistent:
+            self.bind()
+            # orphan the old storage, so we don't have to wait for the GPU
+            # to finish with it
+            glBufferData(self.target, self.nbytes, None, GL_STREAM_DRAW)
+            ptr = glMapBufferRange(self.target, 0, self.nbytes,
+                                   GL_MAP_WRITE_BIT |
+                                   GL_MAP_INVALIDATE_BUFFER_BIT)
+            return _mapped_array(ptr, self.shape, self.dtype)
+        self.region = (self.region + 1) % self.regions
+        fence = self.fences[self.region]
+        if fence is not None:
+            if glClientWaitSync(fence, 0, 0) == GL_TIMEOUT_EXPIRED:
+                self.waits += 1
+                glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT,
+                                 GL_TIMEOUT_IGNORED)
+            glDeleteSync(fence)
+            self.fences[self.region] = None
+        return self.mapped[self.region]
+
+    def end(self):
+        '''Finish writing the region returned by begin().'''
+        if not self.persistent:
+            self.bind()
+            glUnmapBuffer(self.target)
+        self.writes += 1
+
+    def write(self, data):
+        '''Copy `data` into the next region. Same as begin(); ...; end().'''
+        self.begin()[...] = data
+        self.end()
+
+    def fence(self):
+        '''Mark the current region busy until the GPU finishes the commands
+           issued so far (i.e. the draw from it).'''
+        if self.persistent:
+            self.fences[self.region] = glFenceSync(
+                                        GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+    def delete(self):
+        for fence in self.fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        self.fences = [None] * self.regions
+        if self.mapped is not None:
+            self.bind()
+            glUnmapBuffer(self.target)
+            self.mapped = None
+        glDeleteBuffers(1, [self.id])
+        glstate.current.forget_buffer(self.id)
 
 class Texture2D(Texture):
+    """A 2D texture.
+       Image data is uploaded as-is, without copying: row 0 of the array
+       becomes the first row of the texture (t=0). Images are normally
+       stored top row first, so flip t (i.e. sample at (s, 1-t)) in your
+       shader if you want them right side up.
+    """
     def loadimg(self):
+        pixels, swap = self._pixels(self.data)
+        if swap: # e.g. big-endian 16-bit data from a PNM file
+            glPixelStorei(GL_UNPACK_SWAP_BYTES, GL_TRUE)
         glTexImage2D(self.texturetype,   # target
                      0,                  # level
                      self.glformat,      # internalFormat
@@ -356,9 +1396,18 @@ class Texture2D(Texture):
                      0,                  # border. "This value must be 0."
                      self.pixelformat,   # format
                      self.pixeltype,     # type
-                     self.data[::-1,...])# image data (flipped vertically)
-
-    def replaceimg(self, data, xoff=0, yoff=0):
+                     pixels)             # image data
+        if swap:
+            glPixelStorei(GL_UNPACK_SWAP_BYTES, GL_FALSE)
+
+    def replaceimg(self, data, xoff=0, yoff=0, from_pbo=False):
+        if from_pbo:
+            # the bound PIXEL_UNPACK_BUFFER has a raw copy of data
+            pixels, swap = None, not data.dtype.isnative
+        else:
+            pixels, swap = self._pixels(data)
+        if swap:
+            glPixelStorei(GL_UNPACK_SWAP_BYTES, GL_TRUE)
         glTexSubImage2D(self.texturetype,
                         0,
                         xoff,
@@ -367,4 +1416,7 @@ class Texture2D(Texture):
                         data.shape[0],
                         self.pixelformat,
                         self.pixeltype,
-                        data[::-1,...])
+                        # None -> "offset 0 in the bound PIXEL_UNPACK_BUFFER"
+                        pixels)
+        if swap:
+            glPixelStorei(GL_UNPACK_SWAP_BYTES, GL_FALSE)
@@ -0,0 +1,202 @@
+# wigl.fakenect: a fake Kinect, for testing without hardware
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A stand-in for the parts of the `freenect` module that wigl.kinect uses.
+
+Pass it as the backend to Kinect (i.e. Kinect(backend=fakenect)) and you
+get a device that produces a synthetic depth frame (a tilted plane with a
+bump moving across it) every 1/30th of a second from process_events(),
+and a matching RGB frame (a color gradient with the bump in red) if video
+is running. Like the real thing, the arrays passed to the callbacks are
+views of internal buffers that get overwritten by the next frame.
+"""
+
+import time
+import numpy as np
+
+__all__ = [
+    'RESOLUTION_LOW', 'RESOLUTION_MEDIUM', 'RESOLUTION_HIGH',
+    'DEPTH_11BIT', 'DEPTH_10BIT', 'DEPTH_11BIT_PACKED', 'DEPTH_10BIT_PACKED',
+    'DEPTH_REGISTERED', 'DEPTH_MM',
+    'VIDEO_RGB', 'VIDEO_BAYER', 'VIDEO_IR_8BIT', 'VIDEO_IR_10BIT',
+    'VIDEO_IR_10BIT_PACKED', 'VIDEO_YUV_RGB', 'VIDEO_YUV_RAW',
+    'LED_OFF', 'LED_GREEN', 'LED_RED', 'LED_YELLOW', 'LED_BLINK_GREEN',
+    'LED_BLINK_RED_YELLOW',
+]
+
+# same values as libfreenect's enums
+RESOLUTION_LOW, RESOLUTION_MEDIUM, RESOLUTION_HIGH = range(3)
+(DEPTH_11BIT, DEPTH_10BIT, DEPTH_11BIT_PACKED, DEPTH_10BIT_PACKED,
+ DEPTH_REGISTERED, DEPTH_MM) = range(6)
+(VIDEO_RGB, VIDEO_BAYER, VIDEO_IR_8BIT, VIDEO_IR_10BIT,
+ VIDEO_IR_10BIT_PACKED, VIDEO_YUV_RGB, VIDEO_YUV_RAW) = range(7)
+(LED_OFF, LED_GREEN, LED_RED, LED_YELLOW, LED_BLINK_GREEN,
+ _LED_BLINK_GREEN, LED_BLINK_RED_YELLOW) = range(7)
+
+# (rows, cols) for each resolution
+_shapes = {
+    RESOLUTION_LOW:    (240, 320),
+    RESOLUTION_MEDIUM: (480, 640),
+    RESOLUTION_HIGH:   (1024, 1280),
+}
+
+class FakeContext(object):
+    def __init__(self):
+        self.devices = list()
+
+class FakeDevice(object):
+    def __init__(self, ctx, devno, fps=30.0):
+        self.ctx = ctx
+        self.devno = devno
+        self.interval = 1.0/fps
+        self.led = LED_OFF
+        self.depth_callback = None
+        self.depth_running = False
+        self.video_callback = None
+        self.video_running = False
+        self.frameno = 0
+        self.next_frame = None
+        self.set_depth_mode(RESOLUTION_MEDIUM, DEPTH_11BIT)
+        self.set_video_mode(RESOLUTION_MEDIUM, VIDEO_RGB)
+
+    def set_depth_mode(self, resolution, mode):
+        self.resolution = resolution
+        self.depth_mode = mode
+        rows, cols = _shapes[resolution]
+        self.depth = np.zeros((rows, cols), dtype=np.uint16)
+        # normalized grid coordinates, for generating frames
+        self._y, self._x = np.mgrid[-1:1:rows*1j, -1:1:cols*1j]
+
+    def set_video_mode(self, resolution, mode):
+        self.video_resolution = resolution
+        self.video_mode = mode
+        rows, cols = _shapes[resolution]
+        # (RGB, whatever video_mode says)
+        self.video = np.zeros((rows, cols, 3), dtype=np.uint8)
+        vy, vx = np.mgrid[-1:1:rows*1j, -1:1:cols*1j]
+        self._vx, self._vy = vx, vy
+        self._video_base = np.empty((rows, cols, 3), dtype=np.float32)
+        self._video_base[...,0] = 40
+        self._video_base[...,1] = 128 + 100*vx
+        self._video_base[...,2] = 128 + 100*vy
+        self._video_tmp = np.empty_like(self._video_base)
+
+    def _bump(self, x, y, frameno):
+        # (each device's bump starts somewhere different)
+        t = frameno * self.interval + self.devno
+        bx, by = 0.6*np.sin(t), 0.4*np.cos(0.7*t)
+        return np.exp(-((x-bx)**2 + (y-by)**2) * 8)
+
+    def make_depth_frame(self):
+        '''Fill self.depth with the next synthetic frame.'''
+        bump = self._bump(self._x, self._y, self.frameno)
+        # raw 11-bit values, whatever depth_mode says
+        raw = 700 + 100*self._y - 150*bump
+        self.depth[...] = raw
+        self.frameno += 1
+
+    def make_video_frame(self):
+        '''Fill self.video with the RGB frame that goes with the last depth
+           frame.'''
+        bump = self._bump(self._vx, self._vy, self.frameno-1)
+        tmp = self._video_tmp
+        np.multiply((bump*200)[...,None], (1, -0.5, -0.5), out=tmp)
+        tmp += self._video_base
+        np.clip(tmp, 0, 255, out=tmp)
+        self.video[...] = tmp
+
+    def process_events(self):
+        now = time.time()
+        if not (self.depth_running or self.video_running):
+            return
+        if self.next_frame is None:
+            self.next_frame = now
+        if now < self.next_frame:
+            time.sleep(self.next_frame - now)
+        self.next_frame += self.interval
+        self.make_depth_frame()
+        timestamp = int(self.frameno * self.interval * 1e6)
+        if self.depth_running and self.depth_callback is not None:
+            self.depth_callback(self, self.depth, timestamp)
+        if self.video_running:
+            self.make_video_frame()
+            if self.video_callback is not None:
+                self.video_callback(self, self.video, timestamp)
+
+# The freenect-alike API
+
+def init():
+    return FakeContext()
+
+def shutdown(ctx):
+    del ctx.devices[:]
+
+def open_device(ctx, devno):
+    dev = FakeDevice(ctx, devno)
+    ctx.devices.append(dev)
+    return dev
+
+def close_device(dev):
+    if dev in dev.ctx.devices:
+        dev.ctx.devices.remove(dev)
+
+def set_depth_mode(dev, resolution, mode):
+    dev.set_depth_mode(resolution, mode)
+
+def set_video_mode(dev, resolution, mode):
+    dev.set_video_mode(resolution, mode)
+
+def set_depth_callback(dev, callback):
+    dev.depth_callback = callback
+    return 0
+
+def start_depth(dev):
+    dev.depth_running = True
+    dev.next_frame = None
+    return 0
+
+def stop_depth(dev):
+    dev.depth_running = False
+    return 0
+
+def set_video_callback(dev, callback):
+    dev.video_callback = callback
+    return 0
+
+def start_video(dev):
+    dev.video_running = True
+    if not dev.depth_running:
+        dev.next_frame = None
+    return 0
+
+def stop_video(dev):
+    dev.video_running = False
+    return 0
+
+def set_led(dev, led):
+    dev.led = led
+    return 0
+
+def process_events(ctx):
+    '''Deliver the next frame from each running device, waiting until it's
+       due (like the real process_events blocking on USB).'''
+    if not any(dev.depth_running or dev.video_running
+               for dev in ctx.devices):
+        time.sleep(0.01)
+    for dev in ctx.devices:
+        dev.process_events()
+    return 0
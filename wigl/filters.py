@@ -0,0 +1,262 @@
+# wigl.filters: clean up depth frames on the GPU
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Render-to-texture filter passes, for cleaning up raw Kinect depth frames
+without the CPU ever touching the pixels.
+
+A FilterPass is a fragment shader that runs once per texel of its input
+texture and writes to a float texture of the same size. A FilterChain
+runs a list of them, each one reading the previous one's output, and
+ping-pongs between two textures so it doesn't need one per pass:
+
+    chain = depth_filter((640, 480))    # HoleFill, Bilateral, Temporal
+    ...
+    texture.replace(raw)                # upload the raw frame as usual
+    filtered = chain.run(texture)       # then sample this one instead
+
+Passes read and write raw depth values, stored the same way a GL_R16
+texture holds them - i.e. texel.r*65535.0 is the raw value, and a raw
+value of 0 or >= 2047 means "no reading" - so a shader that samples the
+raw depth texture can sample the filtered one instead, unchanged.
+
+Temporal passes also read their own output from the previous frame.
+Each one keeps its own pair of textures for that, so the chain's output
+is a different texture every frame; use the one run() returns (or
+chain.output).
+"""
+
+import numpy as np
+from OpenGL.GL import *
+
+from . import ShaderProgram, VertexShader, FragmentShader
+from . import Texture2D, Framebuffer, VAO
+
+__all__ = [
+    'FilterPass', 'FilterChain', 'FILTER_GLSL',
+    'HoleFill', 'Bilateral', 'TemporalAverage', 'depth_filter',
+]
+
+# One triangle that covers the whole viewport, made from gl_VertexID
+# alone, so there's no vertex buffer to set up.
+FULLSCREEN_VERTEX_SHADER = """
+#version 330
+void main() {
+    gl_Position = vec4((gl_VertexID & 1) * 4 - 1,
+                       (gl_VertexID & 2) * 2 - 1, 0, 1);
+}
+"""
+
+# Everything a filter pass's fragment shader gets, before its own source:
+#   raw_at(p):   raw depth at texel p of `source` (clamped to the edges)
+#   is_hole(v):  true if v isn't a real reading
+#   put(v):      write raw depth v to the output
+FILTER_GLSL = """
+#version 330
+uniform sampler2D source;
+out vec4 result;
+const float RAW_SCALE = 65535.0;
+const float RAW_HOLE = 2047.0;
+float raw_at(ivec2 p) {
+    p = clamp(p, ivec2(0), textureSize(source, 0) - 1);
+    return texelFetch(source, p, 0).r * RAW_SCALE;
+}
+bool is_hole(float raw) {
+    return raw < 1.0 || raw >= RAW_HOLE;
+}
+void put(float raw) {
+    result = vec4(raw / RAW_SCALE);
+}
+"""
+
+class FilterPass(object):
+    """A fragment shader (`source`, appended to FILTER_GLSL) that gets run
+       over every texel, with the given uniforms. With temporal=True it
+       also gets `previous`, a sampler holding its own last output.
+    """
+    temporal = False
+
+    def __init__(self, source, **uniforms):
+        self.program = ShaderProgram(
+                VertexShader(FULLSCREEN_VERTEX_SHADER),
+                FragmentShader(FILTER_GLSL + source))
+        self.program.set_uniforms(source=0)
+        if self.temporal:
+            self.program.set_uniforms(previous=1)
+        self.uniforms = uniforms
+
+    def run(self, source, target, previous=None):
+        '''Read the Texture2D `source` and write into the Framebuffer
+           `target`. (A VAO has to be bound; FilterChain takes care of it.)'''
+        source.bind(0)
+        if previous is not None:
+            previous.bind(1)
+        self.program.use()
+        if self.uniforms:
+            self.program.set_uniforms(**self.uniforms)
+        with target:
+            glDrawArrays(GL_TRIANGLES, 0, 3)
+
+class HoleFill(FilterPass):
+    """Fill holes from the farthest valid reading within `radius` texels.
+       (Most holes are the shadows of nearer things, cast on whatever's
+       behind them, so the background is usually the right guess.)
+    """
+    def __init__(self, radius=2):
+        super(HoleFill, self).__init__("""
+            uniform int radius;
+            void main() {
+                ivec2 p = ivec2(gl_FragCoord.xy);
+                float raw = raw_at(p);
+                if (is_hole(raw)) {
+                    float best = 0.0;
+                    for (int dy = -radius; dy <= radius; dy++)
+                        for (int dx = -radius; dx <= radius; dx++) {
+                            float v = raw_at(p + ivec2(dx, dy));
+                            if (!is_hole(v))
+                                best = max(best, v);
+                        }
+                    if (best > 0.0)
+                        raw = best;
+                }
+                put(raw);
+            }
+        """, radius=radius)
+
+class Bilateral(FilterPass):
+    """Smooth out noise without smearing edges: each texel becomes a
+       weighted average of its neighbors, weighted by distance (in texels,
+       `sigma_space`) and by how close their depth is (in raw units,
+       `sigma_range`). Holes stay holes and don't count as neighbors.
+    """
+    def __init__(self, radius=2, sigma_space=1.5, sigma_range=8.0):
+        super(Bilateral, self).__init__("""
+            uniform int radius;
+            uniform float sigma_space;
+            uniform float sigma_range;
+            void main() {
+                ivec2 p = ivec2(gl_FragCoord.xy);
+                float raw = raw_at(p);
+                if (is_hole(raw)) {
+                    put(raw);
+                    return;
+                }
+                float ks = 0.5 / (sigma_space*sigma_space);
+                float kr = 0.5 / (sigma_range*sigma_range);
+                float sum = 0.0, total = 0.0;
+                for (int dy = -radius; dy <= radius; dy++)
+                    for (int dx = -radius; dx <= radius; dx++) {
+                        float v = raw_at(p + ivec2(dx, dy));
+                        if (is_hole(v))
+                            continue;
+                        float w = exp(-float(dx*dx + dy*dy)*ks
+                                      - (v-raw)*(v-raw)*kr);
+                        sum += v*w;
+                        total += w;
+                    }
+                put(sum / total);
+            }
+        """, radius=radius, sigma_space=sigma_space, sigma_range=sigma_range)
+
+class TemporalAverage(FilterPass):
+    """Exponential moving average over frames: each frame moves `alpha` of
+       the way from the previous output to the new reading. Anything that
+       changes by more than `threshold` (raw units) is taken as movement,
+       not noise, and jumps straight to the new value. Holes keep the last
+       value seen there.
+    """
+    temporal = True
+
+    def __init__(self, alpha=0.3, threshold=16.0):
+        super(TemporalAverage, self).__init__("""
+            uniform sampler2D previous;
+            uniform float alpha;
+            uniform float threshold;
+            void main() {
+                ivec2 p = ivec2(gl_FragCoord.xy);
+                float raw = raw_at(p);
+                float prev = texelFetch(previous, p, 0).r * RAW_SCALE;
+                if (is_hole(raw))
+                    raw = prev;
+                else if (!is_hole(prev) && abs(raw - prev) < threshold)
+                    raw = mix(prev, raw, alpha);
+                put(raw);
+            }
+        """, alpha=alpha, threshold=threshold)
+
+class FilterChain(object):
+    """Runs a list of FilterPasses in order; see the module docs.
+       `size` is the (width, height) of the frames it'll be given.
+    """
+    def __init__(self, size, passes):
+        self.size = tuple(size)
+        self.passes = list(passes)
+        self.vao = VAO()
+        self.output = None
+        # ping-pong targets for the ordinary passes (only as many as needed)
+        plain = sum(1 for p in self.passes if not p.temporal)
+        self.targets = [self._target() for i in xrange(min(plain, 2))]
+        # and a pair per temporal pass: (last frame's output, this frame's)
+        self.history = dict((id(p), [self._target(), self._target()])
+                            for p in self.passes if p.temporal)
+
+    def _target(self):
+        width, height = self.size
+        tex = Texture2D(np.zeros((height, width), dtype=np.float32),
+                        GL_TEXTURE_2D, GL_R32F, GL_RED, GL_FLOAT)
+        tex.load()
+        return tex, Framebuffer(self.size, color=tex, depth=False)
+
+    def run(self, source):
+        '''Filter the Texture2D `source`, and return the result (a Texture2D,
+           bound to unit 0 by the time this returns).'''
+        self.vao.bind()
+        for p in self.passes:
+            if p.temporal:
+                history = self.history[id(p)]
+                history.reverse()
+                (prev, _), (tex, fb) = history
+                p.run(source, fb, prev)
+            else:
+                tex, fb = next(t for t in self.targets if t[0] is not source)
+                p.run(source, fb)
+            source = tex
+        self.output = source
+        source.bind(0)
+        return source
+
+    def delete(self):
+        targets = list(self.targets)
+        for pair in self.history.values():
+            targets.extend(pair)
+        for tex, fb in targets:
+            fb.delete()
+            tex.delete()
+        self.vao.delete()
+        for p in self.passes:
+            p.program.delete()
+
+def depth_filter(size, holes=True, smooth=True, temporal=True):
+    '''A FilterChain with the stock depth passes: HoleFill, then Bilateral,
+       then TemporalAverage (leave any of them out with the flags).'''
+    passes = list()
+    if holes:
+        passes.append(HoleFill())
+    if smooth:
+        passes.append(Bilateral())
+    if temporal:
+        passes.append(TemporalAverage())
+    return FilterChain(size, passes)
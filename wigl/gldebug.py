@@ -0,0 +1,155 @@
+# wigl.gldebug: collect GL errors and warnings via KHR_debug
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+GL errors (and performance warnings, etc.) reported by the driver through
+a GL_KHR_debug message callback, instead of PyOpenGL calling glGetError()
+after every single GL call.
+
+The same message tends to show up once per frame, so messages are counted
+by (source, type, id, severity, text) and each one is only printed once
+every `interval` seconds, with a count of how many times it happened
+since. (The text has to be part of that: Mesa, for one, uses the same id
+for lots of different errors.)
+
+WIGL sets one of these up (as self.debug) when WIGL_MODE is 'fast' or
+'debug'; see wigl.MODE.
+"""
+
+import sys
+
+from OpenGL.GL import *
+from OpenGL.extensions import hasGLExtension
+from OpenGL.raw.GL.KHR.debug import glDebugMessageCallback
+from OpenGL.raw.GL._types import GLDEBUGPROC
+from .timing import clock
+
+__all__ = [
+    'DebugMessages',
+]
+
+_sources = {
+    GL_DEBUG_SOURCE_API: 'api',
+    GL_DEBUG_SOURCE_WINDOW_SYSTEM: 'window system',
+    GL_DEBUG_SOURCE_SHADER_COMPILER: 'shader compiler',
+    GL_DEBUG_SOURCE_THIRD_PARTY: 'third party',
+    GL_DEBUG_SOURCE_APPLICATION: 'application',
+    GL_DEBUG_SOURCE_OTHER: 'other',
+}
+_types = {
+    GL_DEBUG_TYPE_ERROR: 'error',
+    GL_DEBUG_TYPE_DEPRECATED_BEHAVIOR: 'deprecated',
+    GL_DEBUG_TYPE_UNDEFINED_BEHAVIOR: 'undefined behavior',
+    GL_DEBUG_TYPE_PORTABILITY: 'portability',
+    GL_DEBUG_TYPE_PERFORMANCE: 'performance',
+    GL_DEBUG_TYPE_MARKER: 'marker',
+    GL_DEBUG_TYPE_PUSH_GROUP: 'push group',
+    GL_DEBUG_TYPE_POP_GROUP: 'pop group',
+    GL_DEBUG_TYPE_OTHER: 'other',
+}
+_severities = {
+    GL_DEBUG_SEVERITY_HIGH: 'high',
+    GL_DEBUG_SEVERITY_MEDIUM: 'medium',
+    GL_DEBUG_SEVERITY_LOW: 'low',
+    GL_DEBUG_SEVERITY_NOTIFICATION: 'notification',
+}
+
+class DebugMessages(object):
+    """Receives, counts, and (occasionally) prints KHR_debug messages.
+       `counts` maps (source, type, id, severity, message) to [total,
+       unprinted, last time printed]; `errors` counts GL_DEBUG_TYPE_ERROR
+       messages.
+    """
+    def __init__(self, interval=5.0, out=sys.stderr, notifications=False):
+        self.interval = interval
+        self.out = out
+        self.notifications = notifications
+        self.counts = dict()
+        self.total = 0
+        self.errors = 0
+        self.installed = False
+        # keep a reference, or ctypes will free it out from under GL
+        self._callback = GLDEBUGPROC(self._receive)
+
+    def install(self, synchronous=False):
+        '''Start receiving messages from the current context. With
+           synchronous=True, messages arrive during the GL call that caused
+           them (slower, but good for debugging). Returns False if the
+           driver doesn't support KHR_debug.'''
+        if not (hasGLExtension('GL_KHR_debug') or
+                hasGLExtension('GL_ARB_debug_output')):
+            return False
+        glEnable(GL_DEBUG_OUTPUT)
+        if synchronous:
+            glEnable(GL_DEBUG_OUTPUT_SYNCHRONOUS)
+        glDebugMessageCallback(self._callback, None)
+        if not self.notifications:
+            glDebugMessageControl(GL_DONT_CARE, GL_DONT_CARE,
+                                  GL_DEBUG_SEVERITY_NOTIFICATION, 0, None,
+                                  GL_FALSE)
+        self.installed = True
+        return True
+
+    def uninstall(self):
+        if self.installed:
+            glDebugMessageCallback(GLDEBUGPROC(), None)
+            glDisable(GL_DEBUG_OUTPUT)
+            self.installed = False
+
+    def _receive(self, source, msgtype, msgid, severity, length, message,
+                 userdata):
+        # This gets called from inside GL, so it must not raise.
+        try:
+            self.add(source, msgtype, msgid, severity,
+                     message[:length].decode('utf-8', 'replace'))
+        except Exception:
+            pass
+
+    def add(self, source, msgtype, msgid, severity, message):
+        self.total += 1
+        if msgtype == GL_DEBUG_TYPE_ERROR:
+            self.errors += 1
+        key = (source, msgtype, msgid, severity, message)
+        entry = self.counts.get(key)
+        if entry is None:
+            entry = self.counts[key] = [0, 0, None]
+        entry[0] += 1
+        entry[1] += 1
+        now = clock()
+        if entry[2] is None or now - entry[2] >= self.interval:
+            self._print(key, entry, now)
+
+    def _print(self, key, entry, now):
+        source, msgtype, msgid, severity, message = key
+        repeats = ""
+        if entry[1] > 1:
+            repeats = " (x%d)" % entry[1]
+        self.out.write("GL %s %s [%s, %s]: %s%s\n" % (
+            _severities.get(severity, severity), _types.get(msgtype, msgtype),
+            _sources.get(source, source), msgid, message.rstrip(), repeats))
+        entry[1] = 0
+        entry[2] = now
+
+    def flush(self):
+        '''Print any messages that were held back by the rate limit.'''
+        now = clock()
+        for key, entry in self.counts.items():
+            if entry[1]:
+                self._print(key, entry, now)
+
+    def summary(self):
+        '''Return {(source, type, id, severity, message): count, ...}'''
+        return dict((key, entry[0]) for key, entry in self.counts.items())
@@ -0,0 +1,161 @@
+# wigl.glstate: skip GL binds that wouldn't change anything
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A cache of what's bound in the current GL context.
+
+Every frame binds the same program, VAO, textures and buffers it bound
+last frame, and each of those is a trip through PyOpenGL and the driver.
+VAO, ShaderProgram, Texture, VBO, Framebuffer etc. all bind through
+`current` instead, which remembers what's bound and skips the call if
+it's already there. `calls` counts the binds that actually went to GL,
+`elided` counts the ones that didn't.
+
+None means "don't know", and the next bind always goes through. If you
+bind things with raw GL calls, call invalidate() afterward.
+
+It also owns the primitive restart index, which has to match the type of
+the indexes being drawn: call primitive_restart(gltype) before drawing
+strips (GridLOD and RenderQueue do this for you).
+
+There's one GLState per context: WIGL calls reset() when it creates one.
+"""
+
+from OpenGL.GL import *
+
+__all__ = [
+    'GLState', 'current', 'reset', 'RESTART_INDEX', 'RESTART_INDEXES',
+]
+
+# HA HA WHEE I LIKE THIS RESTART INDEX
+RESTART_INDEX = 0xDEADBEEF
+
+# The restart index for each index type: 8- and 16-bit indexes use the
+# biggest value they can hold (so it's never a real vertex), 32-bit ones
+# use RESTART_INDEX.
+RESTART_INDEXES = {
+    GL_UNSIGNED_BYTE:  0xFF,
+    GL_UNSIGNED_SHORT: 0xFFFF,
+    GL_UNSIGNED_INT:   RESTART_INDEX,
+}
+
+class GLState(object):
+    """What's bound where, as far as we know. See the module docs."""
+    def __init__(self):
+        self.calls = 0
+        self.elided = 0
+        self.invalidate()
+
+    def invalidate(self):
+        '''Forget everything, e.g. after binding things behind our back.'''
+        self.program = None
+        self.vao = None
+        self.framebuffer = None
+        self.unit = None
+        self.restart = None
+        self.textures = dict() # (unit, target) -> texture
+        self.buffers = dict()  # target -> buffer
+
+    def _skip(self, known, value):
+        if known is not None and known == value:
+            self.elided += 1
+            return True
+        self.calls += 1
+        return False
+
+    def use_program(self, program):
+        if not self._skip(self.program, program):
+            glUseProgram(program)
+            self.program = program
+
+    def bind_vao(self, vao):
+        if not self._skip(self.vao, vao):
+            glBindVertexArray(vao)
+            self.vao = vao
+            # the element array binding belongs to the VAO
+            self.buffers.pop(GL_ELEMENT_ARRAY_BUFFER, None)
+
+    def bind_framebuffer(self, framebuffer):
+        if not self._skip(self.framebuffer, framebuffer):
+            glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+            self.framebuffer = framebuffer
+
+    def active_texture(self, unit):
+        if not self._skip(self.unit, unit):
+            glActiveTexture(GL_TEXTURE0 + unit)
+            self.unit = unit
+
+    def bind_texture(self, target, texture, unit=None):
+        '''Bind `texture` to `target` on `unit` (default: the active one)'''
+        if unit is not None:
+            self.active_texture(unit)
+        key = (self.unit, target)
+        if not self._skip(self.textures.get(key), texture):
+            glBindTexture(target, texture)
+            if self.unit is not None:
+                self.textures[key] = texture
+
+    def primitive_restart(self, gltype):
+        '''Set the primitive restart index to the one for indexes of type
+           `gltype` (GL_UNSIGNED_SHORT etc.; see RESTART_INDEXES)'''
+        index = RESTART_INDEXES[gltype]
+        if not self._skip(self.restart, index):
+            glPrimitiveRestartIndex(index)
+            self.restart = index
+
+    def bind_buffer(self, target, buf):
+        if not self._skip(self.buffers.get(target), buf):
+            glBindBuffer(target, buf)
+            self.buffers[target] = buf
+
+    # GL unbinds objects when they're deleted, and hands their names out
+    # again later, so call these when something is created or deleted.
+
+    def forget_program(self, program):
+        if self.program == program:
+            self.program = None
+
+    def forget_vao(self, vao):
+        if self.vao == vao:
+            self.vao = None
+            self.buffers.pop(GL_ELEMENT_ARRAY_BUFFER, None)
+
+    def forget_framebuffer(self, framebuffer):
+        if self.framebuffer == framebuffer:
+            self.framebuffer = None
+
+    def forget_texture(self, texture):
+        for key, bound in self.textures.items():
+            if bound == texture:
+                del self.textures[key]
+
+    def forget_buffer(self, buf):
+        for target, bound in self.buffers.items():
+            if bound == buf:
+                del self.buffers[target]
+
+    @property
+    def stats(self):
+        return dict(calls=self.calls, elided=self.elided)
+
+# the state of the current context
+current = GLState()
+
+def reset():
+    '''Start over with a new GLState for a new context, and return it.'''
+    global current
+    current = GLState()
+    return current
@@ -0,0 +1,152 @@
+# wigl.headless: GL contexts without a window
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Create an OpenGL 3.3 core context with no window (or display!) attached,
+for batch jobs, servers, CI machines, etc. WIGL renders into a Framebuffer
+when it's using one of these.
+
+Two backends:
+  'egl':    EGL with the surfaceless platform (EGL_MESA_platform_surfaceless),
+            falling back to the default display
+  'osmesa': Mesa's off-screen renderer
+Either one works with Mesa's llvmpipe software renderer, so you don't need
+a GPU either; set LIBGL_ALWAYS_SOFTWARE=1 to force it.
+
+PyOpenGL needs to know which one you're using before OpenGL.GL gets
+imported, so set WIGL_HEADLESS=egl (or osmesa) in the environment before
+importing wigl. (It sets PYOPENGL_PLATFORM for you.)
+"""
+
+import ctypes
+
+__all__ = [
+    'HeadlessError', 'HeadlessContext', 'create_context', 'BACKENDS',
+]
+
+BACKENDS = ('egl', 'osmesa')
+
+# EGL_MESA_platform_surfaceless, which PyOpenGL doesn't know about
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+# EGL 1.5
+EGL_CONTEXT_OPENGL_DEBUG = 0x31B0
+
+class HeadlessError(RuntimeError):
+    pass
+
+class HeadlessContext(object):
+    """A current GL context with no window. Call destroy() when done."""
+    def __init__(self, backend, destroy):
+        self.backend = backend
+        self._destroy = destroy
+
+    def destroy(self):
+        if self._destroy is not None:
+            self._destroy()
+            self._destroy = None
+
+def _egl_context(size, debug=False):
+    from OpenGL import EGL
+    from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+
+    display = EGL.EGL_NO_DISPLAY
+    if eglGetPlatformDisplayEXT:
+        display = eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS_MESA,
+                                           None, None)
+    if not display:
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not display or not EGL.eglInitialize(display, ctypes.pointer(major),
+                                                     ctypes.pointer(minor)):
+        raise HeadlessError("Can't initialize EGL display")
+
+    config, count = EGL.EGLConfig(), EGL.EGLint()
+    attribs = (EGL.EGLint*3)(EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                             EGL.EGL_NONE)
+    EGL.eglChooseConfig(display, attribs, ctypes.pointer(config), 1,
+                        ctypes.pointer(count))
+    if not count.value:
+        # surfaceless displays may not have any configs, but we don't need
+        # one anyway (EGL_KHR_no_config_context)
+        config = EGL.EGLConfig()
+
+    if not EGL.eglBindAPI(EGL.EGL_OPENGL_API):
+        raise HeadlessError("EGL can't do desktop OpenGL")
+    attribs = [
+        EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+        EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+        EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+    ]
+    if debug:
+        attribs += [EGL_CONTEXT_OPENGL_DEBUG, EGL.EGL_TRUE]
+    attribs = (EGL.EGLint*(len(attribs)+1))(*(attribs + [EGL.EGL_NONE]))
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, attribs)
+    if not context:
+        raise HeadlessError("Can't create EGL context")
+    if not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE,
+                              context):
+        raise HeadlessError("Can't make EGL context current")
+
+    def destroy():
+        EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE,
+                           EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(display, context)
+        EGL.eglTerminate(display)
+    return HeadlessContext('egl', destroy)
+
+def _osmesa_context(size, debug=False):
+    from OpenGL import osmesa
+    from OpenGL.GL import GL_UNSIGNED_BYTE
+    from OpenGL.arrays import GLubyteArray
+
+    attribs = (ctypes.c_int*11)(
+        osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+        osmesa.OSMESA_DEPTH_BITS, 24,
+        osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+        osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+        osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+        0,
+    )
+    context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+    if not context:
+        raise HeadlessError("Can't create OSMesa context")
+    # OSMesa insists on having a buffer to render into, even though we're
+    # going to be rendering into a framebuffer object instead.
+    width, height = size
+    buf = GLubyteArray.zeros((height, width, 4))
+    if not osmesa.OSMesaMakeCurrent(context, buf, GL_UNSIGNED_BYTE,
+                                    width, height):
+        raise HeadlessError("Can't make OSMesa context current")
+
+    def destroy():
+        osmesa.OSMesaDestroyContext(context)
+    ctx = HeadlessContext('osmesa', destroy)
+    ctx.buffer = buf
+    return ctx
+
+_backends = {
+    'egl': _egl_context,
+    'osmesa': _osmesa_context,
+}
+
+def create_context(backend='egl', size=(640,480), debug=False):
+    '''Create a headless GL context and make it current.
+       debug=True asks for a debug context, if the backend can do that.'''
+    if backend not in _backends:
+        raise HeadlessError("unknown headless backend %r (expected one of %s)"
+                            % (backend, ", ".join(BACKENDS)))
+    return _backends[backend](size, debug)
@@ -15,33 +15,228 @@
 # You should have received a copy of the GNU General Public License
 # along with wigl.  If not, see <http://www.gnu.org/licenses/>.
 
-import freenect
-from freenect import *
+import threading
+
+import numpy as np
+
+try:
+    import freenect
+    from freenect import *
+except ImportError:
+    # no libfreenect; you can still use a fake device (see wigl.fakenect)
+    freenect = None
+    from .fakenect import *
 
 class KinectError(IOError):
     pass
 
+# (rows, cols) of the frames at each resolution
+FRAME_SHAPES = {
+    RESOLUTION_LOW:    (240, 320),
+    RESOLUTION_MEDIUM: (480, 640),
+    RESOLUTION_HIGH:   (1024, 1280),
+}
+
+# Converting raw 11-bit depth values to (approximate) meters:
+#   clamp(DEPTH_A*tan(clamp(raw, DEPTH_RAW_MIN, DEPTH_RAW_MAX)*DEPTH_K + DEPTH_B)
+#         + DEPTH_C, DEPTH_MIN, DEPTH_MAX)
+# DEPTH_C is really -0.037, but we shift things back a bit to center the
+# interesting part of the scene.
+DEPTH_A = 0.1236
+DEPTH_K = 1/2842.5
+DEPTH_B = 1.1863
+DEPTH_C = -0.5
+DEPTH_RAW_MIN = 500
+DEPTH_RAW_MAX = 1000
+DEPTH_MIN = 0.0
+DEPTH_MAX = 2.0
+
+def _depth_lut():
+    raw = np.clip(np.arange(2048, dtype=np.float64), DEPTH_RAW_MIN, DEPTH_RAW_MAX)
+    meters = DEPTH_A*np.tan(raw*DEPTH_K + DEPTH_B) + DEPTH_C
+    return np.clip(meters, DEPTH_MIN, DEPTH_MAX).astype(np.float32)
+
+# DEPTH_LUT[raw] is the distance in meters for the raw depth value `raw`
+DEPTH_LUT = _depth_lut()
+DEPTH_LUT.setflags(write=False)
+
+# The same conversion, for use in shaders. Paste this into your shader
+# source (after the #version line) and call raw_to_meters(raw), where raw is
+# the raw value (so for a GL_R16 texture, that's texel.r*65535.0).
+DEPTH_GLSL = """
+float raw_to_meters(float raw) {
+    raw = clamp(raw, %r, %r);
+    return clamp(%r*tan(raw*%r + %r) + %r, %r, %r);
+}
+""" % (float(DEPTH_RAW_MIN), float(DEPTH_RAW_MAX),
+       DEPTH_A, DEPTH_K, DEPTH_B, DEPTH_C, DEPTH_MIN, DEPTH_MAX)
+
+# Approximate depth camera intrinsics (fx, fy, cx, cy) at 640x480
+DEPTH_INTRINSICS = (594.21, 591.04, 339.5, 242.7)
+
+def raw_to_meters(raw, out=None):
+    '''Convert an array of raw depth values to meters, using DEPTH_LUT.
+       If `out` (a float32 array the same shape as `raw`) is given, the
+       result is written into it.'''
+    return np.take(DEPTH_LUT, raw, out=out, mode='clip')
+
+# (shape, intrinsics) -> (xray, yray); see _rays()
+_ray_cache = dict()
+
+def _rays(shape, intrinsics):
+    '''Return (x,y) multipliers that turn depth into x and y coordinates for
+       every pixel of a depth frame with the given shape.'''
+    key = (shape, intrinsics)
+    rays = _ray_cache.get(key)
+    if rays is None:
+        rows, cols = shape
+        fx, fy, cx, cy = intrinsics
+        # intrinsics are for 640x480, so scale them to this resolution
+        sx, sy = cols/640.0, rows/480.0
+        u = np.arange(cols, dtype=np.float64)
+        v = np.arange(rows, dtype=np.float64)
+        xray = ((u - cx*sx) / (fx*sx)).astype(np.float32)
+        # image rows go down, y goes up
+        yray = (-(v - cy*sy) / (fy*sy)).astype(np.float32)
+        rays = _ray_cache[key] = (xray[None,:], yray[:,None])
+    return rays
+
+def depth_to_points(raw, out=None, intrinsics=DEPTH_INTRINSICS):
+    '''Project a (H,W) raw depth frame to an (H,W,3) float32 array of
+       (x,y,z) points, in meters (x right, y up, z forward).
+       If `out` is given, the points are written into it.'''
+    rows, cols = raw.shape
+    if out is None:
+        out = np.empty((rows, cols, 3), dtype=np.float32)
+    elif out.shape != (rows, cols, 3) or out.dtype != np.float32:
+        raise ValueError("output buffer must be float32 with shape %s" % \
+                          ((rows, cols, 3),))
+    xray, yray = _rays(raw.shape, tuple(intrinsics))
+    z = out[...,2]
+    np.take(DEPTH_LUT, raw, out=z, mode='clip')
+    np.multiply(xray, z, out=out[...,0])
+    np.multiply(yray, z, out=out[...,1])
+    return out
+
+# Approximate RGB camera intrinsics (fx, fy, cx, cy) at 640x480, and where
+# the RGB camera is relative to the depth camera (along x, in meters)
+VIDEO_INTRINSICS = (529.22, 525.56, 328.94, 267.48)
+VIDEO_BASELINE = 0.025
+
+# raw_to_meters() + DEPTH_SHIFT is the actual distance from the camera
+# (see DEPTH_C, above)
+DEPTH_SHIFT = -0.037 - DEPTH_C
+
+def _scaled(intrinsics, shape):
+    rows, cols = shape
+    fx, fy, cx, cy = intrinsics
+    sx, sy = cols/640.0, rows/480.0
+    return fx*sx, fy*sy, cx*sx, cy*sy
+
+class Registration(object):
+    """Where each pixel of a depth frame shows up in the RGB frame.
+
+       `coords` is a (rows, cols, 2) float32 array of RGB texture
+       coordinates (s, t) for each depth pixel, for a point infinitely far
+       away. Nearer points are shifted along s by `parallax`/z (z in actual
+       meters; see DEPTH_SHIFT), since the cameras aren't in the same place.
+       All of that is worked out once, up front, so:
+
+       - on the CPU, map(raw) or colors(raw, video) handle a whole frame
+         with a few numpy operations;
+       - on the GPU, upload `coords` as a GL_RG32F texture once, paste
+         `glsl` into your shader (after DEPTH_GLSL) and call
+         video_coord(texture(coords, texpos).rg, raw_to_meters(raw)).
+    """
+    def __init__(self, shape=(480, 640), video_shape=(480, 640),
+                 intrinsics=DEPTH_INTRINSICS,
+                 video_intrinsics=VIDEO_INTRINSICS,
+                 baseline=VIDEO_BASELINE):
+        self.shape = tuple(shape)
+        self.video_shape = tuple(video_shape)
+        fx, fy, cx, cy = _scaled(intrinsics, shape)
+        vfx, vfy, vcx, vcy = _scaled(video_intrinsics, video_shape)
+        rows, cols = shape
+        vrows, vcols = video_shape
+        # (+0.5: texture coordinates for the middle of the pixel)
+        u = np.arange(cols, dtype=np.float64)
+        v = np.arange(rows, dtype=np.float64)
+        s = ((u - cx) * (vfx/fx) + vcx + 0.5) / vcols
+        t = ((v - cy) * (vfy/fy) + vcy + 0.5) / vrows
+        self.coords = np.empty((rows, cols, 2), dtype=np.float32)
+        self.coords[...,0] = s[None,:]
+        self.coords[...,1] = t[:,None]
+        self.coords.setflags(write=False)
+        self.parallax = -vfx * baseline / vcols
+        # the shift in s for each raw depth value
+        self.lut = (self.parallax / (DEPTH_LUT + DEPTH_SHIFT)).astype(np.float32)
+        self.lut.setflags(write=False)
+        # the same things in RGB pixels, for colors()
+        self._x0 = self.coords[...,0] * np.float32(vcols)
+        self._xlut = self.lut * np.float32(vcols)
+        y = np.clip((self.coords[...,1] * vrows).astype(np.intp), 0, vrows-1)
+        self._rowstart = y * vcols
+        self._x = np.empty(shape, dtype=np.float32)
+        self._index = np.empty(shape, dtype=np.intp)
+        self.glsl = """
+vec2 video_coord(vec2 coord, float meters) {
+    return vec2(coord.s + %r / (meters + %r), coord.t);
+}
+""" % (self.parallax, DEPTH_SHIFT)
+
+    def map(self, raw, out=None):
+        '''Return (rows, cols, 2) RGB texture coordinates for each pixel of
+           the raw depth frame `raw` (written into `out`, if given).'''
+        if out is None:
+            out = np.empty(self.coords.shape, dtype=np.float32)
+        out[...] = self.coords
+        out[...,0] += np.take(self.lut, raw, mode='clip')
+        return out
+
+    def colors(self, raw, video, out=None):
+        '''Return the (rows, cols, 3) color of each depth pixel, picked out
+           of the RGB frame `video` (nearest pixel). Not thread-safe: it
+           reuses the same scratch buffers every time.'''
+        vrows, vcols = self.video_shape
+        x, index = self._x, self._index
+        np.take(self._xlut, raw, out=x, mode='clip')
+        np.add(x, self._x0, out=x)
+        np.clip(x, 0, vcols-1, out=x)
+        index[...] = x
+        np.add(index, self._rowstart, out=index)
+        flat = video.reshape(-1, video.shape[-1])
+        return np.take(flat, index, axis=0, out=out)
+
 class Kinect(object):
     def __init__(self,
                  devno=0,
                  resolution=RESOLUTION_MEDIUM,
                  depth_mode=DEPTH_11BIT,
-                 video_mode=VIDEO_RGB):
-        self._ctx = freenect.init()
+                 video_mode=VIDEO_RGB,
+                 backend=None):
+        # backend is the freenect module, or something that quacks like it
+        self._fn = backend or freenect
+        if self._fn is None:
+            raise KinectError("freenect module not available")
+        self._ctx = self._fn.init()
         if not self._ctx:
             raise KinectError("Cannot connect to device.")
         self.devno = devno
-        self._dev = freenect.open_device(self._ctx, self.devno)
+        self._dev = self._fn.open_device(self._ctx, self.devno)
         if not self._dev:
-            freenect.shutdown(self._ctx)
+            self._fn.shutdown(self._ctx)
             raise KinectError("Cannot open device.")
 
         self._depth_callback = None
         self._video_callback = None
+        self._capture = None
+        # a DepthRecorder (see wigl.recording) to save frames to
+        self.recorder = None
 
         self._resolution = resolution
         self.depth_mode = depth_mode
-        self.video_mode = video_mode
+        if self.has_video:
+            self.video_mode = video_mode
 
     @property
     def depth_mode(self):
@@ -50,27 +245,219 @@ class Kinect(object):
     @depth_mode.setter
     def depth_mode(self, mode):
         self._depth_mode = mode
-        freenect.set_depth_mode(self._dev, self._resolution, mode)
+        self._fn.set_depth_mode(self._dev, self._resolution, mode)
+
+    @property
+    def has_video(self):
+        '''False if the backend only does depth (e.g. a recording)'''
+        return hasattr(self._fn, 'start_video')
+
+    @property
+    def video_mode(self):
+        return self._video_mode
+
+    @video_mode.setter
+    def video_mode(self, mode):
+        self._video_mode = mode
+        self._fn.set_video_mode(self._dev, self._resolution, mode)
 
     def start_depth(self, callback):
-        freenect.start_depth(self._dev)
+        if self.recorder is not None:
+            callback = self.recorder.wrap(callback)
+        self._fn.start_depth(self._dev)
         self._depth_callback = callback
-        return freenect.set_depth_callback(self._dev, callback)
+        return self._fn.set_depth_callback(self._dev, callback)
 
     def stop_depth(self):
-        freenect.stop_depth(self._dev)
+        self._fn.stop_depth(self._dev)
         self._depth_callback = None
 
+    def start_video(self, callback):
+        '''Start the RGB (or whatever video_mode says) stream. Like depth,
+           callback(dev, data, timestamp) gets a view of the device's own
+           buffer, which gets reused for the next frame.'''
+        if not self.has_video:
+            raise KinectError("Device has no video stream.")
+        self._fn.start_video(self._dev)
+        self._video_callback = callback
+        return self._fn.set_video_callback(self._dev, callback)
+
+    def stop_video(self):
+        self._fn.stop_video(self._dev)
+        self._video_callback = None
+
     def process_events(self):
-        rv = freenect.process_events(self._ctx)
+        rv = self._fn.process_events(self._ctx)
         if rv:
             raise KinectError("Error processing events", rv)
 
     def set_led(self, leds):
-        return freenect.set_led(self._dev, leds)
+        return self._fn.set_led(self._dev, leds)
+
+    # Threaded capture mode
+
+    def start_capture(self, nbuffers=3, video=False):
+        '''Start a background thread that processes events and stores depth
+           (and, with video=True, video) frames in rings of preallocated
+           buffers. Use latest_depth() and latest_video() to get the newest
+           frames. Don't call process_events(), start_depth() or
+           start_video() yourself while this is running.'''
+        if self._capture is not None:
+            raise KinectError("Capture already running")
+        self._capture = DepthCapture(self, nbuffers, video)
+        self._capture.start()
+        return self._capture
+
+    def stop_capture(self):
+        if self._capture is not None:
+            self._capture.stop()
+            self._capture = None
+
+    @property
+    def capture(self):
+        '''The running DepthCapture, if any'''
+        return self._capture
+
+    def latest_depth(self):
+        '''Return (data, timestamp) for the newest captured depth frame, or
+           (None, None) if there isn't one yet. See DepthCapture.latest().'''
+        if self._capture is None:
+            raise KinectError("Capture not running")
+        return self._capture.latest()
+
+    def latest_video(self):
+        '''Like latest_depth(), for video frames (if the capture has them).'''
+        if self._capture is None or self._capture.video is None:
+            raise KinectError("Video capture not running")
+        return self._capture.video.latest()
 
     def shutdown(self):
+        self.stop_capture()
+        if self.recorder is not None:
+            self.recorder.close()
         if self._dev:
-            freenect.close_device(self._dev)
+            self._fn.close_device(self._dev)
         if self._ctx:
-            freenect.shutdown(self._ctx)
+            self._fn.shutdown(self._ctx)
+
+class FrameRing(object):
+    """A ring of preallocated numpy buffers that frames get copied into by
+       one thread and read out of by another.
+
+       The handoff to the reader doesn't lock: the writer publishes each
+       finished frame by replacing self._latest (a single, atomic attribute
+       assignment) and never writes into the slot that's currently published
+       or the one the reader last took, so with 3+ slots it always has
+       somewhere to write.
+
+       dropped counts frames that were replaced before anyone read them;
+       duplicated counts latest() calls that returned the same frame as the
+       previous call.
+    """
+    def __init__(self, nbuffers=3):
+        if nbuffers < 3:
+            raise ValueError("need at least 3 buffers, got %d" % nbuffers)
+        self.buffers = [None] * nbuffers
+        self.timestamps = [None] * nbuffers
+        # (seq, slot) of the newest complete frame
+        self._latest = (0, None)
+        # slot that the reader currently holds
+        self._reading = None
+        self._last_read = 0
+        self.frames = 0
+        self.dropped = 0
+        self.duplicated = 0
+
+    def write(self, data, timestamp):
+        seq, latest = self._latest
+        busy = (latest, self._reading)
+        slot = next(i for i in xrange(len(self.buffers)) if i not in busy)
+        buf = self.buffers[slot]
+        if buf is None or buf.shape != data.shape or buf.dtype != data.dtype:
+            buf = self.buffers[slot] = np.empty_like(data)
+        # the device reuses `data` for the next frame, so we have to copy it
+        buf[...] = data
+        self.timestamps[slot] = timestamp
+        if seq > self._last_read:
+            self.dropped += 1
+        self.frames += 1
+        self._latest = (seq+1, slot)
+
+    @property
+    def has_new(self):
+        '''True if a frame arrived since the last call to latest()'''
+        return self._latest[0] > self._last_read
+
+    def latest(self):
+        '''Return (data, timestamp) for the newest frame, or (None, None) if
+           there isn't one yet. `data` belongs to the buffer ring; it stays
+           valid until the next call to latest().'''
+        while True:
+            latest = self._latest
+            self._reading = latest[1]
+            # make sure the writer didn't publish another frame meanwhile
+            if self._latest is latest:
+                break
+        seq, slot = latest
+        if slot is None:
+            return None, None
+        if seq == self._last_read:
+            self.duplicated += 1
+        self._last_read = seq
+        return self.buffers[slot], self.timestamps[slot]
+
+class DepthCapture(object):
+    """Runs a Kinect's event loop in a background thread, copying each depth
+       frame into a FrameRing (self.depth), and each video frame into
+       another (self.video) if video=True.
+       has_new, latest(), frames, dropped and duplicated are the depth
+       ring's.
+    """
+    def __init__(self, kinect, nbuffers=3, video=False):
+        self.kinect = kinect
+        self.depth = FrameRing(nbuffers)
+        self.video = FrameRing(nbuffers) if video else None
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name="kinect%d" % kinect.devno)
+        self._thread.daemon = True
+
+    def start(self):
+        self.kinect.start_depth(self._new_frame)
+        if self.video is not None:
+            self.kinect.start_video(self._new_video)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.kinect.stop_depth()
+        if self.video is not None:
+            self.kinect.stop_video()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                self.kinect.process_events()
+        except KinectError as e:
+            self.error = e
+
+    def _new_frame(self, dev, data, timestamp):
+        self.depth.write(data, timestamp)
+
+    def _new_video(self, dev, data, timestamp):
+        self.video.write(data, timestamp)
+
+    has_new = property(lambda self: self.depth.has_new)
+    frames = property(lambda self: self.depth.frames)
+    dropped = property(lambda self: self.depth.dropped)
+    duplicated = property(lambda self: self.depth.duplicated)
+
+    def latest(self):
+        '''The newest depth frame; see FrameRing.latest()'''
+        return self.depth.latest()
@@ -16,12 +16,18 @@
 # along with wigl.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+# (so `import math` gets the stdlib's, not this module)
+from __future__ import absolute_import
+
+import math
 import numpy as np
 
 __all__ = [
-    'norm', 'quat',
-    'identity', 'translate', 'rotate', 'scale',
+    'norm', 'norms', 'quat',
+    'identity', 'translate', 'rotate', 'rotateq', 'scale',
     'lookat', 'perspective', 'ortho',
+    'identities', 'translations', 'rotations', 'rotationsq', 'scalings',
+    'lookats', 'perspectives', 'orthos', 'compose',
 ]
 
 def norm(v):
@@ -29,6 +35,13 @@ def norm(v):
     mag = np.sqrt(v.dot(v))
     return v/mag if mag else v
 
+def norms(v):
+    '''Normalize each row of an (N,k) array of vectors.
+       Zero-length vectors are returned unchanged, like norm().'''
+    mag = np.sqrt(np.einsum('ij,ij->i', v, v))
+    mag[mag == 0] = 1
+    return v/mag[:,None]
+
 def quat(angle, x, y, z):
     '''Return a normalized quaternion for the given rotation axis and angle'''
     a = np.radians(angle)/2
@@ -48,98 +61,237 @@ def quat(angle, x, y, z):
 # a right-handed system for eye-space, so these functions vary slightly from
 # their old GLU equivalents and/or random junk you'll find online..
 
+# XXX NOTE THREE: the plural functions below take arrays of N sets of
+# parameters and return an (N,4,4) float32 stack of matrices, written into
+# `out` if you give them one (so you can reuse the same buffers every
+# frame). The singular functions do the same math on plain floats, since
+# numpy's per-call overhead would swamp it for one matrix.
+# These are plain ndarrays, not np.matrix, so use compose() (or np.dot)
+# to multiply them - '*' is elementwise!
+
+_IDENTITY = np.identity(4, dtype=np.float32)
+
+def _vecs(v, width):
+    '''Return `v` as an (N,width) float64 array'''
+    return np.asarray(v, dtype=np.float64).reshape(-1, width)
+
+def _scalars(*args):
+    '''Return the args as flat float64 arrays, broadcast to the same length'''
+    return np.broadcast_arrays(*[np.asarray(a, dtype=np.float64).ravel()
+                                 for a in args])
+
+def identities(n, out=None):
+    '''Return an (n,4,4) stack of identity matrices, reusing `out` if given.'''
+    if out is None:
+        out = np.empty((n,4,4), dtype=np.float32)
+    elif out.shape != (n,4,4):
+        raise ValueError("output buffer has shape %s, expected %s" % \
+                          (out.shape, (n,4,4)))
+    out[...] = _IDENTITY
+    return out
+
+def compose(a, b, out=None):
+    '''Return the matrix product a*b (i.e. apply b, then a).
+       Works on single matrices and (N,4,4) stacks (which broadcast against
+       each other). If `out` is given the result is written into it, and it's
+       OK for `out` to be `a` or `b`.'''
+    if out is not None and (np.may_share_memory(out, a) or
+                            np.may_share_memory(out, b)):
+        out[...] = np.matmul(a, b)
+        return out
+    return np.matmul(a, b, out=out)
+
+def translations(v, out=None):
+    '''Return matrices for translations by each (x,y,z) in `v`.'''
+    v = _vecs(v, 3)
+    out = identities(len(v), out)
+    out[:,0:3,3] = v
+    return out
+
+def scalings(v, out=None):
+    '''Return matrices for scaling along the x, y, and z axes by each
+       (x,y,z) in `v`.'''
+    v = _vecs(v, 3)
+    out = identities(len(v), out)
+    d = np.arange(3)
+    out[:,d,d] = v
+    return out
+
+def rotationsq(q, out=None):
+    '''Return rotation matrices for each (x,y,z,w) quaternion in `q`.'''
+    x, y, z, w = _vecs(q, 4).T
+    xx, yy, zz = x*x, y*y, z*z
+    xy, xz, yz = x*y, x*z, y*z
+    wx, wy, wz = w*x, w*y, w*z
+    out = identities(len(x), out)
+    out[:,0,0] = 1-2*(yy+zz)
+    out[:,0,1] =   2*(xy-wz)
+    out[:,0,2] =   2*(xz+wy)
+    out[:,1,0] =   2*(xy+wz)
+    out[:,1,1] = 1-2*(xx+zz)
+    out[:,1,2] =   2*(yz-wx)
+    out[:,2,0] =   2*(xz-wy)
+    out[:,2,1] =   2*(yz+wx)
+    out[:,2,2] = 1-2*(xx+yy)
+    return out
+
+def rotations(angles, axes, out=None):
+    '''Return matrices for rotation by each angle (in degrees) about the
+       corresponding (x,y,z) vector in `axes`. Either one can be a single
+       angle or axis, to use for every matrix.'''
+    a, = _scalars(angles)
+    a, axes = np.broadcast_arrays(a[:,None], _vecs(axes, 3))
+    a = np.radians(a[:,0])
+    c = np.cos(a)
+    s = np.sin(a)
+    x, y, z = norms(axes).T
+    xx, yy, zz = x*x, y*y, z*z
+    xy, xz, yz = x*y, x*z, y*z
+    xs, ys, zs = x*s, y*s, z*s
+    oc = 1 - c
+    out = identities(len(x), out)
+    out[:,0,0] = xx*oc+c
+    out[:,0,1] = xy*oc-zs
+    out[:,0,2] = xz*oc+ys
+    out[:,1,0] = xy*oc+zs
+    out[:,1,1] = yy*oc+c
+    out[:,1,2] = yz*oc-xs
+    out[:,2,0] = xz*oc-ys
+    out[:,2,1] = yz*oc+xs
+    out[:,2,2] = zz*oc+c
+    return out
+
+def lookats(eye, center, up, out=None):
+    '''Return view matrices for each (eye, center, up) triple.
+       See lookat() for details.'''
+    eye, center, up = np.broadcast_arrays(_vecs(eye, 3), _vecs(center, 3),
+                                          _vecs(up, 3))
+    z = -norms(center-eye)
+    x = norms(np.cross(z, up))
+    y = np.cross(x, z)
+    out = identities(len(z), out)
+    # rotate world to camera orientation...
+    out[:,0,0:3] = x
+    out[:,1,0:3] = y
+    out[:,2,0:3] = z
+    # ...after translating by the inverse of eye position
+    out[:,0:3,3] = -np.einsum('nij,nj->ni', out[:,0:3,0:3], eye)
+    return out
+
+def perspectives(fovy, aspect, near, far, out=None):
+    '''Return perspective matrices for each set of parameters.
+       See perspective() for details.'''
+    fovy, aspect, near, far = _scalars(fovy, aspect, near, far)
+    f = 1/np.tan((np.pi/180)*(fovy/2))
+    out = identities(len(f), out)
+    out[:,0,0] = f/aspect
+    out[:,1,1] = f
+    out[:,2,2] = (far+near) / (near-far)
+    out[:,2,3] = (2*far*near) / (near-far)
+    out[:,3,2] = -1
+    out[:,3,3] = 0
+    return out
+
+def orthos(left, right, bottom, top, near, far, out=None):
+    '''Return orthographic matrices for each set of parameters.
+       See ortho() for details.'''
+    l, r, b, t, n, f = _scalars(left, right, bottom, top, near, far)
+    out = identities(len(l), out)
+    out[:,0,0] = 2/(r-l)
+    out[:,1,1] = 2/(t-b)
+    out[:,2,2] = 2/(f-n)
+    out[:,0,3] = -(r+l)/(r-l)
+    out[:,1,3] = -(t+b)/(t-b)
+    out[:,2,3] = -(f+n)/(f-n)
+    return out
+
+def _matrix(*rows):
+    '''Return a 4x4 float32 matrix with the given rows (4-tuples)'''
+    return np.array(rows, dtype=np.float32)
+
+def _norm3(x, y, z):
+    mag = math.sqrt(x*x + y*y + z*z)
+    return (x/mag, y/mag, z/mag) if mag else (x, y, z)
+
+def _cross(a, b):
+    return (a[1]*b[2] - a[2]*b[1],
+            a[2]*b[0] - a[0]*b[2],
+            a[0]*b[1] - a[1]*b[0])
+
 def identity():
     return np.identity(4, dtype='float32')
 
 def translate(x, y, z):
     '''Return a matrix representing a translation by (x,y,z).'''
-    return np.matrix([
-        [1, 0, 0, x],
-        [0, 1, 0, y],
-        [0, 0, 1, z],
-        [0, 0, 0, 1],
-    ], dtype=np.float32)
+    return _matrix((1, 0, 0, x),
+                   (0, 1, 0, y),
+                   (0, 0, 1, z),
+                   (0, 0, 0, 1))
 
 def rotateq(quat):
     # This is the quaternion version, wheeeee~~~~
-    x, y, z, w = quat
+    x, y, z, w = [float(i) for i in quat]
     xx, yy, zz = x*x, y*y, z*z
     xy, xz, yz = x*y, x*z, y*z
     wx, wy, wz = w*x, w*y, w*z
-    return np.matrix([
-        [1-2*(yy+zz),   2*(xy-wz),   2*(xz+wy), 0],
-        [  2*(xy+wz), 1-2*(xx+zz),   2*(yz-wx), 0],
-        [  2*(xz-wy),   2*(yz+wx), 1-2*(xx+yy), 0],
-        [          0,           0,           0, 1],
-    ], dtype=np.float32)
+    return _matrix((1-2*(yy+zz),   2*(xy-wz),   2*(xz+wy), 0),
+                   (  2*(xy+wz), 1-2*(xx+zz),   2*(yz-wx), 0),
+                   (  2*(xz-wy),   2*(yz+wx), 1-2*(xx+yy), 0),
+                   (          0,           0,           0, 1))
 
 def rotate(angle, x, y, z):
     '''Return a matrix representing rotation about the vector (x,y,z)'''
     # This is the glRotatef version
-    a = np.radians(angle)
-    c = np.cos(a)
-    s = np.sin(a)
-    x, y, z = norm(np.array([x,y,z]))
+    a = math.radians(angle)
+    c = math.cos(a)
+    s = math.sin(a)
+    x, y, z = _norm3(float(x), float(y), float(z))
     xx, yy, zz = x*x, y*y, z*z
     xy, xz, yz = x*y, x*z, y*z
     xs, ys, zs = x*s, y*s, z*s
     oc = 1 - c
-    return np.matrix([
-        [xx*oc+c,  xy*oc-zs, xz*oc+ys, 0],
-        [xy*oc+zs, yy*oc+c,  yz*oc-xs, 0],
-        [xz*oc-ys, yz*oc+xs, zz*oc+c,  0],
-        [       0,        0,       0,  1],
-    ], dtype=np.float32)
+    return _matrix((xx*oc+c,  xy*oc-zs, xz*oc+ys, 0),
+                   (xy*oc+zs, yy*oc+c,  yz*oc-xs, 0),
+                   (xz*oc-ys, yz*oc+xs, zz*oc+c,  0),
+                   (       0,        0,       0,  1))
 
 def scale(x, y, z):
     '''Return a matrix for scaling along the x, y, and z axes.'''
-    return np.matrix([
-        [x, 0, 0, 0],
-        [0, y, 0, 0],
-        [0, 0, z, 0],
-        [0, 0, 0, 1],
-    ], dtype=np.float32)
+    return _matrix((x, 0, 0, 0),
+                   (0, y, 0, 0),
+                   (0, 0, z, 0),
+                   (0, 0, 0, 1))
 
 def lookat(eye=(0,0,-1), center=(0,0,0), up=(0,1,0)):
     '''Return a view + transform matrix, similar to the one constructed by
        the deprecated gluLookAt() function.'''
-    z = -norm(np.array(center)-np.array(eye))
-    x = norm(np.cross(z, up))
-    y = np.cross(x, z)
-    # rotate world to camera orientation
-    r = np.matrix([
-        [x[0], x[1], x[2], 0],
-        [y[0], y[1], y[2], 0],
-        [z[0], z[1], z[2], 0],
-        [   0,    0,    0, 1],
-    ], dtype=np.float32)
-    # translate inverse of eye position
-    t = -np.array(eye)
-    return r * translate(t[0], t[1], t[2])
-
+    eye = [float(i) for i in eye]
+    z = _norm3(*[e-c for c, e in zip(center, eye)])
+    x = _norm3(*_cross(z, up))
+    y = _cross(x, z)
+    # rotate world to camera orientation, after translating by the inverse
+    # of eye position
+    def row(v):
+        return tuple(v) + (-(v[0]*eye[0] + v[1]*eye[1] + v[2]*eye[2]),)
+    return _matrix(row(x), row(y), row(z), (0, 0, 0, 1))
 
 def perspective(fovy=60, aspect=1.0, near=0.1, far=100):
     '''Return a perspective matrix, similar to the one constructed by the
        deprecated gluPerspective() function.'''
-    f = 1/np.tan((np.pi/180)*(float(fovy)/2))
-    a = 1/aspect
-    z1 = float(far+near) / (near-far)
-    z2 = float(2*far*near) / (near-far)
-    return np.matrix([
-        [f*a, 0,  0 , 0],
-        [  0, f,  0,  0],
-        [  0, 0, z1, z2],
-        [  0, 0, -1,  0],
-    ], dtype=np.float32)
-
+    f = 1/math.tan(math.radians(fovy/2.0))
+    near, far = float(near), float(far)
+    z1 = (far+near) / (near-far)
+    z2 = (2*far*near) / (near-far)
+    return _matrix((f/aspect, 0,  0,  0),
+                   (       0, f,  0,  0),
+                   (       0, 0, z1, z2),
+                   (       0, 0, -1,  0))
 
 def ortho(left=-1, right=1, bottom=-1, top=1, near=-1, far=1):
     '''Return an orthographic matrix, similar to the one constructed by the
        deprecated glOrtho() function.'''
-    (l,r,b,t,n,f) = (left, right, bottom, top, near, far)
-    return np.matrix([
-        [2/(r-l), 0,       0,        -(r+l)/(r-l)],
-        [0,       2/(t-b), 0,        -(t+b)/(t-b)],
-        [0,       0,       2/(f-n),  -(f+n)/(f-n)],
-        [0,       0,       0,                   1],
-    ], dtype=np.float32)
+    l, r, b, t, n, f = [float(i) for i in (left, right, bottom, top, near, far)]
+    return _matrix((2/(r-l), 0,       0,       -(r+l)/(r-l)),
+                   (0,       2/(t-b), 0,       -(t+b)/(t-b)),
+                   (0,       0,       2/(f-n), -(f+n)/(f-n)),
+                   (0,       0,       0,                  1))
@@ -16,24 +16,292 @@
 # along with wigl.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from . import RESTART_INDEX
+from . import RESTART_INDEX, glstate
+from OpenGL.GL import GL_UNSIGNED_SHORT, GL_UNSIGNED_INT, glDrawElements
+from .renderqueue import DrawItem
 
 import numpy as np
+import ctypes
 
 __all__ = [
     'makemesh', 'simplemesh', 'triangle_mesh_indexes',
+    'grid_indexes', 'index_dtype', 'index_gltype', 'restart_index',
+    'TOPOLOGIES', 'decimated_indexes', 'GridLOD',
 ]
 
+# Index topologies that grid_indexes() knows how to build:
+#   'strip':     one GL_TRIANGLE_STRIP per row, separated by restart_index()
+#   'triangles': plain GL_TRIANGLES, two per grid cell
+#   'lines':     GL_LINES wireframe of the 'triangles' mesh (with diagonals)
+TOPOLOGIES = ('strip', 'triangles', 'lines')
+
+# (rows, cols, topology, dtype) -> read-only index array
+_index_cache = dict()
+
 def makemesh(xvec, zvec):
     return np.dstack(np.meshgrid(xvec, zvec)).astype(np.float32)
 
 def simplemesh(numx, numz, aspect=1):
     return makemesh(np.linspace(-aspect,aspect,numx),np.linspace(-1,1,numz))
 
-def triangle_mesh_indexes(mesh):
+def index_dtype(rows, cols):
+    '''Return the smallest index dtype that can address a rows x cols grid.
+       uint16 is used if every vertex index fits below 0xFFFF (which is
+       reserved as the uint16 restart index); otherwise uint32.'''
+    if rows*cols <= np.iinfo(np.uint16).max:
+        return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+def index_gltype(indexes):
+    '''Return the GL type enum to pass to glDrawElements for `indexes`.'''
+    if indexes.dtype == np.uint16:
+        return GL_UNSIGNED_SHORT
+    return GL_UNSIGNED_INT
+
+def restart_index(dtype):
+    '''Return the primitive restart index used in strips of the given dtype.
+       GridLOD and RenderQueue set it for you; if you call glDrawElements
+       yourself, call glstate.current.primitive_restart(gltype) first.'''
+    if np.dtype(dtype) == np.uint16:
+        return np.iinfo(np.uint16).max
+    return RESTART_INDEX
+
+def _strip_indexes(rows, cols, dtype):
+    # each row is a strip of (top, bottom) pairs, followed by a restart marker
+    top = np.arange(cols*(rows-1), dtype=dtype).reshape(rows-1, cols)
+    out = np.empty((rows-1, 2*cols+1), dtype=dtype)
+    out[:,0:-1:2] = top
+    out[:,1:-1:2] = top + cols
+    out[:,-1] = restart_index(dtype)
+    # no restart after the final row
+    return out.ravel()[:-1]
+
+def _triangle_indexes(rows, cols, dtype):
+    # a = top-left corner of each grid cell
+    a = np.arange(rows*cols, dtype=dtype).reshape(rows, cols)[:-1,:-1]
+    out = np.empty(a.shape + (6,), dtype=dtype)
+    # same winding as the strips: (a, a+cols, a+1), (a+1, a+cols, a+cols+1)
+    out[...,0] = a
+    out[...,1] = a + cols
+    out[...,2] = a + 1
+    out[...,3] = a + 1
+    out[...,4] = a + cols
+    out[...,5] = a + cols + 1
+    return out.ravel()
+
+def _line_indexes(rows, cols, dtype):
+    grid = np.arange(rows*cols, dtype=dtype).reshape(rows, cols)
+    horiz = np.dstack((grid[:,:-1], grid[:,1:]))
+    vert  = np.dstack((grid[:-1,:], grid[1:,:]))
+    diag  = np.dstack((grid[:-1,1:], grid[1:,:-1]))
+    return np.concatenate((horiz.ravel(), vert.ravel(), diag.ravel()))
+
+_builders = {
+    'strip': _strip_indexes,
+    'triangles': _triangle_indexes,
+    'lines': _line_indexes,
+}
+
+def grid_indexes(rows, cols, topology='strip', dtype=None):
+    '''Return an index array for a rows x cols vertex grid.
+       `topology` is one of TOPOLOGIES. If `dtype` is None, the smallest
+       dtype that fits (see index_dtype()) is used.
+       Results are cached and shared, so the returned array is read-only.'''
+    if topology not in _builders:
+        raise ValueError("unknown topology %r (expected one of %s)" % \
+                          (topology, ", ".join(TOPOLOGIES)))
+    if dtype is None:
+        dtype = index_dtype(rows, cols)
+    dtype = np.dtype(dtype)
+    key = (rows, cols, topology, dtype.str)
+    idx = _index_cache.get(key)
+    if idx is None:
+        if rows < 2 or cols < 2:
+            idx = np.empty(0, dtype=dtype)
+        else:
+            idx = _builders[topology](rows, cols, dtype)
+        idx.setflags(write=False)
+        _index_cache[key] = idx
+    return idx
+
+def triangle_mesh_indexes(mesh, topology='strip', dtype=np.uint32):
+    '''Return indexes for drawing `mesh` (a rows x cols x 2 grid, as made by
+       makemesh()) with the given topology. See grid_indexes().
+       These are uint32 (GL_UNSIGNED_INT), as they've always been, unless
+       you ask for something else; dtype=None picks the smallest that fits.'''
     rows, cols, _ = mesh.shape
-    out = list()
-    for i in xrange(cols*(rows-1)):
-        if i and (i % cols) == 0: out.append(RESTART_INDEX)
-        out += [i, i+cols]
-    return np.array(out, dtype=np.uint32)
+    return grid_indexes(rows, cols, topology, dtype)
+
+def _samples(start, stop, step):
+    # every step'th point from start to stop, always including stop
+    points = np.arange(start, stop+1, step)
+    if points[-1] != stop:
+        points = np.append(points, stop)
+    return points
+
+def decimated_indexes(rows, cols, step, topology='strip', dtype=None,
+                      rowrange=None, colrange=None):
+    '''Return indexes that draw a coarser version of a rows x cols vertex
+       grid, using only every `step`'th row and column (plus the last ones,
+       so the edges stay put). The indexes refer to the full grid, so the
+       same vertex buffer can be drawn at any level of detail.
+       rowrange/colrange = (first, last) limit it to part of the grid.
+       Results are cached and read-only, like grid_indexes().'''
+    if dtype is None:
+        dtype = index_dtype(rows, cols)
+    dtype = np.dtype(dtype)
+    r0, r1 = rowrange or (0, rows-1)
+    c0, c1 = colrange or (0, cols-1)
+    key = (rows, cols, topology, dtype.str, step, r0, r1, c0, c1)
+    idx = _index_cache.get(key)
+    if idx is None:
+        r, c = _samples(r0, r1, step), _samples(c0, c1, step)
+        # indexes for the smaller grid, mapped back to the full one
+        sub = grid_indexes(len(r), len(c), topology, np.uint32)
+        restart = (sub == restart_index(np.uint32))
+        lut = (r[:,None]*cols + c[None,:]).ravel().astype(dtype)
+        idx = lut.take(np.where(restart, 0, sub))
+        idx[restart] = restart_index(dtype)
+        idx.setflags(write=False)
+        _index_cache[key] = idx
+    return idx
+
+class GridLOD(object):
+    """Levels of detail for drawing a heightmap grid (as made by makemesh()).
+
+       The grid is split into tiles[0] x tiles[1] tiles, and each tile gets
+       `levels` index ranges: level 0 is every vertex, level 1 every 2nd
+       row and column, level 2 every 4th, etc. All of them go in one index
+       array (self.indexes - put it in a GL_ELEMENT_ARRAY_BUFFER) over the
+       one vertex buffer. Each frame, select() picks a level per tile from
+       how big it'll be on screen, and draw() draws them:
+
+           lod = GridLOD(mesh, tiles=(4,4), zrange=(0,2))
+           ...
+           lod.draw(lod.select(mvp, viewport), GL_TRIANGLE_STRIP)
+
+       Or, to draw through a RenderQueue (which can draw all the tiles with
+       one glMultiDrawElements call), make one DrawItem per tile with
+       items(), add them to the queue, and update_items() each frame.
+
+       Tiles share their edge vertices, but neighbors drawn at different
+       levels can leave small cracks between them.
+    """
+    def __init__(self, mesh, levels=4, tiles=(1,1), topology='strip',
+                       dtype=None, zrange=(0,0)):
+        rows, cols, _ = mesh.shape
+        if dtype is None:
+            dtype = index_dtype(rows, cols)
+        self.levels = levels
+        self.tiles = tiles
+        self.drawn = 0       # indexes drawn by the last draw()
+        rowbounds = np.linspace(0, rows-1, tiles[0]+1).round().astype(int)
+        colbounds = np.linspace(0, cols-1, tiles[1]+1).round().astype(int)
+
+        # (offset, count) into self.indexes for each tile and level, and
+        # the number of grid cells across each tile (for picking levels)
+        self.ranges = np.zeros(tuple(tiles) + (levels, 2), dtype=np.intp)
+        self.cells = np.zeros(tiles, dtype=np.intp)
+        chunks, offset = [], 0
+        for i in xrange(tiles[0]):
+            rr = (rowbounds[i], rowbounds[i+1])
+            for j in xrange(tiles[1]):
+                cr = (colbounds[j], colbounds[j+1])
+                self.cells[i,j] = max(rr[1]-rr[0], cr[1]-cr[0])
+                for level in xrange(levels):
+                    idx = decimated_indexes(rows, cols, 2**level, topology,
+                                            dtype, rr, cr)
+                    self.ranges[i,j,level] = (offset, idx.size)
+                    chunks.append(idx)
+                    offset += idx.size
+        self.indexes = np.concatenate(chunks)
+        self.indexes.setflags(write=False)
+
+        # bounding box corners for each tile: (tiles..., 8, xyzw)
+        corners = np.ones(tuple(tiles) + (8, 4), dtype=np.float32)
+        for i in xrange(tiles[0]):
+            for j in xrange(tiles[1]):
+                xy = mesh[rowbounds[i]:rowbounds[i+1]+1,
+                          colbounds[j]:colbounds[j+1]+1].reshape(-1, 2)
+                lo, hi = xy.min(axis=0), xy.max(axis=0)
+                k = 0
+                for x in (lo[0], hi[0]):
+                    for y in (lo[1], hi[1]):
+                        for z in zrange:
+                            corners[i,j,k,:3] = (x, y, z)
+                            k += 1
+        self.corners = corners
+
+    def select(self, mvp, viewport, pixels_per_cell=4.0):
+        '''Pick a level for each tile, aiming for grid cells about
+           `pixels_per_cell` pixels across on screen. `mvp` is the
+           projection * view * model matrix and `viewport` is (width, height)
+           in pixels. Returns an array of levels, with -1 for tiles that are
+           entirely off-screen.'''
+        clip = np.einsum('ij,...j->...i', np.asarray(mvp, np.float32),
+                         self.corners)
+        xyz, w = clip[...,:3], clip[...,3:]
+        # off-screen if every corner is outside the same clip plane
+        culled = ((xyz > w).all(axis=-2) | (xyz < -w).all(axis=-2)).any(-1)
+        # projected size in pixels (only meaningful if it's all in front)
+        behind = (w[...,0] <= 0).any(axis=-1)
+        ndc = xyz[...,:2] / np.where(w > 0, w, 1)
+        extent = ndc.max(axis=-2) - ndc.min(axis=-2)
+        pixels = (extent * np.asarray(viewport) / 2).max(axis=-1)
+        with np.errstate(divide='ignore'):
+            step = self.cells * pixels_per_cell / pixels
+            levels = np.floor(np.log2(np.maximum(step, 1)))
+        levels = np.clip(levels, 0, self.levels-1).astype(int)
+        levels[behind] = 0
+        levels[culled] = -1
+        return levels
+
+    def select_distance(self, eye, distance):
+        '''Pick a level for each tile by how far it is from `eye` (in model
+           coordinates): full detail within `distance`, then one level
+           coarser each time the distance doubles.'''
+        centers = self.corners[...,:3].mean(axis=-2)
+        dist = np.sqrt(((centers - eye)**2).sum(axis=-1))
+        levels = np.floor(np.log2(np.maximum(dist/distance, 1)))
+        return np.clip(levels, 0, self.levels-1).astype(int)
+
+    def count(self, levels):
+        '''Total indexes that draw() would draw for these levels.'''
+        levels = np.asarray(levels)
+        i, j = np.nonzero(levels >= 0)
+        return int(self.ranges[i, j, levels[i, j], 1].sum())
+
+    def draw(self, levels, mode):
+        '''Draw each tile at the given level (skipping tiles with level -1),
+           using the currently-bound element array buffer, which should
+           hold self.indexes.'''
+        gltype = index_gltype(self.indexes)
+        glstate.current.primitive_restart(gltype)
+        size = self.indexes.itemsize
+        levels = np.asarray(levels)
+        self.drawn = 0
+        for i, j in zip(*np.nonzero(levels >= 0)):
+            offset, count = self.ranges[i, j, levels[i, j]]
+            glDrawElements(mode, int(count), gltype,
+                           ctypes.c_void_p(int(offset)*size))
+            self.drawn += count
+
+    def items(self, program, vao, mode, indexes=None, **kwargs):
+        '''Return a DrawItem for each tile, in row-major order. `indexes` is
+           the VBO holding self.indexes (or None if it's in `vao`); other
+           keyword arguments are passed to DrawItem.'''
+        return [DrawItem(program, vao, mode, indexes,
+                         gltype=index_gltype(self.indexes), **kwargs)
+                for i in xrange(self.tiles[0]) for j in xrange(self.tiles[1])]
+
+    def update_items(self, items, levels):
+        '''Point each tile's DrawItem at its level's indexes, and hide the
+           tiles with level -1.'''
+        levels = np.asarray(levels).ravel()
+        ranges = self.ranges.reshape(-1, self.levels, 2)
+        self.drawn = 0
+        for item, level, tile in zip(items, levels, ranges):
+            item.visible = level >= 0
+            if item.visible:
+                item.first, item.count = (int(n) for n in tile[level])
+                self.drawn += item.count
@@ -0,0 +1,277 @@
+# wigl.multikinect: capture from several Kinects at once
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Capture depth frames from several Kinects, each in its own process.
+
+Kinect.start_capture() runs the device's event loop in a thread, which is
+fine for one device, but with more than one they all end up waiting on
+each other for the GIL. MultiKinect starts one worker process per device
+instead. Each worker writes its frames into a SharedDepthRing: a ring of
+frame buffers in shared memory, which the renderer reads through numpy
+views, without copying anything:
+
+    kinects = MultiKinect([0, 1])
+    kinects.start()
+    ...
+    for devno, (depth, timestamp, received) in kinects.latest_all().items():
+        textures[devno].replace(depth)
+    ...
+    kinects.stop()
+
+Each frame comes with the device's own timestamp and the time (on the
+host's clock) that its worker received it, so frames from different
+devices can be matched up.
+
+Pass backend=wigl.fakenect to get simulated devices instead of real ones.
+Start it before creating any GL context, so the workers don't get forked
+with a copy of the driver's state.
+"""
+
+import time
+import ctypes
+import signal
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from Queue import Empty
+
+import numpy as np
+
+from .kinect import Kinect, KinectError, RESOLUTION_MEDIUM, DEPTH_11BIT
+from .kinect import FRAME_SHAPES
+
+__all__ = [
+    'SharedDepthRing', 'DeviceCapture', 'MultiKinect',
+]
+
+# indexes into SharedDepthRing._state
+_SEQ, _SLOT, _READING, _LAST_READ, _FRAMES, _DROPPED = range(6)
+
+class SharedDepthRing(object):
+    """`nbuffers` frames of the given shape and dtype in shared memory,
+       passed from one writer process to one reader process.
+
+       Like FrameRing, the writer never writes into the slot that's
+       currently published or the one the reader holds, so the array that
+       latest() returns stays put until the next call to latest(). Picking
+       a slot, publishing one and claiming one each take a (very short)
+       lock, since there's no GIL to lean on between processes.
+    """
+    def __init__(self, shape, dtype=np.uint16, nbuffers=3):
+        if nbuffers < 3:
+            raise ValueError("need at least 3 buffers, got %d" % nbuffers)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.buffers = np.frombuffer(RawArray(ctypes.c_uint8, nbytes*nbuffers),
+                                     dtype=self.dtype)
+        self.buffers = self.buffers.reshape((nbuffers,) + self.shape)
+        # the device's timestamp, and when we got it (time.time())
+        self.timestamps = np.frombuffer(RawArray(ctypes.c_int64, nbuffers),
+                                        dtype=np.int64)
+        self.received = np.frombuffer(RawArray(ctypes.c_double, nbuffers),
+                                      dtype=np.float64)
+        self._state = np.frombuffer(RawArray(ctypes.c_int64, 6),
+                                    dtype=np.int64)
+        self._state[:] = (0, -1, -1, 0, 0, 0)
+        self._lock = multiprocessing.Lock()
+        self.duplicated = 0 # (only counted in the reader)
+
+    @property
+    def frames(self):
+        return int(self._state[_FRAMES])
+
+    @property
+    def dropped(self):
+        '''Frames that were replaced before anyone read them'''
+        return int(self._state[_DROPPED])
+
+    # writer side
+
+    def write(self, data, timestamp):
+        '''Copy `data` into a free slot and publish it as the latest frame.'''
+        state = self._state
+        with self._lock:
+            busy = (state[_SLOT], state[_READING])
+            slot = next(i for i in xrange(len(self.buffers)) if i not in busy)
+        self.buffers[slot] = data
+        self.timestamps[slot] = timestamp
+        self.received[slot] = time.time()
+        with self._lock:
+            if state[_SEQ] > state[_LAST_READ]:
+                state[_DROPPED] += 1
+            state[_SEQ] += 1
+            state[_SLOT] = slot
+            state[_FRAMES] += 1
+
+    # reader side
+
+    @property
+    def has_new(self):
+        '''True if a frame arrived since the last call to latest()'''
+        return self._state[_SEQ] > self._state[_LAST_READ]
+
+    def latest(self):
+        '''Return (data, timestamp, received) for the newest frame, or
+           (None, None, None) if there isn't one yet. `data` is a view of
+           shared memory that stays valid until the next call.'''
+        state = self._state
+        with self._lock:
+            seq, slot = int(state[_SEQ]), int(state[_SLOT])
+            last = int(state[_LAST_READ])
+            state[_READING] = slot
+            state[_LAST_READ] = seq
+        if slot < 0:
+            return None, None, None
+        if seq == last:
+            self.duplicated += 1
+        return (self.buffers[slot], int(self.timestamps[slot]),
+                float(self.received[slot]))
+
+def _capture_worker(devno, backend, kinect_args, ring, stop, errors):
+    # Ctrl-C is for the parent to deal with; it'll stop() us.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    kinect = None
+    try:
+        kinect = Kinect(devno, backend=backend, **kinect_args)
+        kinect.start_depth(lambda dev, data, timestamp:
+                           ring.write(data, timestamp))
+        while not stop.is_set():
+            kinect.process_events()
+        kinect.stop_depth()
+    except Exception as e:
+        errors.put("kinect%d: %s: %s" % (devno, type(e).__name__, e))
+    finally:
+        if kinect is not None:
+            kinect.shutdown()
+
+class DeviceCapture(object):
+    """One device's worker process and its SharedDepthRing.
+       Has the same has_new/latest()/error/frames/dropped/duplicated as
+       DepthCapture, so it can stand in for one, except that latest()
+       returns (data, timestamp, received). `kinect_args` are passed to
+       Kinect(); the ring's frame size comes from its `resolution`.
+    """
+    def __init__(self, devno, backend=None, nbuffers=3, **kinect_args):
+        self.devno = devno
+        resolution = kinect_args.get('resolution', RESOLUTION_MEDIUM)
+        if resolution not in FRAME_SHAPES:
+            raise ValueError("unknown resolution %r" % (resolution,))
+        self.ring = SharedDepthRing(FRAME_SHAPES[resolution], np.uint16,
+                                    nbuffers)
+        self._stop = multiprocessing.Event()
+        self._errors = multiprocessing.Queue()
+        self._error = None
+        self.process = multiprocessing.Process(target=_capture_worker,
+                name="kinect%d" % devno,
+                args=(devno, backend, kinect_args, self.ring, self._stop,
+                      self._errors))
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    @property
+    def running(self):
+        return self.process.is_alive()
+
+    @property
+    def error(self):
+        '''A message saying why the worker died, or None if it's fine'''
+        if self._error is None:
+            try:
+                self._error = KinectError(self._errors.get_nowait())
+            except Empty:
+                code = self.process.exitcode
+                if code and not self._stop.is_set():
+                    self._error = KinectError("kinect%d: worker exited (%d)" %
+                                              (self.devno, code))
+        return self._error
+
+    has_new = property(lambda self: self.ring.has_new)
+    frames = property(lambda self: self.ring.frames)
+    dropped = property(lambda self: self.ring.dropped)
+    duplicated = property(lambda self: self.ring.duplicated)
+
+    def latest(self):
+        return self.ring.latest()
+
+class MultiKinect(object):
+    """A DeviceCapture for each of `devices` (device numbers)."""
+    def __init__(self, devices=(0,), backend=None, nbuffers=3,
+                 resolution=RESOLUTION_MEDIUM, depth_mode=DEPTH_11BIT):
+        self.captures = dict((devno, DeviceCapture(devno, backend, nbuffers,
+                                                   resolution=resolution,
+                                                   depth_mode=depth_mode))
+                             for devno in devices)
+
+    def __getitem__(self, devno):
+        return self.captures[devno]
+
+    @property
+    def devices(self):
+        return sorted(self.captures)
+
+    def start(self):
+        for capture in self.captures.values():
+            capture.start()
+
+    def stop(self):
+        for capture in self.captures.values():
+            capture._stop.set()
+        for capture in self.captures.values():
+            capture.stop()
+
+    @property
+    def error(self):
+        '''The first device error, if any device has one'''
+        for devno in self.devices:
+            if self.captures[devno].error is not None:
+                return self.captures[devno].error
+        return None
+
+    @property
+    def has_new(self):
+        '''True if any device has a new frame'''
+        return any(c.has_new for c in self.captures.values())
+
+    def latest(self, devno):
+        '''(data, timestamp, received) for device `devno`; see
+           SharedDepthRing.latest()'''
+        return self.captures[devno].latest()
+
+    def latest_all(self):
+        '''Return {devno: (data, timestamp, received)} for every device
+           that has a frame.'''
+        out = dict()
+        for devno, capture in self.captures.items():
+            frame = capture.latest()
+            if frame[0] is not None:
+                out[devno] = frame
+        return out
+
+    @property
+    def stats(self):
+        return dict((devno, dict(frames=c.frames, dropped=c.dropped,
+                                 duplicated=c.duplicated))
+                    for devno, c in self.captures.items())
@@ -15,21 +15,125 @@
 # You should have received a copy of the GNU General Public License
 # along with wigl.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import re
+import mmap
+from collections import OrderedDict
 import numpy as np
 from wigl import Texture2D
 from OpenGL.GL import *
 
-def readpbm(filename):
-    with open(filename, "rb") as pbm:
-        (magic, width, height, maxval) = pbm.readline().split()
-        d = np.fromfile(pbm, dtype=np.uint8 if int(maxval) < 256 else np.uint16)
+__all__ = [
+    'readpnm', 'readpbm', 'iterpnm',
+    'PBMTexture', 'pbm_texture', 'kinect_texture',
+    'TextureCache', 'texture_cache',
+]
 
-    if magic == "P5":
-        d.shape = (int(height),int(width))   # grayscale
-    elif magic == "P6":
-        d.shape = (int(height),int(width),3) # RGB
+# whitespace and comments, which can go anywhere between header fields
+_skip = re.compile(br'(?:\s|#[^\r\n]*)*')
+_number = re.compile(br'\d+')
 
-    return d
+# magic -> (channels, binary?)
+_formats = {
+    b'P1': (0, False), # bitmap (ASCII)
+    b'P2': (1, False), # grayscale (ASCII)
+    b'P3': (3, False), # RGB (ASCII)
+    b'P4': (0, True),  # bitmap
+    b'P5': (1, True),  # grayscale
+    b'P6': (3, True),  # RGB
+}
+
+class PNMError(ValueError):
+    pass
+
+def _header_field(buf, pos):
+    pos = _skip.match(buf, pos).end()
+    m = _number.match(buf, pos)
+    if not m:
+        raise PNMError("bad PNM header at offset %d" % pos)
+    return int(m.group()), m.end()
+
+def _read_image(buf, pos):
+    '''Read the image starting at `pos` in `buf` (a string or mmap).
+       Returns (image, offset of the end of the image).
+       Binary images are read-only views of `buf`; 16-bit data is big-endian,
+       per the spec, so it comes back with dtype '>u2'.'''
+    magic = buf[pos:pos+2]
+    if magic not in _formats:
+        raise PNMError("bad PNM magic %r at offset %d" % (magic, pos))
+    channels, binary = _formats[magic]
+    width, pos = _header_field(buf, pos+2)
+    height, pos = _header_field(buf, pos)
+    if channels:
+        maxval, pos = _header_field(buf, pos)
+    else:
+        maxval = 1
+    shape = (height, width, channels) if channels > 1 else (height, width)
+    if not binary:
+        # slow path: just parse all the numbers
+        count = height*width*max(channels, 1)
+        values = list()
+        for i in range(count):
+            if not channels:
+                # bitmap digits don't need whitespace between them
+                pos = _skip.match(buf, pos).end()
+                values.append(int(buf[pos:pos+1]))
+                pos += 1
+            else:
+                v, pos = _header_field(buf, pos)
+                values.append(v)
+        dtype = np.uint8 if maxval < 256 else np.uint16
+        return np.array(values, dtype=dtype).reshape(shape), pos
+    # exactly one whitespace character separates the header and the raster
+    pos += 1
+    if not channels:
+        rowbytes = (width+7)//8
+        packed = np.frombuffer(buf, np.uint8, rowbytes*height, pos)
+        bits = np.unpackbits(packed.reshape(height, rowbytes), axis=1)
+        return bits[:,:width], pos + packed.size
+    dtype = np.dtype(np.uint8 if maxval < 256 else '>u2')
+    count = height*width*channels
+    data = np.frombuffer(buf, dtype, count, pos).reshape(shape)
+    return data, pos + data.nbytes
+
+def _mmap(filename):
+    with open(filename, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _iterfile(filename):
+    buf = _mmap(filename)
+    pos = 0
+    while True:
+        pos = _skip.match(buf, pos).end()
+        if pos >= len(buf):
+            break
+        image, pos = _read_image(buf, pos)
+        yield image
+
+def iterpnm(path):
+    '''Lazily yield every image in `path`, which can be a (possibly
+       multi-image) PNM file or a directory of them (read in sorted order).
+       Images are memory-mapped views, so nothing gets read into memory
+       until you look at the data.'''
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if os.path.isfile(filename):
+                for image in _iterfile(filename):
+                    yield image
+    else:
+        for image in _iterfile(path):
+            yield image
+
+def readpnm(filename):
+    '''Return the (first) image in the given PNM file.
+       Grayscale images have shape (height, width), RGB (height, width, 3);
+       bitmaps (P1/P4) come back as 0s and 1s, where 1 means black.
+       Binary images are read-only views of the mmap'd file.'''
+    image, pos = _read_image(_mmap(filename), 0)
+    return image
+
+readpbm = readpnm
 
 class PBMTexture(Texture2D):
     def __init__(self, data, texturetype):
@@ -39,9 +143,97 @@ class PBMTexture(Texture2D):
             GL_UNSIGNED_BYTE if data.dtype == np.uint8 else GL_UNSIGNED_SHORT
         )
 
-def pbm_texture(filename, texturetype=GL_TEXTURE_2D):
+def load_pbm_texture(filename, texturetype=GL_TEXTURE_2D):
+    '''Read a PNM file and upload it as a new texture.'''
+    texture = PBMTexture(readpbm(filename), texturetype)
+    texture.load()
+    return texture
+
+class TextureCache(object):
+    """Shares loaded textures between everyone who asks for the same file.
+
+       Textures are keyed by (path, mtime, texturetype), so a file that
+       changes on disk gets reloaded. The cache keeps track of roughly how
+       many bytes of GPU memory its textures are using, and once that goes
+       over `budget` it deletes the least recently used ones - so don't hang
+       onto a texture across frames, get() it again when you need it.
+
+       hits, misses and evictions count what the cache has been up to.
+    """
+    def __init__(self, budget=256<<20, loader=load_pbm_texture):
+        self.budget = budget
+        self.loader = loader
+        self.resident = 0   # bytes of GPU memory in use by our textures
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._textures = OrderedDict() # key -> texture, oldest first
+        self._keys = dict()            # (path, texturetype) -> current key
+
+    def get(self, filename, texturetype=GL_TEXTURE_2D):
+        '''Return the (loaded) texture for `filename`, loading it if needed.'''
+        path = os.path.abspath(filename)
+        key = (path, os.stat(path).st_mtime, texturetype)
+        texture = self._textures.pop(key, None)
+        if texture is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            # a different version of this file is out of date now
+            stale = self._keys.get((path, texturetype))
+            if stale in self._textures:
+                self._evict(stale)
+            texture = self.loader(filename, texturetype)
+            self.resident += texture.gpu_bytes
+            self._keys[(path, texturetype)] = key
+        # (re)insert as most recently used
+        self._textures[key] = texture
+        self.trim(keep=key)
+        return texture
+
+    def _evict(self, key):
+        texture = self._textures.pop(key)
+        self.resident -= texture.gpu_bytes
+        texture.delete()
+        self.evictions += 1
+        path, mtime, texturetype = key
+        if self._keys.get((path, texturetype)) == key:
+            del self._keys[(path, texturetype)]
+
+    def trim(self, budget=None, keep=None):
+        '''Evict least recently used textures until we're within `budget`
+           (default: self.budget). The texture for `keep` is never evicted.'''
+        if budget is None:
+            budget = self.budget
+        for key in list(self._textures):
+            if self.resident <= budget:
+                break
+            if key != keep:
+                self._evict(key)
+
+    def clear(self):
+        '''Delete all the textures in the cache.'''
+        self.trim(budget=0)
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, resident=self.resident,
+                    textures=len(self._textures), budget=self.budget)
+
+# the default cache, for pbm_texture(cached=True) and friends
+texture_cache = TextureCache()
+
+def pbm_texture(filename, texturetype=GL_TEXTURE_2D, cached=False):
+    '''Return a texture for the given PNM file. By default it's a new one,
+       all yours, and not loaded yet (call its load()).
+       With cached=True you get an already-loaded texture from texture_cache
+       instead, shared with everyone else who asked for the same file - so
+       don't replace() or delete() it. See TextureCache.'''
+    if cached:
+        return texture_cache.get(filename, texturetype)
     return PBMTexture(readpbm(filename), texturetype)
 
-def kinect_texture(filename, texturetype=GL_TEXTURE_2D):
-    data = readpbm(filename)
-    return PBMTexture(data, texturetype)
+def kinect_texture(filename, texturetype=GL_TEXTURE_2D, cached=False):
+    '''A texture for a depth frame saved as a PNM file; see pbm_texture().'''
+    return pbm_texture(filename, texturetype, cached)
@@ -0,0 +1,260 @@
+# wigl.recording: record Kinect depth data and play it back
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Record depth frames from a Kinect to a file, and play them back later
+through something that looks just like a Kinect.
+
+To record:
+    kinect = Kinect()
+    DepthRecorder("session.depth").attach(kinect)
+    kinect.start_depth(callback)   # (or kinect.start_capture())
+
+To play it back in real time (or speed=2.0 for double speed, or speed=None
+for as fast as possible):
+    kinect = KinectPlayback("session.depth", speed=1.0)
+    kinect.start_depth(callback)
+
+The file is a 64-byte header followed by fixed-size records of:
+    time      float64   time.time() when the frame arrived
+    timestamp int64     the device's timestamp for the frame
+    depth     rows x cols array of the frame's dtype
+so a recording can be memory-mapped as a single numpy array, and played
+back without copying any frame data.
+"""
+
+import os
+import time
+import struct
+import numpy as np
+
+from .kinect import Kinect, KinectError
+
+__all__ = [
+    'DepthRecorder', 'Recording', 'KinectPlayback',
+]
+
+MAGIC = b'WIGLDPTH'
+VERSION = 1
+# magic, version, rows, cols, dtype string, padding
+HEADER = struct.Struct('<8sIII8s')
+HEADER_SIZE = 64
+
+def record_dtype(rows, cols, dtype):
+    '''Return the numpy dtype for one record in a recording'''
+    return np.dtype([
+        ('time', '<f8'),
+        ('timestamp', '<i8'),
+        ('depth', np.dtype(dtype), (rows, cols)),
+    ])
+
+def read_header(f):
+    '''Read a recording header from the file `f`, and return
+       (rows, cols, dtype).'''
+    raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE:
+        raise KinectError("%s: truncated header" % f.name)
+    magic, version, rows, cols, dtype = HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise KinectError("%s: not a depth recording" % f.name)
+    if version != VERSION:
+        raise KinectError("%s: unknown recording version %d" % \
+                           (f.name, version))
+    return rows, cols, np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+
+class DepthRecorder(object):
+    """Appends depth frames (and their timestamps) to a recording file.
+       attach() it to a Kinect before calling start_depth() and every frame
+       delivered to your callback gets recorded first.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.frames = 0
+        self._file = None
+        self._shape = None
+        self._dtype = None
+
+    def attach(self, kinect):
+        kinect.recorder = self
+        return self
+
+    def wrap(self, callback):
+        '''Return a depth callback that records each frame, then calls
+           `callback` with it.'''
+        def record_and_call(dev, data, timestamp):
+            self.write(data, timestamp)
+            if callback is not None:
+                return callback(dev, data, timestamp)
+        return record_and_call
+
+    def _open(self, data):
+        rows, cols = data.shape
+        dtype = data.dtype.newbyteorder('<')
+        self._file = open(self.filename, "a+b")
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            header = HEADER.pack(MAGIC, VERSION, rows, cols,
+                                 dtype.str.encode('ascii'))
+            self._file.write(header.ljust(HEADER_SIZE, b'\0'))
+        else:
+            self._file.seek(0)
+            if read_header(self._file) != (rows, cols, dtype):
+                raise KinectError("%s: can't append %s %s frames to this "
+                                  "recording" % (self.filename, data.shape,
+                                                 data.dtype))
+            # drop any partial record left over from a crash
+            recsize = record_dtype(rows, cols, dtype).itemsize
+            self._file.seek(0, os.SEEK_END)
+            extra = (self._file.tell() - HEADER_SIZE) % recsize
+            if extra:
+                self._file.truncate(self._file.tell() - extra)
+            self._file.seek(0, os.SEEK_END)
+        self._shape = data.shape
+        self._dtype = dtype
+        self._prefix = np.zeros(1, dtype=[('time','<f8'), ('timestamp','<i8')])
+
+    def write(self, data, timestamp):
+        '''Append one frame to the recording.'''
+        if self._file is None:
+            self._open(data)
+        elif data.shape != self._shape:
+            raise KinectError("frame shape changed from %s to %s" % \
+                               (self._shape, data.shape))
+        self._prefix['time'] = time.time()
+        self._prefix['timestamp'] = timestamp
+        self._prefix.tofile(self._file)
+        np.ascontiguousarray(data, dtype=self._dtype).tofile(self._file)
+        self.frames += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class Recording(object):
+    """A read-only, memory-mapped depth recording.
+       `depth`, `times` and `timestamps` are views into the mapped file, so
+       no frame data gets read until you actually look at it.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.rows, self.cols, self.dtype = read_header(f)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+        recdtype = record_dtype(self.rows, self.cols, self.dtype)
+        count = (size - HEADER_SIZE) // recdtype.itemsize
+        if count:
+            self.records = np.memmap(filename, dtype=recdtype, mode='r',
+                                     offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=recdtype)
+        self.depth = self.records['depth']
+        self.times = self.records['time']
+        self.timestamps = self.records['timestamp']
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        '''Return (depth, timestamp) for frame i.'''
+        return self.depth[i], int(self.timestamps[i])
+
+class PlaybackDevice(object):
+    """Plays back a Recording through the same interface as the `freenect`
+       module (or at least the bits of it that Kinect uses), so that it can
+       be used as a Kinect backend.
+    """
+    def __init__(self, recording, speed=1.0, loop=False):
+        self.recording = recording
+        self.speed = speed
+        self.loop = loop
+        self.frameno = 0
+        self.led = None
+        self.depth_callback = None
+        self.depth_running = False
+        self._start = None
+
+    def init(self):
+        return self
+
+    def shutdown(self, ctx):
+        self.depth_running = False
+
+    def open_device(self, ctx, devno):
+        return self
+
+    def close_device(self, dev):
+        self.depth_running = False
+
+    def set_depth_mode(self, dev, resolution, mode):
+        pass
+
+    def set_depth_callback(self, dev, callback):
+        self.depth_callback = callback
+        return 0
+
+    def start_depth(self, dev):
+        self.depth_running = True
+        self._start = None
+        return 0
+
+    def stop_depth(self, dev):
+        self.depth_running = False
+        return 0
+
+    def set_led(self, dev, led):
+        self.led = led
+        return 0
+
+    def process_events(self, ctx):
+        '''Deliver the next frame, once it's due.'''
+        if not self.depth_running:
+            time.sleep(0.01)
+            return 0
+        rec = self.recording
+        if self.frameno >= len(rec):
+            if not self.loop or not len(rec):
+                self.depth_running = False
+                raise KinectError("End of recording")
+            self.frameno = 0
+            self._start = None
+        i = self.frameno
+        if self.speed:
+            now = time.time()
+            if self._start is None:
+                # wall-clock time that corresponds to frame i
+                self._start = now - (rec.times[i] - rec.times[0])/self.speed
+            due = self._start + (rec.times[i] - rec.times[0])/self.speed
+            if now < due:
+                time.sleep(due - now)
+        self.frameno += 1
+        depth, timestamp = rec[i]
+        if self.depth_callback is not None:
+            self.depth_callback(self, depth, timestamp)
+        return 0
+
+class KinectPlayback(Kinect):
+    """A Kinect that plays back a recording made by DepthRecorder.
+       speed=1.0 plays in real time, 2.0 at double speed, etc.; speed=None
+       delivers frames as fast as you can process them.
+       When the recording ends, process_events() raises KinectError, unless
+       loop=True, in which case it starts over.
+    """
+    def __init__(self, filename, speed=1.0, loop=False, **kwargs):
+        self.recording = Recording(filename)
+        self.player = PlaybackDevice(self.recording, speed, loop)
+        super(KinectPlayback, self).__init__(backend=self.player, **kwargs)
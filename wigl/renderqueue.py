@@ -0,0 +1,175 @@
+# wigl.renderqueue: draw things sorted by GL state, batching where we can
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A retained list of things to draw, so they can be drawn in a sensible
+order instead of whatever order the code happens to run in.
+
+Each DrawItem says what program, VAO, index buffer and textures it needs,
+any uniforms to set first, and which range of indexes to draw. Add it to
+a RenderQueue once and it gets drawn every frame until you remove() it
+(or set its `visible` to False); change its fields whenever you like.
+
+draw() sorts the items by their state - program first, since that's the
+most expensive thing to switch, then VAO, index buffer and textures - so
+each program etc. is bound once per frame (the binds go through
+wigl.glstate, so they're free if it's already bound). The primitive
+restart index is set to match each item's index type the same way. Items are kept in
+that order between frames, so re-sorting is cheap. Neighbouring items
+with the same state and the same uniforms are drawn together with one
+glMultiDrawElements call.
+
+WIGL has one of these as self.queue, drawn after display() every frame.
+"""
+
+import ctypes
+import numpy as np
+from OpenGL.GL import *
+
+from . import glstate
+
+__all__ = [
+    'DrawItem', 'RenderQueue',
+]
+
+_index_types = {
+    np.dtype(np.uint8):  GL_UNSIGNED_BYTE,
+    np.dtype(np.uint16): GL_UNSIGNED_SHORT,
+    np.dtype(np.uint32): GL_UNSIGNED_INT,
+}
+
+class DrawItem(object):
+    """Draw indexes[first:first+count] (of the VBO `indexes`, or whatever
+       element buffer `vao` has) with `program`, after binding `textures`
+       (each one to its own unit) and setting `uniforms`.
+    """
+    def __init__(self, program, vao, mode=GL_TRIANGLES, indexes=None,
+                 first=0, count=None, textures=(), uniforms=None, gltype=None):
+        self.program = program
+        self.vao = vao
+        self.mode = mode
+        self.indexes = indexes
+        self.first = first
+        if count is None:
+            count = indexes.data.size if indexes is not None else 0
+        self.count = count
+        self.textures = tuple(textures)
+        self.uniforms = uniforms or dict()
+        if gltype is None:
+            gltype = GL_UNSIGNED_INT
+            if indexes is not None:
+                gltype = _index_types[np.dtype(indexes.data.dtype)]
+        self.gltype = gltype
+        self.visible = True
+        self._key = None
+
+    @property
+    def itemsize(self):
+        '''Size of one index, in bytes'''
+        return {GL_UNSIGNED_BYTE:1, GL_UNSIGNED_SHORT:2}.get(self.gltype, 4)
+
+    def key(self):
+        '''The state this item needs; items with equal keys can share draws'''
+        return (self.program.id, self.vao.id,
+                int(self.indexes) if self.indexes is not None else 0,
+                tuple((t.unit, t.texturetype, t.id) for t in self.textures),
+                self.mode, self.gltype)
+
+def _same_uniforms(a, b):
+    if a is b:
+        return True
+    if len(a) != len(b):
+        return False
+    for name, value in a.items():
+        if name not in b or not np.array_equal(value, b[name]):
+            return False
+    return True
+
+class RenderQueue(object):
+    """A sorted, retained list of DrawItems. See the module docs.
+       `draws` counts GL draw calls; `merged` counts items that got drawn
+       as part of another item's glMultiDrawElements call.
+    """
+    def __init__(self):
+        self.items = list()
+        self.draws = 0
+        self.merged = 0
+        # reused between frames for glMultiDrawElements' arguments
+        self._counts = np.zeros(16, dtype=np.int32)
+        self._offsets = np.zeros(16, dtype=np.uintp)
+
+    def add(self, item):
+        self.items.append(item)
+        return item
+
+    def remove(self, item):
+        self.items.remove(item)
+
+    def clear(self):
+        del self.items[:]
+
+    def __len__(self):
+        return len(self.items)
+
+    def draw(self):
+        '''Draw all the visible items, sorted and batched.'''
+        items = self.items
+        for item in items:
+            item._key = item.key()
+        # already in order (or nearly), unless something changed state
+        items.sort(key=lambda item: item._key)
+        run = list()
+        for item in items:
+            if not (item.visible and item.count):
+                continue
+            if run and (item._key != run[0]._key or
+                        not _same_uniforms(item.uniforms, run[0].uniforms)):
+                self._draw_run(run)
+                run = list()
+            run.append(item)
+        if run:
+            self._draw_run(run)
+
+    def _bind(self, item):
+        item.program.use()
+        item.vao.bind()
+        if item.indexes is not None:
+            item.indexes.bind()
+        glstate.current.primitive_restart(item.gltype)
+        for tex in item.textures:
+            glstate.current.bind_texture(tex.texturetype, tex.id, tex.unit)
+        if item.uniforms:
+            item.program.set_uniforms(**item.uniforms)
+
+    def _draw_run(self, run):
+        first = run[0]
+        self._bind(first)
+        size = first.itemsize
+        if len(run) == 1:
+            glDrawElements(first.mode, int(first.count), first.gltype,
+                           ctypes.c_void_p(int(first.first)*size))
+        else:
+            n = len(run)
+            if n > self._counts.size:
+                self._counts = np.zeros(n*2, dtype=np.int32)
+                self._offsets = np.zeros(n*2, dtype=np.uintp)
+            counts, offsets = self._counts[:n], self._offsets[:n]
+            for i, item in enumerate(run):
+                counts[i] = item.count
+                offsets[i] = item.first * size
+            glMultiDrawElements(first.mode, counts, first.gltype, offsets, n)
+            self.merged += n-1
+        self.draws += 1
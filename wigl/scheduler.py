@@ -0,0 +1,147 @@
+# wigl.scheduler: fixed-timestep updates and paced redraws
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The scheduler behind WIGL.every(), WIGL.timer() and WIGL.redraw().
+
+Repeating tasks run on a fixed timestep: each one's due times are
+start + n*interval, no matter how long the callbacks take, so they don't
+drift. If we fall behind (a long frame, the window got dragged...) a task
+runs up to `max_catchup` times to catch up, and then gives up on the rest
+and starts over from now (see `Task.dropped`).
+
+Redraw requests are coalesced: no matter how many times redraw() gets
+called, there's at most one frame per `frame_interval` (i.e. per vsync,
+at 60Hz by default), and none at all if nobody asked for one.
+next_wakeup() says how long we can sleep until something needs doing.
+"""
+
+import heapq
+from .timing import clock
+
+__all__ = [
+    'Scheduler', 'Task',
+]
+
+class Task(object):
+    """Something the Scheduler will call. cancel() to stop it."""
+    def __init__(self, func, value, when, interval=None, max_catchup=5):
+        self.func = func
+        self.value = value
+        self.when = when
+        self.interval = interval
+        self.max_catchup = max_catchup
+        self.calls = 0
+        self.dropped = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler(object):
+    def __init__(self, frame_interval=1.0/60, max_catchup=5):
+        self.frame_interval = frame_interval
+        self.max_catchup = max_catchup
+        self.queue = list()     # (when, seq, task)
+        self._seq = 0
+        self.last_frame = None
+        self.redraw_pending = False
+        self.redraw_posted = False
+        self.frames = 0
+        self.coalesced = 0      # redraw requests folded into another frame
+
+    def _push(self, task):
+        self._seq += 1
+        heapq.heappush(self.queue, (task.when, self._seq, task))
+        return task
+
+    def after(self, secs, func, value=None):
+        '''Call func(value) once, `secs` seconds from now.'''
+        return self._push(Task(func, value, clock() + secs))
+
+    def every(self, secs, func, value=None, max_catchup=None):
+        '''Call func(value) every `secs` seconds, starting `secs` from now.'''
+        if max_catchup is None:
+            max_catchup = self.max_catchup
+        return self._push(Task(func, value, clock() + secs, secs, max_catchup))
+
+    def run_due(self, now=None):
+        '''Run every task that's due. Returns the number of calls made.'''
+        if now is None:
+            now = clock()
+        calls = 0
+        while self.queue and self.queue[0][0] <= now:
+            when, seq, task = heapq.heappop(self.queue)
+            if task.cancelled:
+                continue
+            if task.interval is None:
+                task.func(task.value)
+                task.calls += 1
+                calls += 1
+                continue
+            steps = 0
+            while task.when <= now and steps < task.max_catchup:
+                task.func(task.value)
+                task.when += task.interval
+                steps += 1
+                if task.cancelled:
+                    break
+            task.calls += steps
+            calls += steps
+            if task.when <= now:
+                # too far behind; skip the missed steps
+                missed = int((now - task.when) // task.interval) + 1
+                task.dropped += missed
+                task.when += missed * task.interval
+            if not task.cancelled:
+                self._push(task)
+        return calls
+
+    def request_redraw(self):
+        if self.redraw_pending:
+            self.coalesced += 1
+        self.redraw_pending = True
+
+    def next_frame(self):
+        '''The earliest time the next frame should be drawn.'''
+        if self.last_frame is None:
+            return 0
+        return self.last_frame + self.frame_interval
+
+    def frame_due(self, now=None):
+        '''True if someone asked for a redraw and it's time for a frame.'''
+        if not self.redraw_pending or self.redraw_posted:
+            return False
+        return (now if now is not None else clock()) >= self.next_frame()
+
+    def frame_done(self, now=None):
+        self.last_frame = now if now is not None else clock()
+        self.redraw_pending = False
+        self.redraw_posted = False
+        self.frames += 1
+
+    def next_wakeup(self, now=None):
+        '''Seconds until something needs doing, or None if nothing does.'''
+        if now is None:
+            now = clock()
+        while self.queue and self.queue[0][2].cancelled:
+            heapq.heappop(self.queue)
+        times = [when for when, seq, task in self.queue[:1]]
+        if self.redraw_pending and not self.redraw_posted:
+            times.append(self.next_frame())
+        if not times:
+            return None
+        return max(0, min(times) - now)
@@ -0,0 +1,185 @@
+# wigl.shadercache: keep linked shader programs on disk
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compiling and linking GLSL is slow, and we do it every time we start.
+ProgramCache saves the driver's binary for each linked program (via
+glGetProgramBinary) and loads it back with glProgramBinary next time,
+skipping the compile and link entirely.
+
+Programs are keyed by their shader sources and types plus the GL vendor,
+renderer and version strings, so editing a shader or updating the driver
+just means a cache miss. Drivers are also allowed to reject binaries they
+made themselves (and do, after some updates); that's treated as a miss
+too, and the program gets rebuilt from source.
+
+ShaderProgram uses `program_cache` by default. It lives in
+$WIGL_SHADER_CACHE, or $XDG_CACHE_HOME/wigl/shaders (~/.cache/wigl/shaders).
+"""
+
+import os
+import struct
+import hashlib
+import tempfile
+import ctypes
+
+from OpenGL.GL import *
+from OpenGL.error import GLError
+from OpenGL.extensions import hasGLExtension
+# (the raw versions, so we can hand them plain ctypes buffers)
+from OpenGL.raw.GL.VERSION.GL_4_1 import glGetProgramBinary, glProgramBinary
+from .timing import clock
+
+__all__ = [
+    'ProgramCache', 'program_cache', 'default_cache_dir',
+]
+
+MAGIC = b'WIGLPROG'
+VERSION = 1
+# magic, version, binary format, binary length, seconds it took to build
+HEADER = struct.Struct('<8sIIId')
+
+def default_cache_dir():
+    if 'WIGL_SHADER_CACHE' in os.environ:
+        return os.environ['WIGL_SHADER_CACHE']
+    cachedir = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cachedir, 'wigl', 'shaders')
+
+class ProgramCache(object):
+    """An on-disk cache of linked program binaries. See the module docs."""
+    def __init__(self, directory=None):
+        self.directory = directory or default_cache_dir()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0     # binaries the driver wouldn't take back
+        self.stores = 0
+        self.time_saved = 0.0 # build time we didn't spend, in seconds
+        self._supported = None
+
+    @property
+    def supported(self):
+        '''Whether the current context can save/load program binaries'''
+        if self._supported is None:
+            self._supported = bool(
+                hasGLExtension('GL_ARB_get_program_binary') and
+                glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS))
+        return self._supported
+
+    def key(self, shaders):
+        '''Return the cache key for a program made from `shaders`.'''
+        h = hashlib.sha1()
+        for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+            h.update(glGetString(name) or b'')
+            h.update(b'\0')
+        for shader in shaders:
+            h.update(struct.pack('<I', shader.type))
+            source = shader.source
+            if not isinstance(source, bytes):
+                source = source.encode('utf-8')
+            h.update(source)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+
+    def load(self, program, key):
+        '''Try to load the cached binary for `key` into `program`.
+           Returns True if it worked (and the program is linked).'''
+        if not self.supported:
+            return False
+        start = clock()
+        try:
+            with open(self._path(key), 'rb') as f:
+                raw = f.read()
+            magic, version, binformat, length, build_secs = \
+                    HEADER.unpack_from(raw)
+            binary = raw[HEADER.size:]
+        except (IOError, OSError, struct.error):
+            self.misses += 1
+            return False
+        if magic != MAGIC or version != VERSION or len(binary) != length:
+            self._discard(key)
+            return False
+        try:
+            glProgramBinary(program, binformat, binary, length)
+        except GLError:
+            # e.g. GL_INVALID_ENUM: a format this driver doesn't do (any more)
+            self.rejected += 1
+            self._discard(key)
+            return False
+        if not glGetProgramiv(program, GL_LINK_STATUS):
+            self.rejected += 1
+            self._discard(key)
+            return False
+        self.hits += 1
+        self.time_saved += max(0.0, build_secs - (clock() - start))
+        return True
+
+    def _discard(self, key):
+        self.misses += 1
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def store(self, program, key, build_secs=0.0):
+        '''Save the binary for the linked `program` under `key`.
+           `build_secs` is how long it took to compile and link, so we can
+           tell how much time the cache saves later.
+           (The program should have GL_PROGRAM_BINARY_RETRIEVABLE_HINT set
+           before it was linked.)'''
+        if not self.supported:
+            return False
+        length = int(glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH))
+        if not length:
+            return False
+        binary = ctypes.create_string_buffer(length)
+        outlen, binformat = GLsizei(), GLenum()
+        glGetProgramBinary(program, length, ctypes.byref(outlen),
+                           ctypes.byref(binformat), binary)
+        data = HEADER.pack(MAGIC, VERSION, binformat.value, outlen.value,
+                           build_secs) + binary.raw[:outlen.value]
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # write it somewhere else first, so nobody reads half a file
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self._path(key))
+        except (IOError, OSError):
+            return False
+        self.stores += 1
+        return True
+
+    def clear(self):
+        '''Delete everything in the cache directory.'''
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.bin'):
+                os.unlink(os.path.join(self.directory, name))
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    rejected=self.rejected, stores=self.stores,
+                    time_saved=self.time_saved)
+
+# the default cache, used by ShaderProgram
+program_cache = ProgramCache()
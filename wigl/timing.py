@@ -0,0 +1,208 @@
+# wigl.timing: measure where the frame time goes
+#
+# Copyright (C) 2014 Will Woods <will@wizard.zone>
+#
+# wigl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# wigl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with wigl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Frame timing for WIGL.
+
+WIGL keeps a FrameTiming in self.timing, which records:
+  'display', 'keyboard', 'resize', 'timer', 'idle':
+            CPU time spent in each kind of callback
+  'frame':  time between the starts of consecutive frames
+  'gpu':    GPU time for each frame, from GL_TIME_ELAPSED queries
+All times are in seconds. Each one keeps a rolling window of samples, so
+you can ask for percentiles of recent frames:
+
+    w.timing['frame'].percentile(95)
+    w.timing.fps
+    print w.timing.format()
+
+Note that 'frame' (and so `fps`) is how often frames actually got drawn.
+WIGL only redraws when something asks it to, so that includes any time
+spent idle: a scene that isn't changing shows a very low fps without
+being slow at all. `max_fps` is how fast it could go, going by how long
+the frames themselves took ('display' and 'gpu').
+"""
+
+import ctypes
+from collections import deque
+from timeit import default_timer as clock
+
+import numpy as np
+from OpenGL.GL import *
+# (PyOpenGL's wrapped version of this can't handle uint64 numpy arrays)
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v
+
+__all__ = [
+    'clock', 'RollingStats', 'GPUTimer', 'FrameTiming',
+]
+
+class RollingStats(object):
+    """The most recent `size` samples of something, with percentiles."""
+    def __init__(self, size=256):
+        self.samples = np.zeros(size, dtype=np.float64)
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % self.samples.size] = value
+        self.count += 1
+
+    @property
+    def values(self):
+        '''The samples currently in the window (not in order)'''
+        return self.samples[:min(self.count, self.samples.size)]
+
+    def percentile(self, *pcts):
+        '''Return the given percentile(s) of the samples, or NaN if we
+           don't have any yet.'''
+        if not self.count:
+            result = np.full(len(pcts), np.nan)
+        else:
+            result = np.percentile(self.values, pcts)
+        return result[0] if len(pcts) == 1 else tuple(result)
+
+    def summary(self):
+        p50, p95, p99 = self.percentile(50, 95, 99)
+        values = self.values
+        return dict(count=self.count,
+                    mean=values.mean() if self.count else np.nan,
+                    max=values.max() if self.count else np.nan,
+                    p50=p50, p95=p95, p99=p99)
+
+class GPUTimer(object):
+    """Times GPU work with a ring of GL_TIME_ELAPSED queries.
+       Results are read back once they're available, usually a few frames
+       later, so this never makes the CPU wait on the GPU. If every query is
+       still pending, that frame just doesn't get timed (see `skipped`).
+    """
+    def __init__(self, stats, depth=4):
+        self.stats = stats
+        self.ids = [glGenQueries(1) for i in xrange(depth)]
+        self.free = list(self.ids)
+        self.pending = deque()
+        self.active = None
+        self.skipped = 0
+        self._result = ctypes.c_uint64()
+        # llvmpipe (Mesa 22, at least) gets the first GL_TIME_ELAPSED
+        # query in a context wildly wrong - nearly an hour, when the ones
+        # after it say ~100ms - so throw that one away. It's timing the
+        # first frame, which is mostly one-time setup anyway.
+        self._first = True
+
+    def begin(self):
+        self.poll()
+        if not self.free:
+            self.skipped += 1
+            return
+        self.active = self.free.pop()
+        glBeginQuery(GL_TIME_ELAPSED, self.active)
+
+    def end(self):
+        if self.active is None:
+            return
+        glEndQuery(GL_TIME_ELAPSED)
+        self.pending.append(self.active)
+        self.active = None
+
+    def poll(self):
+        '''Collect the results of any finished queries.'''
+        while self.pending:
+            query = self.pending[0]
+            if not glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE):
+                break
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT,
+                                  ctypes.byref(self._result))
+            if self._first:
+                self._first = False
+            else:
+                self.stats.add(self._result.value / 1e9)
+            self.free.append(self.pending.popleft())
+
+    def delete(self):
+        glDeleteQueries(len(self.ids), self.ids)
+
+class FrameTiming(object):
+    """A collection of RollingStats, by name. See the module docs."""
+    def __init__(self, gpu=True, size=256):
+        self.size = size
+        self.stats = dict()
+        self.gpu = GPUTimer(self['gpu']) if gpu else None
+        self._last_frame = None
+
+    def __getitem__(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = RollingStats(self.size)
+        return stats
+
+    def add(self, name, seconds):
+        self[name].add(seconds)
+
+    def timed(self, name, func, *args):
+        '''Call func(*args), adding the time it took to `name`.'''
+        start = clock()
+        try:
+            return func(*args)
+        finally:
+            self[name].add(clock() - start)
+
+    def begin_frame(self):
+        now = clock()
+        if self._last_frame is not None:
+            self['frame'].add(now - self._last_frame)
+        self._last_frame = now
+        if self.gpu is not None:
+            self.gpu.begin()
+
+    def end_frame(self):
+        if self.gpu is not None:
+            self.gpu.end()
+
+    @property
+    def fps(self):
+        '''Frames drawn per second, going by the median time between frames.
+           This is the rate frames were actually drawn at, idle time and
+           all; see the module docs.'''
+        return 1.0 / self['frame'].percentile(50)
+
+    @property
+    def max_fps(self):
+        '''Frames per second we could draw if we drew continuously: going by
+           the median of 'display' (CPU) or 'gpu' time, whichever's bigger.'''
+        busy = self['display'].percentile(50)
+        if self['gpu'].count:
+            busy = max(busy, self['gpu'].percentile(50))
+        return 1.0 / busy
+
+    def summary(self):
+        '''Return {name: RollingStats.summary(), ..., 'fps': fps,
+           'max_fps': max_fps}'''
+        out = dict((name, stats.summary())
+                   for name, stats in self.stats.items() if stats.count)
+        out['fps'] = self.fps
+        out['max_fps'] = self.max_fps
+        return out
+
+    def format(self):
+        '''Return a human-readable summary, one line per measurement.'''
+        lines = ["fps: %.1f (drawn), %.1f (max)" % (self.fps, self.max_fps)]
+        for name in sorted(self.stats):
+            stats = self.stats[name]
+            if not stats.count:
+                continue
+            p50, p95, p99 = stats.percentile(50, 95, 99)
+            lines.append("%-8s p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  (n=%d)"
+                         % (name, p50*1000, p95*1000, p99*1000, stats.count))
+        return "\n".join(lines)